@@ -139,6 +139,7 @@ OUTPUT_DIR = '/data/promnesia'
 '''
 Optional setting.
 A directory to keep intemediate caches in order to speed up indexing.
+(e.g. file types detected by the auto indexer, so unchanged files aren't opened again)
 If not specified, will use user cache directory
 If set to None, cache is disabled
 '''
@@ -171,3 +172,64 @@ def HOOK(v):
             return
     # otherwise keep intact
     yield v
+
+'''
+Optional setting.
+Same as HOOK, but receives lists of visits (HOOK_BATCH_SIZE at most), so the per-call work (e.g. loading a lookup table) can be shared.
+If both are set, HOOK is applied first. Errors are passed to the hooks as well, so make sure to keep them intact.
+The time spent in the hooks is reported after indexing.
+'''
+def BATCH_HOOK(visits):
+    for v in visits:
+        if isinstance(v, Exception):
+            yield v
+        elif 'example.com' not in v.norm_url:
+            yield v
+
+HOOK_BATCH_SIZE = 1000
+
+'''
+Optional setting.
+Extra url normalisation rules for the domains which promnesia doesn't know about (see promnesia/cannon.py for the builtin ones).
+Spec tells which query parameters are meaningful for the domain (and subdomains), and the rest is dropped.
+NOTE: if you're using these, pass the config to the server as well (promnesia serve --config ...), so it normalises urls the same way.
+'''
+from promnesia.cannon import Spec
+CANONIFY_SPECS = {
+    'example.com': Spec(qkeep=['article', 'page']),
+}
+
+'''
+Optional setting.
+Domain prefix substitutions, take priority over the builtin ones.
+'''
+CANONIFY_DOMAIN_SUBST = [
+    ('mobile.example.', 'example.'),
+]
+
+'''
+Optional setting.
+Keep the normalised urls in CACHE_DIR between the indexer runs, so they don't need to be recomputed every time.
+Invalidated automatically whenever the normalisation rules change.
+Worth it if you have millions of urls (e.g. browser history), but keep in mind the cache is loaded in memory during indexing.
+'''
+CANONIFY_CACHE = True
+
+'''
+Optional setting.
+Number of normalised urls kept in memory (within a single indexer/server process), 50K by default.
+0 disables the in-memory cache, negative value means unbounded.
+'''
+CANONIFY_CACHE_SIZE = 50_000
+
+'''
+Optional setting.
+How to detect duplicate visits emitted by a source. Possible values:
+- 'exact'  : keeps all visits in memory (default). Simplest, but might take gigabytes for sources with millions of visits
+- 'hash128': keeps a 128-bit hash of each visit. Exact for all practical purposes, and takes way less memory
+- 'hash64' : keeps a 64-bit hash of each visit. Faster to compute, but a few visits might be dropped on collision
+- 'window' : only detects duplicates among the last DEDUP_WINDOW visits (e.g. if the source emits duplicates close to each other)
+Memory used for deduplication is logged for each source.
+'''
+DEDUP = 'hash128'
+DEDUP_WINDOW = 100_000
@@ -74,7 +74,9 @@ def main() -> None:
 
 # todo might be nice to ensure they are installable in separation?
 DEPS_INDEXER = [
-    'urlextract',
+    # promnesia.common speeds up URLExtract by relying on its internals, see _URLEXTRACT_ATTRS
+    # tested against 1.2.0 - 1.10.0; for other versions it falls back onto the public API if needed (see test_urlextract_internals)
+    'urlextract>=1.2.0',
 ]
 
 DEPS_SERVER = [
@@ -88,6 +90,7 @@ DEPS_SOURCES = {
     ('optional', 'dependencies that bring some bells & whistles'): [
         'logzero', # pretty colored logging
         'python-magic', # better mimetype decetion
+        'brotli', # better compression for server responses
     ],
     ('HPI'     , 'dependencies for [[https://github.com/karlicoss/HPI][HPI]]'): [
         'HPI', # pypi version
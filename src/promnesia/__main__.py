@@ -2,23 +2,38 @@ import argparse
 import logging
 import inspect
 import sys
-from typing import List, Tuple, Optional, Dict, Sequence, Iterable, Iterator, Union
+from typing import Any, Callable, List, Tuple, Optional, Dict, Sequence, Iterable, Iterator, Union
 from pathlib import Path
 from datetime import datetime
 from .compat import check_call, register_argparse_extend_action_in_pre_py38
 from tempfile import TemporaryDirectory
+from contextlib import ExitStack
+from timeit import default_timer as timer
 
 
 from . import config
 from . import server
 from .misc import install_server
-from .common import PathIsh, logger, get_tmpdir, DbVisit, Res
+from .common import PathIsh, logger, get_tmpdir, DbVisit, DbVisitBatch, Res
 from .common import Source, get_system_tz, user_config_file, default_config_path
-from .dump import visits_to_sqlite
-from .extract import extract_visits, make_filter
+from .cannon import canonify_cache_stats, shutdown_pool as shutdown_canonify_pool
+from .cannon_cache import canonify_cache, CanonifyCache
+from .dump import visits_to_sqlite, recanonify
+from .extract import extract_batches, make_filter, filters, filter_stats
 
 
 def iter_all_visits(sources_subset: Iterable[Union[str, int]]=()) -> Iterator[Res[DbVisit]]:
+    for v in iter_all_batches(sources_subset):
+        if isinstance(v, DbVisitBatch):
+            yield from v
+        else:
+            yield v
+
+
+def iter_all_batches(sources_subset: Iterable[Union[str, int]]=()) -> Iterator[Res[Union[DbVisit, DbVisitBatch]]]:
+    '''
+    Same as iter_all_visits, but the visits might come in batches (see extract_batches)
+    '''
     cfg = config.get()
     output_dir = cfg.output_dir
     # not sure if belongs here??
@@ -26,8 +41,30 @@ def iter_all_visits(sources_subset: Iterable[Union[str, int]]=()) -> Iterator[Re
         logger.warning("OUTPUT_DIR '%s' didn't exist, creating", output_dir)
         output_dir.mkdir(exist_ok=True, parents=True)
 
-    hook = cfg.hook
+    cfg.configure_canonify()
+    # filters depend on the config, and their stats should only cover this run
+    filters.cache_clear()
+
+    with ExitStack() as estack:
+        # canonify worker processes are reused by all sources
+        estack.callback(shutdown_canonify_pool)
+        ccache: Optional[CanonifyCache] = None
+        cache_dir = cfg.cache_dir
+        if cfg.CANONIFY_CACHE and cache_dir is not None:
+            ccache = estack.enter_context(canonify_cache(cache_dir))
+        yield from _iter_all_batches(cfg, sources_subset, canonify_cache=ccache)
+
 
+def _iter_all_batches(
+        cfg: config.Config,
+        sources_subset: Iterable[Union[str, int]],
+        *,
+        canonify_cache: Optional[CanonifyCache],
+    ) -> Iterator[Res[Union[DbVisit, DbVisitBatch]]]:
+    hook = cfg.hook
+    batch_hook = cfg.batch_hook
+    batch_size = cfg.HOOK_BATCH_SIZE
+    _hook_stats.clear()
     sources = list(cfg.sources)
 
     is_subset_sources = bool(sources_subset)
@@ -57,24 +94,56 @@ def iter_all_visits(sources_subset: Iterable[Union[str, int]]=()) -> Iterator[Re
 
         # todo hmm it's not even used??
         einfo = source.description
-        for v in extract_visits(source, src=source.name):
-            if hook is None:
-                yield v
-            else:
-                try:
-                    yield from hook(v)
-                except Exception as e:
-                    yield e
+        # visits for the BATCH_HOOK
+        pending: List[Res[DbVisit]] = []
+        for b in extract_batches(source, src=source.name, canonify_cache=canonify_cache):
+            if hook is None and batch_hook is None:
+                yield b
+                continue
+            for v in (b if isinstance(b, DbVisitBatch) else (b,)):
+                vs = [v] if hook is None else _run_hook('HOOK', hook, v)
+                if batch_hook is None:
+                    yield from vs
+                    continue
+                pending.extend(vs)
+                if len(pending) >= batch_size:
+                    yield from _run_hook('BATCH_HOOK', batch_hook, pending)
+                    pending = []
+        if batch_hook is not None and len(pending) > 0:
+            yield from _run_hook('BATCH_HOOK', batch_hook, pending)
 
     if sources_subset:
         logger.warning("unknown --sources: %s", ", ".join(repr(i) for i in sources_subset))
 
 
+# hook name -> number of calls and time spent, for the index report
+_hook_stats: Dict[str, Dict[str, float]] = {}
+
+
+def hook_stats() -> Dict[str, Dict[str, float]]:
+    return {name: dict(st) for name, st in _hook_stats.items()}
+
+
+def _run_hook(name: str, hook: Callable[[Any], Iterable[Res[DbVisit]]], arg: Any) -> List[Res[DbVisit]]:
+    res: List[Res[DbVisit]] = []
+    before = timer()
+    try:
+        for x in hook(arg):
+            res.append(x)
+    except Exception as e:
+        # NOTE: for BATCH_HOOK, the whole batch is lost in this case
+        res.append(e)
+    st = _hook_stats.setdefault(name, {'calls': 0, 'seconds': 0.0})
+    st['calls'] += 1
+    st['seconds'] += timer() - before
+    return res
+
+
 def _do_index(dry: bool=False, sources_subset: Iterable[Union[str, int]]=(), overwrite_db: bool=False) -> Iterable[Exception]:
     # also keep & return errors for further display
     errors: List[Exception] = []
-    def it() -> Iterable[Res[DbVisit]]:
-        for v in iter_all_visits(sources_subset):
+    def it() -> Iterable[Res[Union[DbVisit, DbVisitBatch]]]:
+        for v in iter_all_batches(sources_subset):
             if isinstance(v, Exception):
                 errors.append(v)
             yield v
@@ -82,10 +151,15 @@ def _do_index(dry: bool=False, sources_subset: Iterable[Union[str, int]]=(), ove
     if dry:
         res = list(it())
         logger.warning("DRY MODE: won't modify the database. Printing the results out")
-        for v in res:
-            print(v)
+        for b in res:
+            for v in (b if isinstance(b, DbVisitBatch) else [b]):
+                print(v)
     else:
         dump_errors = visits_to_sqlite(it(), overwrite_db=overwrite_db)
+        logger.info('canonify in-memory cache: %s', canonify_cache_stats())
+        logger.info('visits dropped by filters: %s', filter_stats())
+        for name, st in hook_stats().items():
+            logger.info('%s: %d calls, %.2fs', name, st['calls'], st['seconds'])
         for e in dump_errors:
             logger.exception(e)
             errors.append(e)
@@ -176,7 +250,8 @@ def do_demo(
                 quiet=False,
                 config=ServerConfig(
                     db=dbp,
-                    timezone=get_system_tz()
+                    timezone=get_system_tz(),
+                    config=config_file,
                 ),
             )
 
@@ -275,6 +350,24 @@ def cli_doctor_db(args: argparse.Namespace) -> None:
     Popen(cmd)
 
 
+def cli_db_recanonify(args: argparse.Namespace) -> None:
+    config.load_from(args.config)
+    try:
+        cfg = config.get()
+        db = cfg.db
+        if not db.exists():
+            logger.error("Database %s doesn't exist!", db)
+            sys.exit(1)
+        cfg.configure_canonify()
+        from .config import use_cores
+        changed, errors = recanonify(db, workers=use_cores())
+    finally:
+        config.reset()
+    if errors > 0:
+        logger.error('%d errors while recanonifying (see logs above), their visits were kept intact', errors)
+        sys.exit(1)
+
+
 def cli_doctor_server(args: argparse.Namespace) -> None:
     port = args.port
     endpoint = f'http://localhost:{port}/status'
@@ -376,6 +469,13 @@ def main() -> None:
     sdps.set_defaults(func=cli_doctor_server)
     add_port_arg(sdps)
 
+    dbp = subp.add_parser('db', help='Database maintenance')
+    dbp.set_defaults(func=lambda *args: dbp.print_help())
+    sdbp = dbp.add_subparsers()
+    rcp = sdbp.add_parser('recanonify', help='Recompute normalised urls in place (e.g. after canonify rules changed), without reindexing the sources')
+    rcp.add_argument('--config', type=Path, default=default_config_path(), help='Config path')
+    rcp.set_defaults(func=cli_db_recanonify)
+
     args = p.parse_args()
 
     # TODO is there a way to print full help? i.e. for all subparsers
@@ -419,6 +519,8 @@ def main() -> None:
             args.func(args)
         elif args.mode == 'doctor':
             args.func(args)
+        elif args.mode == 'db':
+            args.func(args)
         else:
             raise AssertionError(f'unexpected mode {args.mode}')
 
@@ -0,0 +1,118 @@
+'''
+Bloom filter of the visited (normalised) urls, built by the indexer.
+
+Clients can download it (see /visited_filter endpoint) and check 'visited' status locally,
+only asking the server (e.g. /visited) about the urls that match.
+
+Binary format (all integers are little endian):
+
+- header: magic b'PRBF', format version (u8), number of hashes k (u8), number of bits m (u32), number of urls (u32)
+- followed by m / 8 bytes of the bit array, bit i is (byte i // 8) & (1 << (i % 8))
+
+For each url, h1 and h2 are the first two u32 of SHA-256 of its utf-8 encoding,
+and the bits set are (h1 + j * h2) % m for j in 0..k-1
+(SHA-256 is used since it's easily available in any environment, including browser extensions)
+'''
+from hashlib import sha256
+import math
+import struct
+from typing import List, Sequence
+
+from .common import Url
+
+
+_MAGIC = b'PRBF'
+_FORMAT_VERSION = 1
+_HEADER = struct.Struct('<4sBBII')
+
+# 1% false positives take ~10 bits per url, so ~1.2Mb for 1M urls, seems like a reasonable tradeoff
+FALSE_POSITIVE_RATE = 0.01
+
+
+def _hashes(url: Url) -> Sequence[int]:
+    return struct.unpack_from('<II', sha256(url.encode('utf8')).digest())
+
+
+class BloomFilter:
+    def __init__(self, *, bits: bytearray, k: int, count: int) -> None:
+        self.bits = bits
+        self.k = k
+        self.m = len(bits) * 8
+        self.count = count
+
+    @classmethod
+    def empty(cls, capacity: int, *, false_positive_rate: float=FALSE_POSITIVE_RATE) -> 'BloomFilter':
+        '''
+        capacity: expected number of urls, the false positive rate grows if more urls are added
+        '''
+        n = max(capacity, 1)
+        # standard optimal parameters
+        m = math.ceil(-n * math.log(false_positive_rate) / math.log(2) ** 2)
+        nbytes = (m + 7) // 8
+        m = nbytes * 8
+        k = max(1, round(m / n * math.log(2)))
+        return cls(bits=bytearray(nbytes), k=k, count=0)
+
+    @classmethod
+    def build(cls, urls: Sequence[Url], *, false_positive_rate: float=FALSE_POSITIVE_RATE) -> 'BloomFilter':
+        bf = cls.empty(len(urls), false_positive_rate=false_positive_rate)
+        for u in urls:
+            bf.add(u)
+        return bf
+
+    def add(self, url: Url) -> None:
+        h1, h2 = _hashes(url)
+        m = self.m
+        bits = self.bits
+        for j in range(self.k):
+            i = (h1 + j * h2) % m
+            bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def __contains__(self, url: Url) -> bool:
+        h1, h2 = _hashes(url)
+        m = self.m
+        bits = self.bits
+        for j in range(self.k):
+            i = (h1 + j * h2) % m
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def to_bytes(self) -> bytes:
+        return _HEADER.pack(_MAGIC, _FORMAT_VERSION, self.k, self.m, self.count) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'BloomFilter':
+        if len(data) < _HEADER.size:
+            raise ValueError(f'Bloom filter is too short: {len(data)} bytes')
+        magic, version, k, m, count = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError(f'Not a bloom filter: magic {magic!r}')
+        if version != _FORMAT_VERSION:
+            raise ValueError(f'Unsupported bloom filter format version: {version}')
+        bits = bytearray(data[_HEADER.size:])
+        if k == 0 or m == 0 or len(bits) * 8 != m:
+            raise ValueError(f'Malformed bloom filter: k={k}, m={m}, {len(bits)} bytes of bits')
+        return cls(bits=bits, k=k, count=count)
+
+
+def test_bloom_filter() -> None:
+    urls: List[Url] = [f'example.com/page{i}' for i in range(10000)]
+    bf = BloomFilter.from_bytes(BloomFilter.build(urls).to_bytes())
+    assert bf.count == len(urls)
+    # no false negatives
+    assert all(u in bf for u in urls)
+
+    others = [f'example.org/page{i}' for i in range(10000)]
+    fp = sum(u in bf for u in others)
+    assert fp < len(others) * FALSE_POSITIVE_RATE * 2, fp
+
+    empty = BloomFilter.build([])
+    assert 'example.com' not in empty
+
+    import pytest
+    data = BloomFilter.build(urls).to_bytes()
+    for bad in [b'', data[:10], b'XXXX' + data[4:], data[:-1]]:
+        with pytest.raises(ValueError):
+            BloomFilter.from_bytes(bad)
@@ -11,10 +11,14 @@ Also some experiments to establish 'URL hierarchy'.
 """
 # TODO eh?? they fixed mobile.twitter.com?
 
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
 from itertools import chain
+import os
 import re
 import typing
-from typing import Iterable, NamedTuple, Set, Optional, List, Sequence, Union, Tuple, Dict, Any, Collection
+from typing import Iterable, NamedTuple, Set, Optional, List, Sequence, Union, Tuple, Dict, Any, Collection, Generic, TypeVar
 
 import urllib.parse
 from urllib.parse import urlsplit, parse_qsl, urlunsplit, parse_qs, urlencode, SplitResult
@@ -40,7 +44,8 @@ def try_cutr(suffix: str, s: str) -> str:
         return s
 
 # TODO move this to site-specific normalisers?
-dom_subst = [
+# NOTE: these are matched as domain prefixes, first matching one wins
+dom_subst: List[Tuple[str, str]] = [
     ('m.youtube.'     , 'youtube.'),
     ('studio.youtube.', 'youtube.'),
 
@@ -65,7 +70,8 @@ def canonify_domain(dom: str) -> str:
     for st in ('www.', 'amp.'):
         dom = try_cutl(st, dom)
 
-    for start, repl in dom_subst:
+    label = dom.split('.', maxsplit=1)[0]
+    for start, repl in _dom_subst_index.get(label, _dom_subst_fallback):
         if dom.startswith(start):
             dom = repl + dom[len(start):]
             break
@@ -106,37 +112,60 @@ default_qkeep = [
     'p',
 ]
 
+Parts = Sequence[Tuple[str, str]]
+
 # TODO perhaps, decide if fragment is meaningful (e.g. wiki) or random sequence of letters?
 class Spec(NamedTuple):
     qkeep  : Optional[Union[Collection[str], bool]] = None
     qremove: Optional[Set[str]] = None
     fkeep  : bool = False
 
+    # NOTE: canonify uses compiled specs, this is kept for compatibility
     def keep_query(self, q: str) -> Optional[int]: # returns order
+        return self.compile().keep_query(q)
+
+    def compile(self) -> 'CompiledSpec':
         if self.qkeep is True:
-            return 1
+            return CompiledSpec(spec=self, keep_all=True, qkeep={})
         qkeep = {
             q: i for i, q in enumerate(chain(default_qkeep, self.qkeep or []))
         }
-        qremove = default_qremove.union(self.qremove or {})
-        # I suppose 'remove' is only useful for logging. we remove by default anyway
-
-        keep = False
-        remove = False
-        qk = qkeep.get(q)
-        if qk is not None:
-            return qk
+        # I suppose 'remove' (qremove) is only useful for logging. we remove by default anyway
         # todo later, check if spec tells both to keep and remove?
-        if q in qremove:
-            return None
-        # by default drop all
-        # it's a better default, since if it's *too* unified, the user would notice it. but not vice versa!
-        return None
+        return CompiledSpec(spec=self, keep_all=False, qkeep=qkeep)
 
     @classmethod
     def make(cls, **kwargs) -> 'Spec':
         return cls(**kwargs)
 
+
+class CompiledSpec(NamedTuple):
+    '''
+    Spec with precomputed query parameter tables, so filtering the query doesn't need to rebuild them for every parameter
+    '''
+    spec: Spec
+    keep_all: bool
+    # query parameter -> its order in the normalised url
+    qkeep: Dict[str, int]
+
+    def keep_query(self, q: str) -> Optional[int]:
+        if self.keep_all:
+            return 1
+        # by default drop all
+        # it's a better default, since if it's *too* unified, the user would notice it. but not vice versa!
+        return self.qkeep.get(q)
+
+    def filter_query(self, qq: Parts) -> List[Tuple[str, str]]:
+        if len(qq) == 0:
+            return []
+        if self.keep_all:
+            # all have the same order, so just sorted by parameter
+            return sorted(qq)
+        qkeep = self.qkeep
+        iqq = [(qkeep[k], k, v) for k, v in qq if k in qkeep]
+        iqq.sort()
+        return [(k, v) for i, k, v in iqq]
+
 S = Spec
 
 # TODO perhaps these can be machine learnt from large set of urls?
@@ -192,20 +221,111 @@ specs: Dict[str, Spec] = {
 }
 
 _def_spec = S()
-# TODO use cache?
+_def_compiled_spec = _def_spec.compile()
+
 def get_spec(dom: str) -> Spec:
-    # ugh. a bit ugly way of getting stuff without subdomain...
-    parts = dom.split('.')
-    cur = None
-    for p in reversed(parts):
-        if cur is None:
-            cur = p
+    return get_compiled_spec(dom).spec
+
+
+def get_compiled_spec(dom: str) -> CompiledSpec:
+    sp = _spec_trie.get(dom)
+    return _def_compiled_spec if sp is None else sp
+
+
+V = TypeVar('V')
+
+class DomainTrie(Generic[V]):
+    '''
+    Trie of reversed domain labels, e.g. 'play.google.com' is stored under 'com' -> 'google' -> 'play'.
+    Lookup returns the value for the shortest matching domain suffix, so 'en.wikipedia.org' gets the spec for 'wikipedia.org'.
+    '''
+    __slots__ = ('children', 'value')
+
+    def __init__(self) -> None:
+        self.children: Dict[str, DomainTrie[V]] = {}
+        self.value: Optional[V] = None
+
+    def add(self, dom: str, value: V) -> None:
+        node = self
+        for label in reversed(dom.split('.')):
+            child = node.children.get(label)
+            if child is None:
+                child = DomainTrie()
+                node.children[label] = child
+            node = child
+        node.value = value
+
+    def get(self, dom: str) -> Optional[V]:
+        node: Optional[DomainTrie[V]] = self
+        for label in reversed(dom.split('.')):
+            assert node is not None # make mypy happy
+            node = node.children.get(label)
+            if node is None:
+                return None
+            if node.value is not None:
+                return node.value
+        return None
+
+
+def _compile_specs(specs: Dict[str, Spec]) -> DomainTrie[CompiledSpec]:
+    trie: DomainTrie[CompiledSpec] = DomainTrie()
+    for dom, spec in specs.items():
+        trie.add(dom, spec.compile())
+    return trie
+
+
+DomSubstIndex = Dict[str, List[Tuple[str, str]]]
+
+def _compile_dom_subst(dom_subst: Sequence[Tuple[str, str]]) -> Tuple[DomSubstIndex, List[Tuple[str, str]]]:
+    '''
+    Groups the substitutions by the first domain label, so only the relevant ones need to be checked.
+    Prefixes without a dot (i.e. partial first label) might match any domain, so they end up in every group (and the fallback list).
+    The original order is preserved within each group.
+    '''
+    by_label: Dict[str, List[Tuple[int, str, str]]] = {}
+    fallback: List[Tuple[int, str, str]] = []
+    for i, (start, repl) in enumerate(dom_subst):
+        label, dot, _ = start.partition('.')
+        if dot == '':
+            fallback.append((i, start, repl))
         else:
-            cur = p + '.' + cur
-        sp = specs.get(cur)
-        if sp is not None:
-            return sp
-    return _def_spec
+            by_label.setdefault(label, []).append((i, start, repl))
+    index = {
+        label: [(start, repl) for _, start, repl in sorted(entries + fallback)]
+        for label, entries in by_label.items()
+    }
+    return index, [(start, repl) for _, start, repl in fallback]
+
+
+_builtin_specs = dict(specs)
+_builtin_dom_subst = list(dom_subst)
+
+def configure(*, user_specs: Dict[str, Spec]={}, user_dom_subst: Sequence[Tuple[str, str]]=(), cache_size: Optional[int]=None) -> None:
+    '''
+    Extends the builtin rules with the user defined ones (e.g. CANONIFY_SPECS/CANONIFY_DOMAIN_SUBST from the config).
+    User specs override the builtin ones for the same domains, and user substitutions take priority over the builtin ones.
+    Each call replaces the previously configured user rules.
+
+    cache_size: size of the in-memory canonify cache (see _canonify_cache_size)
+    '''
+    global _spec_trie, _dom_subst_index, _dom_subst_fallback, _user_specs, _user_dom_subst, _user_cache_size, _canonify_cached
+    # kept so they can be passed to subprocesses (see canonify_many)
+    _user_specs = dict(user_specs)
+    _user_dom_subst = list(user_dom_subst)
+    _user_cache_size = cache_size
+
+    specs.clear()
+    specs.update(_builtin_specs)
+    specs.update(user_specs)
+
+    dom_subst[:] = [*user_dom_subst, *_builtin_dom_subst]
+
+    _spec_trie = _compile_specs(specs)
+    _dom_subst_index, _dom_subst_fallback = _compile_dom_subst(dom_subst)
+    # also drops the cached results for the old rules
+    _canonify_cached = lru_cache(maxsize=_canonify_cache_size(cache_size))(_canonify)
+    # pool workers have the old rules
+    shutdown_pool()
 
 
 
@@ -218,7 +338,6 @@ Spec2 = Any # TODO
 
 # TODO this should be a map
 Frag = Any
-Parts = Sequence[Tuple[str, str]]
 
 
 def _yc(domain: str, path: str, qq: Parts, frag: Frag) -> Tuple[Any, Any, Parts, Frag]:
@@ -232,10 +351,12 @@ def _yc(domain: str, path: str, qq: Parts, frag: Frag) -> Tuple[Any, Any, Parts,
     # TODO this should be in-place? for brevity?
     return (domain, path, qq, frag)
 
+specs2: Dict[str, Spec2] = {
+    'news.ycombinator.com': _yc,
+}
+
 def get_spec2(dom: str) -> Optional[Spec2]:
-    return {
-        'news.ycombinator.com': _yc,
-    }.get(dom)
+    return specs2.get(dom)
 
 
 class CanonifyException(Exception):
@@ -258,10 +379,13 @@ def _quote_path(path: str) -> str:
     return '/'.join(nparts)
 
 
+_GOOGLE_AMP = re.compile(r'google\..*/amp/s/')
+
 # TODO wtf is it doing???
 def _prenormalise(url: str) -> str:
     # meh..
-    url = re.sub(r'google\..*/amp/s/', '', url)
+    if '/amp/s/' in url: # cheap check first, regex is relatively slow
+        url = _GOOGLE_AMP.sub('', url)
 
     if '?' not in url:
         # sometimes urls have not ? but do have query parameters starting with & for some reason; urlsplit chokes over it
@@ -273,6 +397,50 @@ def _prenormalise(url: str) -> str:
     return url
 
 
+ID   = r'(?P<id>[^/]+)'
+REST = r'(?P<rest>.*)'
+
+Left = Union[str, Sequence[str]]
+Right = Tuple[str, ...]
+# the idea is that we can unify certain URLs here and map them to the 'canonical' one
+# this is a dict only for grouping but should be a list really.. todo
+rules: Dict[Left, Right] = {
+    # TODO m. handling might be quite common
+    # f'm.youtube.com/{REST}': ('youtube.com', '{rest}'),
+    (
+        f'youtu.be/{ID}',
+        f'youtube.com/embed/{ID}',
+    ) : ('youtube.com', '/watch', 'v={id}'),
+    # TODO wonder if there is a better candidate for canonical video link?
+    # {DOMAIN} pattern? implicit?
+    (
+        'twitter.com/home',
+        'twitter.com/explore',
+    ) : ('twitter.com', '', ''),
+}
+
+CompiledRules = Dict[str, List[Tuple[typing.Pattern[str], Tuple[str, str, str]]]]
+
+def compile_rules(rules: Dict[Left, Right]) -> CompiledRules:
+    '''
+    Compiles the rules into a dispatch table by domain, so each url only needs to check the rules for its own domain
+    '''
+    res: CompiledRules = {}
+    for fr, to in rules.items():
+        if isinstance(fr, str):
+            fr = (fr, )
+        if len(to) == 2:
+            to = to + ('', )
+        assert len(to) == 3, to
+        for f in fr:
+            dom, rest = f.split('/', maxsplit=1)
+            rest = '/' + rest  # path seems to always start with /
+            res.setdefault(dom, []).append((re.compile(rest), (to[0], to[1], to[2])))
+    return res
+
+_compiled_rules = compile_rules(rules)
+
+
 def transform_split(split: SplitResult):
     netloc = canonify_domain(split.netloc)
 
@@ -281,48 +449,11 @@ def transform_split(split: SplitResult):
 
     fragment = split.fragment
 
-    ID   = r'(?P<id>[^/]+)'
-    REST = r'(?P<rest>.*)'
-
-    Left = Union[str, Sequence[str]]
-    Right = Tuple[str, str, str]
-    # the idea is that we can unify certain URLs here and map them to the 'canonical' one
-    # this is a dict only for grouping but should be a list really.. todo
-    rules: Dict[Left, Right] = {
-        # TODO m. handling might be quite common
-        # f'm.youtube.com/{REST}': ('youtube.com', '{rest}'),
-        (
-            f'youtu.be/{ID}',
-            f'youtube.com/embed/{ID}',
-        ) : ('youtube.com', '/watch', 'v={id}'),
-        # TODO wonder if there is a better candidate for canonical video link?
-        # {DOMAIN} pattern? implicit?
-        (
-            'twitter.com/home',
-            'twitter.com/explore',
-        ) : ('twitter.com', '', ''),
-    }
-
-    def iter_rules():
-        for fr, to in rules.items():
-            if isinstance(fr, str):
-                fr = (fr, )
-            for f in fr:
-                yield f, to
-
-    for fr, to in iter_rules():
-        # TODO precache by domain?
-        dom, rest = fr.split('/', maxsplit=1)
-        if dom != netloc:
-            continue
-
-        rest = '/' + rest  # path seems to always start with /
-        m = re.fullmatch(rest, path)
+    for rc, to in _compiled_rules.get(netloc, ()):
+        m = rc.fullmatch(path)
         if m is None:
             continue
         gd = m.groupdict()
-        if len(to) == 2:
-            to = to + ('', )
 
         (netloc, path, qq) = [t.format(**gd) for t in to]
         qparts.extend(parse_qsl(qq, keep_blank_values=True)) # TODO hacky..
@@ -361,18 +492,54 @@ def myunsplit(domain: str, path: str, query: str, fragment: str) -> str:
 #     ]
 #     for re in regexes:
 
+_ARCHIVE_ORG = re.compile(r'web.archive.org/web/(?P<timestamp>\d+)/(?P<rest>.*)')
+
 def handle_archive_org(url: str) -> Optional[str]:
-    are = r'web.archive.org/web/(?P<timestamp>\d+)/(?P<rest>.*)'
-    m = re.fullmatch(are, url)
+    m = _ARCHIVE_ORG.fullmatch(url)
     if m is None:
         return None
     else:
         return m.group('rest')
 
 
+_DEFAULT_CANONIFY_CACHE_SIZE = 50_000 # 50K urls is about 15Mb of memory
+
+
+def _canonify_cache_size(size: Optional[int]=None) -> Optional[int]:
+    '''
+    size: from the config (CANONIFY_CACHE_SIZE), if None falls back onto PROMNESIA_CANONIFY_CACHE_SIZE env variable
+    (env variable is propagated to the subprocesses/server workers)
+    0 disables the cache, negative value means unbounded
+    Returns the maxsize for lru_cache.
+    '''
+    if size is None:
+        cs = os.environ.get('PROMNESIA_CANONIFY_CACHE_SIZE', None)
+        if cs is None:
+            size = _DEFAULT_CANONIFY_CACHE_SIZE
+        else:
+            try:
+                size = int(cs)
+            except ValueError:
+                import warnings
+                warnings.warn(f'Malformed PROMNESIA_CANONIFY_CACHE_SIZE={cs!r}, using default cache size {_DEFAULT_CANONIFY_CACHE_SIZE}')
+                size = _DEFAULT_CANONIFY_CACHE_SIZE
+    return None if size < 0 else size
+
+
+def canonify(url: str) -> str:
+    return _canonify_cached(url)
+
+
+def canonify_cache_clear() -> None:
+    _canonify_cached.cache_clear()
+
+
+# same urls are canonified over and over again: browser history has thousands of visits of the same urls,
+# and the extension keeps requesting the same urls from the server
+# NOTE: the cache is per process, so it's safe to use from the process pools
 # TODO ok, I suppose even though we can't distinguish + and space, likelihood of them overlapping in normalised url is so low, that it doesn't matter much
 # TODO actually, might be easier for most special charaters
-def canonify(url: str) -> str:
+def _canonify(url: str) -> str:
     # TODO check for invalid charaters?
     url = _prenormalise(url)
 
@@ -408,18 +575,13 @@ def canonify(url: str) -> str:
         domain, path, qq, _frag = spec2(domain, path, qq, _frag)
 
 
-    spec = get_spec(domain)
+    spec = get_compiled_spec(domain)
 
     # TODO FIXME turn this logic back on?
-    # frag = parts.fragment if spec.fkeep else ''
+    # frag = parts.fragment if spec.spec.fkeep else ''
     frag = ''
 
-    iqq = []
-    for k, v in qq:
-        order = spec.keep_query(k)
-        if order is not None:
-            iqq.append((order, k, v))
-    qq = [(k, v) for i, k, v in sorted(iqq)]
+    qq = spec.filter_query(qq)
     # TODO still not sure what we should do..
     # quote_plus replaces %20 with +, not sure if we want it...
     query = urlencode(qq, quote_via=quote_via) # type: ignore[type-var]
@@ -431,6 +593,130 @@ def canonify(url: str) -> str:
     return uns
 
 
+_canonify_cached = lru_cache(maxsize=_canonify_cache_size())(_canonify)
+
+_spec_trie = _compile_specs(specs)
+_dom_subst_index, _dom_subst_fallback = _compile_dom_subst(dom_subst)
+_user_specs: Dict[str, Spec] = {}
+_user_dom_subst: List[Tuple[str, str]] = []
+_user_cache_size: Optional[int] = None
+
+
+def rules_digest() -> str:
+    '''
+    Changes whenever the canonify logic/rules (including the user configured ones) change.
+    Can be used to invalidate the persisted normalised urls.
+    '''
+    from hashlib import sha256
+    from pathlib import Path
+    h = sha256(Path(__file__).read_bytes())
+
+    # sets are iterated in random order, so need to be sorted to get a stable digest
+    det = lambda x: sorted(x) if isinstance(x, (set, frozenset)) else x
+    user = (
+        sorted((dom, det(sp.qkeep), det(sp.qremove), sp.fkeep) for dom, sp in _user_specs.items()),
+        _user_dom_subst,
+    )
+    h.update(repr(user).encode('utf8'))
+    return h.hexdigest()[:32]
+
+
+CanonifyResult = Union[str, CanonifyException]
+
+def _canonify_safe(url: str) -> CanonifyResult:
+    try:
+        return canonify(url)
+    except CanonifyException as e:
+        return e
+    except Exception as e:
+        ce = CanonifyException(url)
+        ce.__cause__ = e
+        return ce
+
+
+def _canonify_chunk(urls: Sequence[str]) -> List[CanonifyResult]:
+    return [_canonify_safe(u) for u in urls]
+
+
+def _init_worker(user_specs: Dict[str, Spec], user_dom_subst: List[Tuple[str, str]], cache_size: Optional[int]) -> None:
+    global _pool
+    # if the worker is forked, it inherits the parent's pool object, which isn't usable (nor should be shut down) here
+    _pool = None
+    # workers aren't necessarily forked (e.g. on mac/windows), so need to get the user rules
+    configure(user_specs=user_specs, user_dom_subst=user_dom_subst, cache_size=cache_size)
+
+
+# below that, the overhead of starting the processes and pickling isn't worth it
+_POOL_THRESHOLD = 20_000
+
+
+# the pool is kept between canonify_many calls, so the processes aren't started over again for every batch
+# NOTE: workers get the rules when they start, so the pool is shut down whenever the rules change (see configure)
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+
+
+def _get_pool(nworkers: int) -> ProcessPoolExecutor:
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != nworkers:
+        shutdown_pool()
+        _pool = ProcessPoolExecutor(nworkers, initializer=_init_worker, initargs=(_user_specs, _user_dom_subst, _user_cache_size))
+        _pool_workers = nworkers
+    return _pool
+
+
+def shutdown_pool() -> None:
+    '''
+    Stops the worker processes used by canonify_many (e.g. at the end of the indexing run)
+    '''
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+def canonify_many(urls: Iterable[str], *, workers: Optional[int]=None) -> List[CanonifyResult]:
+    '''
+    Batch version of canonify: returns the results in the same order,
+    but the errors are returned (as CanonifyException) rather than raised.
+    Each distinct url is only canonified once.
+
+    workers: None means no process pool, 0 means using all cores (same as PROMNESIA_CORES)
+    The pool is only used for large enough inputs, and kept until shutdown_pool() is called.
+    '''
+    urls = list(urls)
+    unique = list(dict.fromkeys(urls))
+    results: List[CanonifyResult]
+    if workers is None or len(unique) < _POOL_THRESHOLD:
+        results = _canonify_chunk(unique)
+    else:
+        nworkers = (os.cpu_count() or 1) if workers == 0 else workers
+        # a few chunks per worker, so they are balanced more evenly
+        size = -(-len(unique) // (nworkers * 4))
+        chunks = [unique[i: i + size] for i in range(0, len(unique), size)]
+        pool = _get_pool(nworkers)
+        try:
+            results = list(chain.from_iterable(pool.map(_canonify_chunk, chunks)))
+        except BrokenProcessPool:
+            # e.g. a worker was killed, the pool isn't usable anymore
+            shutdown_pool()
+            raise
+    mapping = dict(zip(unique, results))
+    return [mapping[u] for u in urls]
+
+
+def canonify_cache_stats() -> Dict[str, Any]:
+    ci = _canonify_cached.cache_info()
+    total = ci.hits + ci.misses
+    return {
+        'hits'    : ci.hits,
+        'misses'  : ci.misses,
+        'size'    : ci.currsize,
+        'maxsize' : ci.maxsize,
+        'hit_rate': None if total == 0 else round(ci.hits / total, 3),
+    }
+
+
  # TODO wonder if lisp could be convenient for this. lol
 TW_PATTERNS = [
     {
@@ -0,0 +1,89 @@
+'''
+Persistent cache of normalised urls, so the same urls (e.g. browser history) aren't canonified from scratch on every indexer run.
+
+Stored in CACHE_DIR, and invalidated whenever the canonify rules change (see cannon.rules_digest).
+'''
+from contextlib import contextmanager
+from pathlib import Path
+import sqlite3
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .cannon import canonify_many, rules_digest, CanonifyResult
+from .common import logger, Url
+
+
+# so we don't lose much if the indexer crashes, and don't keep too much in memory
+_WRITE_BATCH = 10_000
+
+
+class CanonifyCache:
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+        self.cache: Dict[Url, Url] = {}
+        self.pending: List[Tuple[Url, Url]] = []
+        self.hits = 0
+        self.misses = 0
+
+    def load(self) -> None:
+        conn = self.conn
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (rules_digest TEXT NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS canonify (url TEXT PRIMARY KEY, norm_url TEXT NOT NULL)')
+        digest = rules_digest()
+        row = conn.execute('SELECT rules_digest FROM meta').fetchone()
+        if row is None or row[0] != digest:
+            if row is not None:
+                logger.info('canonify rules changed, invalidating the canonify cache')
+            conn.execute('DELETE FROM canonify')
+            conn.execute('DELETE FROM meta')
+            conn.execute('INSERT INTO meta (rules_digest) VALUES (?)', (digest,))
+            conn.commit()
+        self.cache = dict(conn.execute('SELECT url, norm_url FROM canonify'))
+        logger.debug('loaded %d urls from the canonify cache', len(self.cache))
+
+    def canonify_many(self, urls: List[Url], *, workers: Optional[int]=None) -> List[CanonifyResult]:
+        '''
+        Same as cannon.canonify_many, but only canonifies the urls missing in the cache
+        '''
+        cache = self.cache
+        missing = [u for u in urls if u not in cache]
+        self.misses += len(missing)
+        self.hits += len(urls) - len(missing)
+        computed = dict(zip(missing, canonify_many(missing, workers=workers)))
+        for u, nu in computed.items():
+            # errors aren't cached, they should be rare anyway
+            if not isinstance(nu, Exception):
+                cache[u] = nu
+                self.pending.append((u, nu))
+        if len(self.pending) >= _WRITE_BATCH:
+            self.flush()
+        return [computed[u] if u in computed else cache[u] for u in urls]
+
+    def flush(self) -> None:
+        if len(self.pending) == 0:
+            return
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO canonify (url, norm_url) VALUES (?, ?)', self.pending)
+        self.pending = []
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits'  : self.hits,
+            'misses': self.misses,
+            'size'  : len(self.cache),
+        }
+
+
+@contextmanager
+def canonify_cache(cache_dir: Path) -> Iterator[CanonifyCache]:
+    path = cache_dir / 'canonify.sqlite'
+    conn = sqlite3.connect(str(path))
+    try:
+        cache = CanonifyCache(conn)
+        cache.load()
+        try:
+            yield cache
+        finally:
+            cache.flush()
+        logger.info('canonify persistent cache %s: %s', path, cache.stats())
+    finally:
+        conn.close()
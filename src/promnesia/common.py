@@ -1,14 +1,16 @@
 from collections.abc import Sized
 from contextlib import contextmanager
 from datetime import datetime, date
+import json
 import os
-from typing import NamedTuple, Set, Iterable, Dict, TypeVar, Callable, List, Optional, Union, Any, Collection, Sequence, Tuple, TypeVar, TYPE_CHECKING
+from typing import NamedTuple, Set, Iterable, Iterator, Dict, TypeVar, Callable, List, Optional, Union, Any, Collection, Sequence, Tuple, TypeVar, TYPE_CHECKING
 from pathlib import Path
 from glob import glob
 import itertools
 from more_itertools import intersperse
 import logging
 from functools import lru_cache
+import re
 import shutil
 from timeit import default_timer as timer
 from types import ModuleType
@@ -146,7 +148,10 @@ class DbVisit(NamedTuple):
     duration: Optional[Second] = None
 
     @staticmethod
-    def make(p: Visit, src: SourceName) -> Res['DbVisit']:
+    def make(p: Visit, src: SourceName, norm_url: Optional[Res[Url]]=None) -> Res['DbVisit']:
+        '''
+        norm_url: if already canonified (e.g. via cannon.canonify_many)
+        '''
         try:
             # hmm, mypy gets a bit confused here.. presumably because datetime is always datetime (but date is not datetime)
             if isinstance(p.dt, datetime):
@@ -159,10 +164,15 @@ class DbVisit(NamedTuple):
         except Exception as e:
             return e
 
-        try:
-            nurl = canonify(p.url)
-        except Exception as e:
-            return e
+        if norm_url is None:
+            try:
+                nurl = canonify(p.url)
+            except Exception as e:
+                return e
+        elif isinstance(norm_url, Exception):
+            return norm_url
+        else:
+            nurl = norm_url
 
         return DbVisit(
             # TODO shit, can't handle errors properly here...
@@ -176,6 +186,87 @@ class DbVisit(NamedTuple):
         )
 
 
+class VisitBatch:
+    '''
+    Column oriented batch of visits.
+    Sources can yield these (mixed with individual visits and errors) to avoid per-visit overhead.
+    '''
+    __slots__ = ('urls', 'dts', 'locators', 'contexts', 'durations')
+
+    def __init__(
+            self,
+            urls: List[Url],
+            dts: List[datetime],
+            locators: List[Loc],
+            contexts: Optional[List[Optional[Context]]]=None,
+            durations: Optional[List[Optional[Second]]]=None,
+    ) -> None:
+        n = len(urls)
+        self.urls = urls
+        self.dts = dts
+        self.locators = locators
+        self.contexts: List[Optional[Context]] = [None] * n if contexts is None else contexts
+        self.durations: List[Optional[Second]] = [None] * n if durations is None else durations
+        assert len(self.dts) == len(self.locators) == len(self.contexts) == len(self.durations) == n
+
+    @classmethod
+    def from_visits(cls, visits: Sequence[Visit]) -> 'VisitBatch':
+        return cls(
+            urls     =[v.url      for v in visits],
+            dts      =[v.dt       for v in visits],
+            locators =[v.locator  for v in visits],
+            contexts =[v.context  for v in visits],
+            durations=[v.duration for v in visits],
+        )
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def __iter__(self) -> Iterator[Visit]:
+        for url, dt, loc, ctx, dur in zip(self.urls, self.dts, self.locators, self.contexts, self.durations):
+            yield Visit(url=url, dt=dt, locator=loc, context=ctx, duration=dur)
+
+
+class DbVisitBatch:
+    '''
+    Column oriented batch of DbVisits from the same source, see VisitBatch
+    '''
+    __slots__ = ('norm_urls', 'orig_urls', 'dts', 'locators', 'src', 'contexts', 'durations')
+
+    def __init__(self, *, src: Optional[SourceName]) -> None:
+        self.src = src
+        self.norm_urls: List[Url] = []
+        self.orig_urls: List[Url] = []
+        self.dts: List[datetime] = []
+        self.locators: List[Loc] = []
+        self.contexts: List[Optional[Context]] = []
+        self.durations: List[Optional[Second]] = []
+
+    def append(self, *, norm_url: Url, orig_url: Url, dt: datetime, locator: Loc, context: Optional[Context], duration: Optional[Second]) -> None:
+        self.norm_urls.append(norm_url)
+        self.orig_urls.append(orig_url)
+        self.dts.append(dt)
+        self.locators.append(locator)
+        self.contexts.append(context)
+        self.durations.append(duration)
+
+    def __len__(self) -> int:
+        return len(self.norm_urls)
+
+    def __iter__(self) -> Iterator[DbVisit]:
+        src = self.src
+        for nurl, ourl, dt, loc, ctx, dur in zip(self.norm_urls, self.orig_urls, self.dts, self.locators, self.contexts, self.durations):
+            yield DbVisit(norm_url=nurl, orig_url=ourl, dt=dt, locator=loc, src=src, context=ctx, duration=dur)
+
+    def rows(self) -> Iterator[Tuple[Any, ...]]:
+        '''
+        Flattened the same way as cachew.NTBinder(DbVisit).to_row, for inserting in the database
+        '''
+        src = self.src
+        for nurl, ourl, dt, loc, ctx, dur in zip(self.norm_urls, self.orig_urls, self.dts, self.locators, self.contexts, self.durations):
+            yield (nurl, ourl, dt, loc.title, loc.href, src, ctx, dur)
+
+
 Filter = Callable[[Url], bool]
 
 
@@ -200,10 +291,195 @@ def get_tmpdir() -> tempfile.TemporaryDirectory:
 Syntax = str
 
 
+class _TldScanner:
+    '''
+    Drop-in replacement for the TLD regex in URLExtract (it only uses its findall), returning exactly the same matches.
+
+    The original regex is an alternation of all TLDs with IGNORECASE, and python regex engine tries all of them at every position,
+    so it takes most of the time of URLExtract.gen_urls. Instead we only look at the positions where a TLD can start (i.e. dots).
+    '''
+    def __init__(self, tlds: Sequence[str]) -> None:
+        '''
+        tlds: alternatives of the original regex, in the same order
+        '''
+        self.tlds = tlds
+        self._orig: Optional['re.Pattern[str]'] = None
+        # all TLDs start with a dot, except for 'localhost'
+        starts = {t[0] if t.startswith('.') else t for t in tlds}
+        self.candidates = re.compile('|'.join(map(re.escape, sorted(starts))), flags=re.IGNORECASE)
+
+        # for ASCII text, the matches can be looked up in a set, which is even faster
+        self.ascii_tlds: Optional[Set[str]] = None
+        ascii_tlds = [t for t in tlds if t.isascii()]
+        other_chars = {c for t in tlds if not t.isascii() for c in t if not c.isascii()}
+        if (
+            # with IGNORECASE some non-ASCII characters match ASCII ones, e.g. KELVIN SIGN matches 'k'
+            not any(ch.isascii() for c in other_chars for ch in c.lower() + c.upper())
+            and _longest_first(ascii_tlds)
+        ):
+            self.ascii_tlds = {t.lower() for t in ascii_tlds}
+            self.max_len = max(map(len, ascii_tlds))
+            tail_chars = {c for t in ascii_tlds for c in t[1:].lower() + t[1:].upper()}
+            self.tail = re.compile('[' + ''.join(map(re.escape, sorted(tail_chars))) + ']*')
+
+    @staticmethod
+    def parse(orig: 're.Pattern[str]') -> List[str]:
+        return [re.sub(r'\\(.)', r'\1', t) for t in orig.pattern.split('|')]
+
+    @property
+    def orig(self) -> 're.Pattern[str]':
+        # only needed for non-ASCII text, and takes a while to compile, so lazy
+        if self._orig is None:
+            self._orig = re.compile('|'.join(map(re.escape, self.tlds)), flags=re.IGNORECASE)
+        return self._orig
+
+    def findall(self, text: str) -> List[str]:
+        res: List[str] = []
+        search = self.candidates.search
+        fast = self.ascii_tlds is not None and text.isascii()
+        pos = 0
+        while True:
+            m = search(text, pos)
+            if m is None:
+                break
+            start = m.start()
+            found: Optional[str] = None
+            if fast:
+                assert self.ascii_tlds is not None # meh, for mypy
+                tail = self.tail.match(text, start + 1)
+                assert tail is not None
+                for end in range(min(tail.end(), start + self.max_len), start, -1):
+                    if text[start: end].lower() in self.ascii_tlds:
+                        found = text[start: end]
+                        break
+            else:
+                mm = self.orig.match(text, start)
+                if mm is not None:
+                    found = mm.group()
+            if found is None:
+                pos = start + 1
+            else:
+                res.append(found)
+                pos = start + len(found)
+        return res
+
+
+def _longest_first(tlds: Sequence[str]) -> bool:
+    '''
+    Regex alternation picks the first matching alternative, so the set lookup is only equivalent if longer TLDs always come before their prefixes
+    '''
+    idx = {t.lower(): i for i, t in enumerate(tlds)}
+    for i, t in enumerate(tlds):
+        for l in range(1, len(t)):
+            j = idx.get(t[:l].lower())
+            if j is not None and j < i:
+                return False
+    return True
+
+
+# bump if _TldScanner needs different data
+_TLDS_CACHE_VERSION = 1
+
+# where to keep the TLD list between the processes, see preload_urlextractors
+_tlds_cache_dir: Optional[Path] = None
+
+_tld_scanners: Dict[Tuple, _TldScanner] = {}
+
+
+def _get_tlds_cache_dir() -> Optional[Path]:
+    if _tlds_cache_dir is not None:
+        return _tlds_cache_dir
+    from . import config
+    return config.get().cache_dir if config.has() else None
+
+
+def _load_tld_scanner(u, reload: Callable[[], None]) -> _TldScanner:
+    '''
+    URLExtract reads (and idna decodes) the TLD list and compiles a huge regex on every instantiation, which takes a while.
+    So the TLDs are loaded once per process, and also kept in cache_dir, so new processes (e.g. auto indexer workers) start quickly.
+    '''
+    import urlextract # type: ignore
+    version = urlextract.__version__
+    tlds_path = u._tld_list_path
+    st = os.stat(tlds_path)
+    key = (_TLDS_CACHE_VERSION, tlds_path, st.st_mtime_ns, st.st_size, u._extract_localhost)
+    scanner = _tld_scanners.get((version, key))
+    if scanner is not None:
+        return scanner
+
+    cache_dir = _get_tlds_cache_dir()
+    cache_file = None if cache_dir is None else cache_dir / 'urlextract_tlds.json'
+    tlds: Optional[List[str]] = None
+    if cache_file is not None and cache_file.exists():
+        try:
+            data = json.loads(cache_file.read_text())
+            # the TLD list and the way it's processed might change between urlextract versions
+            cached_version = data.get('urlextract_version')
+            if cached_version != version:
+                logger.info('%s was created by urlextract %s (current: %s), ignoring', cache_file, cached_version, version)
+            elif tuple(data['key']) == key:
+                tlds = data['tlds']
+        except Exception as e:
+            logger.warning('error while loading %s, ignoring: %s', cache_file, e)
+    if tlds is None:
+        reload()
+        tlds = _TldScanner.parse(u._tlds_re)
+        if cache_file is not None:
+            # write + rename, so concurrent processes never see a partial file
+            tmp = cache_file.with_name(f'{cache_file.name}.{os.getpid()}.tmp')
+            try:
+                tmp.write_text(json.dumps({'urlextract_version': version, 'key': key, 'tlds': tlds}))
+                os.replace(tmp, cache_file)
+            except OSError as e:
+                # e.g. read-only cache dir, still fine to use the TLDs loaded in memory
+                logger.warning('error while saving %s, ignoring: %s', cache_file, e)
+                try:
+                    tmp.unlink()
+                except OSError:
+                    pass
+    scanner = _TldScanner(tlds)
+    _tld_scanners[(version, key)] = scanner
+    return scanner
+
+
+# URLExtract internals the speedups below rely on (see DEPS_INDEXER in setup.py for the tested versions)
+_URLEXTRACT_ATTRS = (
+    '_reload_tlds_from_file',
+    '_tld_list_path',
+    '_tlds_re',
+    '_extract_localhost',
+    '_stop_chars_left',
+    '_stop_chars_right',
+    '_after_tld_chars',
+)
+
+
+def _urlextract_compatible(u) -> bool:
+    import urlextract # type: ignore
+    return hasattr(urlextract, '__version__') and all(hasattr(u, a) for a in _URLEXTRACT_ATTRS)
+
+
+@lru_cache(1)
+def _urlextract_class():
+    from urlextract import URLExtract # type: ignore
+
+    class _URLExtract(URLExtract):
+        def _reload_tlds_from_file(self) -> None:
+            try:
+                scanner = _load_tld_scanner(self, reload=super()._reload_tlds_from_file)
+            except AttributeError as e:
+                # if URLExtract doesn't even call this method anymore, _UrlScanner falls back as well
+                logger.warning('unsupported urlextract version, extracting urls might be slow: %s', e)
+                super()._reload_tlds_from_file()
+                return
+            self._tlds_re = scanner
+
+    return _URLExtract
+
+
 @lru_cache(None)
 def _get_urlextractor(syntax: Syntax):
-    from urlextract import URLExtract # type: ignore
-    u = URLExtract()
+    u = _urlextract_class()()
     # https://github.com/lipoja/URLExtract/issues/13
     if syntax in {'org', 'orgmode', 'org-mode'}: # TODO remove hardcoding..
         # handle org-mode links properly..
@@ -226,10 +502,94 @@ def _sanitize(url: str) -> str:
     return url
 
 
+# plain http(s) url, without any characters which might make URLExtract trim or split it
+_SIMPLE_URL = re.compile(r'''
+https?://
+(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]*[a-zA-Z0-9])?\.)+(?P<tld>[a-zA-Z][a-zA-Z0-9-]*)
+(?::[0-9]+)?
+(?P<path>/[a-zA-Z0-9\-._~/?#@!$&*+,=%:]*)?
+''', flags=re.VERBOSE)
+
+
+class _UrlScanner:
+    '''
+    Finds the same urls as URLExtract.gen_urls, but faster:
+    - skips the text if it can't contain any TLDs at all
+    - if all potential urls in the text are plain http(s) urls, extracts them directly
+    - otherwise (e.g. bare domains) falls back onto URLExtract
+    With unsupported URLExtract versions, it only uses gen_urls.
+    '''
+    tlds: Optional[_TldScanner]
+
+    def __init__(self, extractor) -> None:
+        self.extractor = extractor
+        tlds = getattr(extractor, '_tlds_re', None)
+        if not isinstance(tlds, _TldScanner) or not _urlextract_compatible(extractor):
+            # unsupported URLExtract version, only the public API is safe to use
+            self.tlds = None
+            return
+        self.tlds = tlds
+        self.after_tld = frozenset(extractor._after_tld_chars)
+        # these characters stop the url on both sides, so the text can be split by them (e.g. whitespace, or [] for org-mode)
+        delims = extractor._stop_chars_left & extractor._stop_chars_right
+        self.chunks = re.compile('[^' + ''.join(map(re.escape, sorted(delims))) + ']+')
+
+    def urls(self, text: str) -> Iterable[Url]:
+        if self.tlds is None:
+            return self.extractor.gen_urls(text)
+        if self.tlds.candidates.search(text) is None:
+            return []
+        simple = self._simple_urls(text)
+        if simple is not None:
+            return simple
+        # note: it also has get_indices, might be useful
+        return self.extractor.gen_urls(text)
+
+    def _simple_urls(self, text: str) -> Optional[List[Url]]:
+        assert self.tlds is not None
+        ascii_tlds = self.tlds.ascii_tlds
+        if ascii_tlds is None or '://' not in text or not text.isascii():
+            return None
+        has_tlds = self.tlds.candidates.search
+        after_tld = self.after_tld
+        res: List[Url] = []
+        for m in self.chunks.finditer(text):
+            chunk = m.group()
+            if has_tlds(chunk) is None:
+                continue
+            u = _SIMPLE_URL.fullmatch(chunk)
+            if u is None or '.' + u.group('tld').lower() not in ascii_tlds:
+                return None
+            if chunk[-1] in after_tld:
+                # URLExtract might strip it
+                return None
+            end = m.end()
+            if u.group('path') is None and end < len(text) and text[end] not in after_tld:
+                # URLExtract wouldn't consider it a TLD
+                return None
+            res.append(chunk)
+        return res
+
+
+@lru_cache(None)
+def _get_url_scanner(syntax: Syntax) -> _UrlScanner:
+    return _UrlScanner(_get_urlextractor(syntax=syntax))
+
+
+def preload_urlextractors(cache_dir: Optional[Path]=None) -> None:
+    '''
+    Can be used as a worker process initializer, so the workers don't need to load URLExtract on the first file.
+    cache_dir: where to keep the TLD list, since workers might not have access to the config
+    '''
+    global _tlds_cache_dir
+    if cache_dir is not None:
+        _tlds_cache_dir = cache_dir
+    for syntax in ['', 'org', 'markdown']:
+        _get_url_scanner(syntax=syntax)
+
+
 def iter_urls(s: str, *, syntax: Syntax='') -> Iterable[Url]:
-    urlextractor = _get_urlextractor(syntax=syntax)
-    # note: it also has get_indices, might be useful
-    for u in urlextractor.gen_urls(s):
+    for u in _get_url_scanner(syntax=syntax).urls(s):
         yield _sanitize(u)
 
 
@@ -253,18 +613,6 @@ def join_tags(tags: Iterable[str]) -> str:
     return " ".join(f"#{t}" for t in tags if t and t.strip())
 
 
-class PathWithMtime(NamedTuple):
-    path: Path
-    mtime: float
-
-    @classmethod
-    def make(cls, p: Path) -> 'PathWithMtime':
-        return cls(
-            path=p,
-            mtime=p.stat().st_mtime,
-        )
-
-
 # like an Extractor, but with args not bound yet
 PreExtractor = Callable[..., Results]
 
@@ -426,9 +774,55 @@ def mime(path: PathIsh) -> Optional[str]:
     pm, _ = mimetypes.guess_type(ps)
     if pm is not None:
         return pm
-    # next, libmagic, it might access the file, so a bit slower
+    return mime_from_content(ps)
+
+
+# magic bytes for the most common binary files, to avoid calling libmagic for them
+# NOTE: mime types are the same as libmagic would return
+_SIGNATURES: List[Tuple[bytes, str]] = [
+    (b'SQLite format 3\x00' , 'application/vnd.sqlite3'),
+    (b'%PDF-'               , 'application/pdf'),
+    (b'\x1f\x8b'            , 'application/gzip'),
+    (b'\x89PNG\r\n\x1a\n'   , 'image/png'),
+    (b'\xff\xd8\xff'        , 'image/jpeg'),
+    (b'GIF87a'              , 'image/gif'),
+    (b'GIF89a'              , 'image/gif'),
+]
+
+
+def sniff_mime(header: bytes) -> Optional[str]:
+    '''
+    Cheap mime detection by the first bytes of the file. Returns None if not sure.
+    '''
+    if len(header) == 0:
+        return 'inode/x-empty'
+    for sig, m in _SIGNATURES:
+        if header.startswith(sig):
+            return m
+    if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+        return 'image/webp'
+    if header.startswith(b'PK\x03\x04'):
+        # first entry name starts at offset 30
+        # epub/docx/etc are also zips, so let libmagic deal with them
+        name = header[30:]
+        if name.startswith((b'mimetype', b'[Content_Types].xml', b'META-INF')):
+            return None
+        return 'application/zip'
+    return None
+
+
+def mime_from_content(path: PathIsh) -> Optional[str]:
+    try:
+        with open(path, 'rb') as fo:
+            header = fo.read(64)
+    except OSError:
+        header = None
+    pm = None if header is None else sniff_mime(header)
+    if pm is not None:
+        return pm
+    # next, libmagic, a bit slower
     magic = _magic()
-    return magic(ps)
+    return magic(str(path))
 
 
 def find_args(root: Path, follow: bool, ignore: List[str]=[]) -> List[str]:
@@ -474,11 +868,28 @@ def fdfind_args(root: Path, follow: bool, ignore: List[str]=[]) -> List[str]:
     ]
 
 
-def traverse(root: Path, *, follow: bool=True, ignore: List[str]=[]) -> Iterable[Path]:
+def traverse(root: Path, *, follow: bool=True, ignore: List[str]=[], use_gitignore: bool=False, hidden: bool=False) -> Iterable[Path]:
+    '''
+    use_gitignore: whether to skip the files ignored by .gitignore
+    hidden       : whether to include hidden files/directories (skipped by default, same as fd)
+    NOTE: with the external traverse (PROMNESIA_TRAVERSE=external), these are ignored:
+    fd always respects .gitignore and skips hidden files, find never does
+    '''
     if not root.is_dir():
         yield root
         return
 
+    from .config import use_external_traverse
+    if use_external_traverse():
+        yield from _traverse_external(root, follow=follow, ignore=ignore)
+        return
+
+    from .walk import walk
+    for e in walk(root, follow=follow, ignore=ignore, gitignore=use_gitignore, hidden=hidden):
+        yield e.path
+
+
+def _traverse_external(root: Path, *, follow: bool, ignore: List[str]) -> Iterable[Path]:
     # todo does windows even have symlinks??
     if _is_windows:
         # on windows could use 'forfiles'... but probably easier not to bother for now
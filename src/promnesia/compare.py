@@ -7,7 +7,7 @@ import sys
 from typing import Dict, List, Any, NamedTuple, Optional, Iterator, Set, Tuple
 
 
-from .common import DbVisit, Url, PathWithMtime # TODO ugh. figure out pythonpath
+from .common import DbVisit, Url # TODO ugh. figure out pythonpath
 
 # TODO include latest too?
 # from cconfig import ignore, filtered
@@ -138,8 +138,8 @@ def compare_files(*files: Path, log=True) -> Iterator[Tuple[str, DbVisit]]:
         name = f.name
         this_dts = name[0: name.index('.')] # can't use stem due to multiple extensions..
 
-        from promnesia.server import _get_stuff # TODO ugh
-        engine, binder, table = _get_stuff(PathWithMtime.make(f))
+        from promnesia.server import get_stuff # TODO ugh
+        engine, binder, table = get_stuff(f)
 
         with engine.connect() as conn:
             vis = [binder.from_row(row) for row in conn.execute(table.select())]  # type: ignore[var-annotated]
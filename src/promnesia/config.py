@@ -1,16 +1,18 @@
 from pathlib import Path
 import os
 from types import ModuleType
-from typing import List, Optional, Union, NamedTuple, Iterable, Callable
+from typing import List, Optional, Union, NamedTuple, Iterable, Callable, Dict, Tuple
 import importlib
 import importlib.util
 import warnings
 
 from .common import PathIsh, get_tmpdir, appdirs, default_output_dir, default_cache_dir, user_config_file
 from .common import Res, Source, DbVisit
+from .cannon import Spec
 
 
 HookT = Callable[[Res[DbVisit]], Iterable[Res[DbVisit]]]
+BatchHookT = Callable[[List[Res[DbVisit]]], Iterable[Res[DbVisit]]]
 
 
 from typing import Any
@@ -33,6 +35,22 @@ class Config(NamedTuple):
     FILTERS: List[str] = []
 
     HOOK: Optional[HookT] = None
+    # same as HOOK, but receives lists of (up to HOOK_BATCH_SIZE) visits, so can amortize the work (applied after HOOK)
+    BATCH_HOOK: Optional[BatchHookT] = None
+    HOOK_BATCH_SIZE: int = 1000
+
+    # extra url normalisation rules, see cannon.configure
+    CANONIFY_SPECS: Dict[str, Spec] = {}
+    CANONIFY_DOMAIN_SUBST: List[Tuple[str, str]] = []
+    # keep normalised urls in CACHE_DIR between the indexer runs (see cannon_cache.py)
+    CANONIFY_CACHE: bool = False
+    # number of normalised urls kept in memory, None means default (see cannon._canonify_cache_size)
+    CANONIFY_CACHE_SIZE: Optional[int] = None
+
+    # how to detect duplicate visits emitted by a source (see extract.make_dedup)
+    DEDUP: str = 'exact'
+    # for DEDUP = 'window'
+    DEDUP_WINDOW: int = 100_000
 
     #
     # NOTE: INDEXERS is deprecated, use SOURCES instead
@@ -97,6 +115,18 @@ class Config(NamedTuple):
     def hook(self) -> Optional[HookT]:
         return self.HOOK
 
+    @property
+    def batch_hook(self) -> Optional[BatchHookT]:
+        return self.BATCH_HOOK
+
+    def configure_canonify(self) -> None:
+        from . import cannon
+        cannon.configure(
+            user_specs=self.CANONIFY_SPECS,
+            user_dom_subst=self.CANONIFY_DOMAIN_SUBST,
+            cache_size=self.CANONIFY_CACHE_SIZE,
+        )
+
 instance: Optional[Config] = None
 
 
@@ -160,3 +190,13 @@ def extra_fd_args() -> List[str]:
     v = os.environ.get('PROMNESIA_FD_EXTRA_ARGS', '')
     extra = v.split() # eh, hopefully splitting that way is ok...
     return extra
+
+
+def use_external_traverse() -> bool:
+    '''
+    By default files are discovered in-process (see promnesia.walk)
+    PROMNESIA_TRAVERSE=external switches back to fd/find (also used if there are extra fd args)
+    '''
+    if os.environ.get('PROMNESIA_TRAVERSE', '') == 'external':
+        return True
+    return len(extra_fd_args()) > 0
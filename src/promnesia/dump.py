@@ -1,40 +1,49 @@
+from hashlib import sha256
 from pathlib import Path
 import shutil
-from typing import  List, Set, Iterable
+from typing import  Any, List, Set, Iterable, Iterator, Optional, Tuple, Union
 
 from more_itertools import chunked
 
-from sqlalchemy import create_engine, MetaData, Table, event, text
+from sqlalchemy import create_engine, MetaData, Table, event, text, exc
+from sqlalchemy.engine import Connection, Engine
 
 from cachew import NTBinder
 
-from .common import get_logger, DbVisit, get_tmpdir, Res, now_tz, Loc
+from .bloom import BloomFilter
+from .cannon import canonify_many, shutdown_pool as shutdown_canonify_pool
+from .common import get_logger, DbVisit, DbVisitBatch, get_tmpdir, Res, now_tz, Loc
 from . import config
 
 
-# NOTE: I guess the main performance benefit from this is not creating too many tmp lists and avoiding overhead
-# since as far as sql is concerned it should all be in the same transaction. only a guess
-# not sure it's the proper way to handle it
-# see test_index_many
-_CHUNK_BY = 10
+# NOTE: rows are inserted via executemany, so there is no limit on the number of sql variables
+# (previously it was a single INSERT with multiple VALUES, which would crash on large chunks, see test_index_many)
+# and the statement is only compiled once, rather than for every chunk
+_CHUNK_BY = 1000
 
 # I guess 1 hour is definitely enough
 _CONNECTION_TIMEOUT_SECONDS = 3600
 
 # returns critical warnings
-def visits_to_sqlite(vit: Iterable[Res[DbVisit]], *, overwrite_db: bool) -> List[Exception]:
+def visits_to_sqlite(vit: Iterable[Res[Union[DbVisit, DbVisitBatch]]], *, overwrite_db: bool) -> List[Exception]:
     logger = get_logger()
     db_path = config.get().db
 
+    binder = NTBinder.make(DbVisit)
+    SRC = [c.name for c in binder.columns].index('src')
+
     now = now_tz()
     ok = 0
     errors = 0
-    def vit_ok() -> Iterable[DbVisit]:
+    def rows() -> Iterator[Tuple[Any, ...]]:
         nonlocal errors, ok
         for v in vit:
-            if isinstance(v, DbVisit):
+            if isinstance(v, DbVisitBatch):
+                ok += len(v)
+                yield from v.rows()
+            elif isinstance(v, DbVisit):
                 ok += 1
-                yield v
+                yield binder.to_row(v)
             else:
                 errors += 1
                 # conform to the schema and dump. can't hurt anyway
@@ -47,7 +56,7 @@ def visits_to_sqlite(vit: Iterable[Res[DbVisit]], *, overwrite_db: bool) -> List
                     # todo attach backtrace?
                     context=repr(v),
                 )
-                yield ev
+                yield binder.to_row(ev)
 
     tpath = Path(get_tmpdir().name) / 'promnesia.tmp.sqlite'
     if overwrite_db:
@@ -64,18 +73,24 @@ def visits_to_sqlite(vit: Iterable[Res[DbVisit]], *, overwrite_db: bool) -> List
     def enable_wal(dbapi_con, con_record) -> None:
         dbapi_con.execute('PRAGMA journal_mode = WAL')
     event.listen(engine, 'connect', enable_wal)
+    event.listen(engine, 'connect', register_functions)
 
-    binder = NTBinder.make(DbVisit)
     meta = MetaData()
     table = Table('visits', meta, *binder.columns)
+    insert = table.insert()
+    names = [c.name for c in binder.columns]
+
+    if overwrite_db and db_path.exists():
+        # need to carry over the history, otherwise the clients would have to resync from scratch
+        copy_versions(engine, from_=db_path)
 
     cleared: Set[str] = set()
     ncleared = 0
     with engine.begin() as conn:
         table.create(conn, checkfirst=True)
 
-        for chunk in chunked(vit_ok(), n=_CHUNK_BY):
-            srcs = set(v.src or '' for v in chunk)
+        for chunk in chunked(rows(), n=_CHUNK_BY):
+            srcs = set(r[SRC] or '' for r in chunk)
             new = srcs.difference(cleared)
 
             for src in new:
@@ -85,9 +100,10 @@ def visits_to_sqlite(vit: Iterable[Res[DbVisit]], *, overwrite_db: bool) -> List
                 ncleared += cursor[0]
                 cleared.add(src)
 
-            bound = [binder.to_row(x) for x in chunk]
-            # pylint: disable=no-value-for-parameter
-            conn.execute(table.insert().values(bound))
+            conn.execute(insert, [dict(zip(names, r)) for r in chunk])
+
+        db_version, nchanged = update_versions(conn)
+        update_visited_filter(conn, version=db_version)
     engine.dispose()
 
     if overwrite_db:
@@ -99,7 +115,207 @@ def visits_to_sqlite(vit: Iterable[Res[DbVisit]], *, overwrite_db: bool) -> List
     logger.info(
         '%s database "%s". %d total (%d OK%s, %d cleared, +%d more)',
         what, db_path, total, ok, errs, ncleared, ok - ncleared)
+    logger.info('database version: %d (%d urls changed)', db_version, nchanged)
     res: List[Exception] = []
     if total == 0:
         res.append(RuntimeError('No visits were indexed, something is probably wrong!'))
     return res
+
+
+# for the clients keeping a local copy of the visited urls (see /changes endpoint)
+# every url has the db version it was last changed at, and the removed urls are kept as tombstones
+_VERSIONS_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS db_version (version INTEGER NOT NULL)',
+    # digest is a hash of all the visits for the url, a cheap way of telling if they changed
+    'CREATE TABLE IF NOT EXISTS url_versions (norm_url TEXT PRIMARY KEY, digest TEXT, version INTEGER NOT NULL, present INTEGER NOT NULL)',
+    # (version, norm_url) is the order the changes are paginated in
+    'DROP INDEX IF EXISTS main.index_url_versions_version',
+    'CREATE INDEX IF NOT EXISTS main.index_url_versions_version_url ON url_versions (version, norm_url)',
+]
+
+
+def _create_versions(conn: Connection) -> None:
+    for q in _VERSIONS_SCHEMA:
+        conn.execute(text(q))
+
+
+class VisitsDigest:
+    '''
+    sqlite aggregate function, hashing the contents of all the visits (rows) in the group.
+    Rows are sorted, so the result doesn't depend on the order they are stored in.
+    '''
+    def __init__(self) -> None:
+        self.rows: List[str] = []
+
+    def step(self, *columns: Any) -> None:
+        # repr, so None and '' are different
+        self.rows.append(repr(columns))
+
+    def finalize(self) -> str:
+        h = sha256()
+        for r in sorted(self.rows):
+            h.update(r.encode('utf8'))
+            h.update(b'\0')
+        return h.hexdigest()[:32]
+
+
+def register_functions(dbapi_con, con_record) -> None:
+    dbapi_con.create_aggregate('visits_digest', -1, VisitsDigest)
+
+
+def copy_versions(engine: Engine, *, from_: Path) -> None:
+    with engine.connect() as conn:
+        with conn.begin():
+            # NOTE: ATTACH can't be used within a transaction, so this needs to happen before any inserts
+            conn.execute(text("ATTACH DATABASE :path AS old"), {'path': str(from_)})
+            tables = {r[0] for r in conn.execute(text("SELECT name FROM old.sqlite_master WHERE type = 'table'"))}
+            _create_versions(conn)
+            for t in ('db_version', 'url_versions'):
+                if t in tables:
+                    conn.execute(text(f'INSERT INTO main.{t} SELECT * FROM old.{t}'))
+        # while it's attached, unqualified statements might resolve to the tables in the old (live!) database
+        # NOTE: DETACH isn't possible while the transaction is open (the database is locked), hence the separate transaction above
+        conn.execute(text("DETACH DATABASE old"))
+
+
+def get_db_version(conn: Connection) -> Optional[int]:
+    '''
+    None means that the database doesn't track versions (e.g. created by an older promnesia version)
+    '''
+    try:
+        row = conn.execute(text('SELECT version FROM db_version')).fetchone()
+    except exc.OperationalError as e:
+        if 'no such table' in str(e):
+            return None
+        raise e
+    return 0 if row is None else row[0]
+
+
+def update_versions(conn: Connection) -> Tuple[int, int]:
+    '''
+    Bumps the database version if any urls were added/removed/changed since the last time.
+    Returns the (new) version and the number of changed urls.
+    '''
+    _create_versions(conn)
+    old = get_db_version(conn)
+    assert old is not None
+    new = old + 1
+
+    conn.execute(text('DROP TABLE IF EXISTS temp.current_urls'))
+    conn.execute(text('''
+    CREATE TEMP TABLE current_urls AS
+    SELECT norm_url, visits_digest(orig_url, dt, locator_title, locator_href, src, context, duration) AS digest
+    FROM visits WHERE src != 'error'
+    GROUP BY norm_url
+    '''))
+
+    def changes() -> int:
+        row = conn.execute(text("SELECT changes()")).fetchone()
+        assert row is not None
+        return row[0]
+
+    # added/changed urls
+    conn.execute(text('''
+    INSERT INTO url_versions (norm_url, digest, version, present)
+    SELECT c.norm_url, c.digest, :version, 1
+    FROM current_urls AS c LEFT JOIN url_versions AS u ON c.norm_url = u.norm_url
+    WHERE u.norm_url IS NULL OR u.present = 0 OR u.digest != c.digest
+    ON CONFLICT (norm_url) DO UPDATE SET digest = excluded.digest, version = excluded.version, present = 1
+    '''), {'version': new})
+    nchanged = changes()
+
+    # removed urls
+    conn.execute(text('''
+    UPDATE url_versions SET present = 0, digest = NULL, version = :version
+    WHERE present = 1 AND norm_url NOT IN (SELECT norm_url FROM current_urls)
+    '''), {'version': new})
+    nchanged += changes()
+
+    conn.execute(text('DROP TABLE temp.current_urls'))
+
+    if nchanged == 0:
+        return old, 0
+
+    conn.execute(text('DELETE FROM db_version'))
+    conn.execute(text('INSERT INTO db_version (version) VALUES (:version)'), {'version': new})
+    return new, nchanged
+
+
+def update_visited_filter(conn: Connection, *, version: int) -> None:
+    '''
+    Rebuilds the snapshot of the visited urls bloom filter (served by /visited_filter endpoint)
+    '''
+    # NOTE: tables are qualified explicitly, so these never touch any other (attached) databases
+    row = conn.execute(text('SELECT count(*) FROM main.url_versions WHERE present = 1')).fetchone()
+    assert row is not None
+    bf = BloomFilter.empty(capacity=row[0])
+    for (url,) in conn.execute(text('SELECT norm_url FROM main.url_versions WHERE present = 1')):
+        bf.add(url)
+    data = bf.to_bytes()
+    # used as ETag, so the clients don't need to redownload it if nothing changed
+    digest = sha256(data).hexdigest()[:32]
+    conn.execute(text('DROP TABLE IF EXISTS main.visited_filter'))
+    conn.execute(text('CREATE TABLE main.visited_filter (version INTEGER NOT NULL, digest TEXT NOT NULL, data BLOB NOT NULL)'))
+    conn.execute(text('INSERT INTO main.visited_filter (version, digest, data) VALUES (:version, :digest, :data)'), {'version': version, 'digest': digest, 'data': data})
+
+
+_RECANONIFY_CHUNK = 50_000
+
+
+def recanonify(db_path: Path, *, workers: Optional[int]=None) -> Tuple[int, int]:
+    '''
+    Recomputes normalised urls of the visits in place (e.g. after canonify rules changed), so there is no need to reindex the sources.
+    Each chunk is updated in a separate transaction, so the database stays usable (e.g. by the server) in the meantime.
+    Returns the number of the changed visits and the number of errors.
+    '''
+    logger = get_logger()
+    engine = create_engine(f'sqlite:///{db_path}', connect_args={'timeout': _CONNECTION_TIMEOUT_SECONDS})
+    event.listen(engine, 'connect', register_functions)
+
+    with engine.connect() as conn:
+        row = conn.execute(text("SELECT count(*) FROM visits")).fetchone()
+        assert row is not None
+        total = row[0]
+
+    processed = 0
+    changed = 0
+    errors = 0
+    last = -1
+    try:
+        while True:
+            with engine.begin() as conn:
+                rows = list(conn.execute(
+                    text("SELECT rowid, orig_url, norm_url FROM visits WHERE rowid > :last AND src != 'error' ORDER BY rowid LIMIT :limit"),
+                    {'last': last, 'limit': _RECANONIFY_CHUNK},
+                ))
+                if len(rows) == 0:
+                    break
+                last = rows[-1][0]
+
+                nurls = canonify_many([r[1] for r in rows], workers=workers)
+                updates = []
+                for (rowid, orig_url, old), new in zip(rows, nurls):
+                    if isinstance(new, Exception):
+                        # just keep the old one
+                        errors += 1
+                        logger.error('error while canonifying %s', orig_url)
+                        logger.exception(new)
+                        continue
+                    if new != old:
+                        updates.append({'rowid': rowid, 'norm_url': new})
+                if len(updates) > 0:
+                    conn.execute(text("UPDATE visits SET norm_url = :norm_url WHERE rowid = :rowid"), updates)
+                processed += len(rows)
+                changed += len(updates)
+            logger.info('recanonify: processed %d/%d visits (%d changed, %d errors)', processed, total, changed, errors)
+    finally:
+        # the worker processes were reused between the chunks
+        shutdown_canonify_pool()
+
+    with engine.begin() as conn:
+        conn.execute(text("REINDEX visits"))
+        db_version, nchanged = update_versions(conn)
+        update_visited_filter(conn, version=db_version)
+    engine.dispose()
+    logger.info('recanonified database "%s": %d visits changed, database version: %d (%d urls changed)', db_path, changed, db_version, nchanged)
+    return changed, errors
@@ -1,19 +1,28 @@
+from collections import deque
+from datetime import datetime
 from functools import lru_cache
+from hashlib import blake2b
+from itertools import islice
 import re
+import sys
 import traceback
-from typing import Set, Iterable, Sequence, Union
+from typing import Any, Deque, Hashable, Set, Iterable, Sequence, Union, List, Optional, Dict, Tuple, TYPE_CHECKING
 
-from .cannon import CanonifyException
+from .cannon import CanonifyException, canonify_many
 from .common import (
     logger,
-    DbVisit, Visit,
+    DbVisit, Visit, Loc,
+    DbVisitBatch, VisitBatch,
     Res,
     SourceName, Source,
     Filter,
     Url,
-    Results, Extractor,
+    Result, Results, Extractor,
 )
 
+if TYPE_CHECKING:
+    from .cannon_cache import CanonifyCache
+
 
 DEFAULT_FILTERS = (
     r'^chrome-\w+://',
@@ -29,22 +38,263 @@ DEFAULT_FILTERS = (
 
 
 @lru_cache(1) #meh, not sure what would happen under tests?
-def filters() -> Sequence[Filter]:
+def filters() -> 'CompiledFilters':
     from . import config
 
-    flt = list(DEFAULT_FILTERS)
+    flt: List[Union[str, Filter]] = list(DEFAULT_FILTERS)
     if config.has(): # meeeh...
         cfg = config.get()
         flt.extend(cfg.FILTERS)
-    return tuple(make_filter(f) for f in flt)
+    return CompiledFilters(flt)
+
+
+_REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+
+# backreferences would refer to wrong groups, and global flags are only allowed at the start of the regex
+_NOT_COMBINABLE = re.compile(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)')
+
+_NEVER = re.compile(r'(?!)')
+
+
+class CompiledFilters:
+    '''
+    Matching a url against many regexes one by one is relatively slow, and it needs to be done for every visit.
+    So string filters are combined into a single regex, and literal '^prefix' ones are checked with a single str.startswith.
+    Filters which can't be combined (e.g. using backreferences) and predicates are checked separately.
+    '''
+    def __init__(self, filters: Sequence[Union[str, Filter]]) -> None:
+        self.prefixes: List[str] = []
+        self.individual: List[Tuple[str, 're.Pattern[str]']] = []
+        self.separate: List[Tuple[str, Filter]] = []
+        for f in filters:
+            if not isinstance(f, str):
+                self.separate.append((getattr(f, '__name__', repr(f)), f))
+                continue
+            rc = re.compile(f) # fail early if the regex is invalid
+            rest = f[1:]
+            if f.startswith('^') and len(rest) > 0 and not any(c in _REGEX_SPECIAL for c in rest):
+                self.prefixes.append(f)
+            elif _NOT_COMBINABLE.search(f) is None:
+                self.individual.append((f, rc))
+            else:
+                self.separate.append((f, make_filter(f)))
+        self.prefix_tuple = tuple(p[1:] for p in self.prefixes)
+
+        # NOTE: anchored and unanchored regexes are combined separately
+        # mixing them in a single alternation makes python regex engine try all of them at every position, which is way slower
+        def is_anchored(f: str) -> bool:
+            # with alternation the '^' might only apply to one of the branches
+            return f.startswith('^') and '|' not in f
+        anchored   = self._combine([f for f, _ in self.individual if     is_anchored(f)])
+        unanchored = self._combine([f for f, _ in self.individual if not is_anchored(f)])
+        if anchored is None or unanchored is None:
+            # e.g. same group names in different filters
+            self.separate.extend((f, make_filter(f)) for f, _ in self.individual)
+            self.individual = []
+            anchored = unanchored = _NEVER
+        self.anchored  : 're.Pattern[str]' = anchored
+        self.unanchored: 're.Pattern[str]' = unanchored
+
+        # filter -> number of urls it dropped
+        self.dropped: Dict[str, int] = {}
+
+    @staticmethod
+    def _combine(patterns: Sequence[str]) -> Optional['re.Pattern[str]']:
+        if len(patterns) == 0:
+            return _NEVER
+        try:
+            return re.compile('|'.join(f'(?:{p})' for p in patterns))
+        except re.error as e:
+            logger.debug("couldn't combine filters, falling back to matching them separately: %s", e)
+            return None
+
+    def match(self, url: Url) -> Optional[str]:
+        '''
+        Returns the (first) filter matching the url
+        '''
+        if url.startswith(self.prefix_tuple):
+            for p in self.prefixes:
+                if url.startswith(p[1:]):
+                    return p
+        if self.anchored.match(url) is not None or self.unanchored.search(url) is not None:
+            # only happens for the filtered urls, so fine to be slower here
+            for f, rc in self.individual:
+                if rc.search(url) is not None:
+                    return f
+        for f, flt in self.separate:
+            if flt(url):
+                return f
+        return None
+
+    def __call__(self, url: Url) -> bool:
+        f = self.match(url)
+        if f is None:
+            return False
+        self.dropped[f] = self.dropped.get(f, 0) + 1
+        return True
+
+
+class Dedup:
+    '''
+    Keeps track of the visits already emitted by the source.
+    Stores the visits as is, subclasses store more compact fingerprints instead.
+    '''
+    name = 'exact'
+
+    def __init__(self) -> None:
+        self.seen: Set[Hashable] = set()
+
+    def key(self, v: Visit) -> Hashable:
+        return v
+
+    def add(self, v: Visit) -> bool:
+        '''
+        Returns False if the visit is a duplicate
+        '''
+        k = self.key(v)
+        if k in self.seen:
+            return False
+        self.seen.add(k)
+        return True
+
+    def memory(self) -> int:
+        '''
+        Rough estimate of memory used, in bytes
+        '''
+        seen = self.seen
+        sample = list(islice(seen, 100))
+        if len(sample) == 0:
+            return sys.getsizeof(seen)
+        avg = sum(map(_deep_size, sample)) / len(sample)
+        return sys.getsizeof(seen) + int(avg * len(seen))
+
+
+def _deep_size(x: Any) -> int:
+    # good enough for visits, which are tuples of primitive values and Loc
+    # NOTE: objects shared between the visits are counted multiple times, so it overestimates a bit
+    res = sys.getsizeof(x)
+    if isinstance(x, tuple):
+        res += sum(map(_deep_size, x))
+    return res
+
+
+class Hash64Dedup(Dedup):
+    '''
+    Uses builtin (64-bit) hash, so might drop unique visits on collision, but that's fairly unlikely (~1e-5 for 10M visits)
+    '''
+    name = 'hash64'
+
+    def key(self, v: Visit) -> Hashable:
+        return hash(v)
+
 
+class Hash128Dedup(Dedup):
+    '''
+    Exact for all practical purposes, but a bit slower to compute.
+    NOTE: hashes the repr, so equal visits with different representation (e.g. same time in different timezones) are considered distinct
+    '''
+    name = 'hash128'
 
-def extract_visits(source: Source, *, src: SourceName) -> Iterable[Res[DbVisit]]:
+    def key(self, v: Visit) -> Hashable:
+        return int.from_bytes(blake2b(repr(v).encode('utf8'), digest_size=16).digest(), 'little')
+
+
+class WindowDedup(Hash64Dedup):
+    '''
+    Only detects duplicates among the last 'size' visits, so memory use is bounded
+    '''
+    name = 'window'
+
+    def __init__(self, size: int) -> None:
+        super().__init__()
+        self.size = size
+        self.window: Deque[Hashable] = deque()
+
+    def add(self, v: Visit) -> bool:
+        k = self.key(v)
+        if k in self.seen:
+            return False
+        self.seen.add(k)
+        window = self.window
+        window.append(k)
+        if len(window) > self.size:
+            self.seen.remove(window.popleft())
+        return True
+
+    def memory(self) -> int:
+        return super().memory() + sys.getsizeof(self.window)
+
+
+def make_dedup() -> Dedup:
+    from . import config
+    cfg = config.get() if config.has() else config.Config()
+    strategy = cfg.DEDUP
+    if strategy == 'exact':
+        return Dedup()
+    if strategy == 'hash64':
+        return Hash64Dedup()
+    if strategy == 'hash128':
+        return Hash128Dedup()
+    if strategy == 'window':
+        return WindowDedup(size=cfg.DEDUP_WINDOW)
+    raise RuntimeError(f"Unknown DEDUP strategy: {strategy}. Should be one of 'exact', 'hash64', 'hash128', 'window'")
+
+
+class Interner:
+    '''
+    Within a source run the same locators and contexts are repeated across lots of visits (e.g. links from the same message or file line).
+    Keeps a single copy of each, so the visits kept in memory (dedup, canonify batches) share them.
+    '''
+    def __init__(self, max_size: int=100_000) -> None:
+        # NOTE: cleared when full, so it doesn't keep growing with the bounded memory dedup strategies
+        self.max_size = max_size
+        self.locs: Dict[Loc, Loc] = {}
+        self.contexts: Dict[str, str] = {}
+        self.shared = 0
+
+    def visit(self, v: Visit) -> Visit:
+        loc = v.locator
+        locs = self.locs
+        iloc = locs.get(loc)
+        if iloc is None:
+            if len(locs) >= self.max_size:
+                locs.clear()
+            locs[loc] = iloc = loc
+
+        ctx = v.context
+        ictx = ctx
+        if ctx is not None:
+            contexts = self.contexts
+            ictx = contexts.get(ctx)
+            if ictx is None:
+                if len(contexts) >= self.max_size:
+                    contexts.clear()
+                contexts[ctx] = ictx = ctx
+
+        if iloc is loc and ictx is ctx:
+            return v
+        self.shared += 1
+        return v._replace(locator=iloc, context=ictx)
+
+
+def extract_visits(source: Source, *, src: SourceName, canonify_cache: Optional['CanonifyCache']=None) -> Iterable[Res[DbVisit]]:
+    for b in extract_batches(source, src=src, canonify_cache=canonify_cache):
+        if isinstance(b, Exception):
+            yield b
+        else:
+            yield from b
+
+
+def extract_batches(source: Source, *, src: SourceName, canonify_cache: Optional['CanonifyCache']=None) -> Iterable[Res[DbVisitBatch]]:
+    '''
+    Same as extract_visits, but emits column oriented batches, to avoid per-visit overhead downstream.
+    The source can emit individual visits, VisitBatch or both.
+    '''
     extractor = source.extractor
     logger.info('extracting via %s ...', source.description)
 
     try:
-        vit: Results = extractor()
+        vit: Iterable[Union[Result, VisitBatch]] = extractor()
     except Exception as e:
         # todo critical error?
         # cause that means error during binding extractor args
@@ -52,7 +302,43 @@ def extract_visits(source: Source, *, src: SourceName) -> Iterable[Res[DbVisit]]
         yield e
         return
 
-    handled: Set[Visit] = set()
+    from .config import use_cores
+    cores = use_cores()
+
+    # canonifying in batches is faster (e.g. same urls are only canonified once)
+    batch: List[Visit] = []
+    def flush() -> Iterable[Res[DbVisitBatch]]:
+        if len(batch) == 0:
+            return
+        # taken out before canonifying, so if it fails, the same visits aren't flushed again while handling the error
+        pending = list(batch)
+        batch.clear()
+        urls = [v.url for v in pending]
+        nurls = canonify_many(urls, workers=cores) if canonify_cache is None else canonify_cache.canonify_many(urls, workers=cores)
+        res = DbVisitBatch(src=src)
+        for v, nurl in zip(pending, nurls):
+            dt = v.dt
+            if isinstance(nurl, Exception) or not isinstance(dt, datetime):
+                # rare, so fine to go through the slow path
+                dv = next(iter(as_db_visit(v, src=src, norm_url=nurl)))
+                if isinstance(dv, Exception):
+                    # flushing first to preserve the order
+                    if len(res) > 0:
+                        yield res
+                        res = DbVisitBatch(src=src)
+                    yield dv
+                    continue
+                dt = dv.dt
+                nurl = dv.norm_url
+            res.append(norm_url=nurl, orig_url=v.url, dt=dt, locator=v.locator, context=v.context, duration=v.duration)
+        if len(res) > 0:
+            yield res
+
+    nfiltered = 0
+    nunique = 0
+    dedup = make_dedup()
+    # NOTE: src doesn't need interning, it's the same object for all visits from the source
+    interner = Interner()
     try:
         for p in vit:
             if isinstance(p, Exception):
@@ -61,27 +347,46 @@ def extract_visits(source: Source, *, src: SourceName) -> Iterable[Res[DbVisit]]
                 # eh, exception type is ignored by format_exception completely, apparently??
                 # parts.extend(traceback.format_exception(Exception, p, p.__traceback__))
                 # logger.error(''.join(parts))
+                # flushing first to preserve the order
+                yield from flush()
                 yield p
                 continue
 
-            if p in handled: # no need to emit duplicates
-                continue
-            handled.add(p)
+            for v in (p if isinstance(p, VisitBatch) else (p,)):
+                v = interner.visit(v)
+                if not dedup.add(v): # no need to emit duplicates
+                    continue
+                nunique += 1
 
-            yield from as_db_visit(p, src=src)
+                if filtered(v.url):
+                    nfiltered += 1
+                    continue
+                batch.append(v)
+            if len(batch) >= _CANONIFY_BATCH:
+                yield from flush()
+        yield from flush()
     except Exception as e:
+        # visits emitted before the error
+        yield from flush()
         # todo critical error?
         logger.exception(e)
         yield e
 
 
-    logger.info('extracting via %s: got %d visits', source.description, len(handled))
+    logger.info('extracting via %s: got %d visits (%d filtered out)', source.description, nunique, nfiltered)
+    logger.info('extracting via %s: dedup (%s) memory ~%.1f MiB', source.description, dedup.name, dedup.memory() / 2 ** 20)
+    logger.debug('extracting via %s: %d visits share locator/context with the previous ones', source.description, interner.shared)
+
 
+# large enough to benefit from canonify_many process pool
+_CANONIFY_BATCH = 50_000
 
-def as_db_visit(v: Visit, *, src: SourceName) -> Iterable[Res[DbVisit]]:
-    if filtered(v.url):
+
+def as_db_visit(v: Visit, *, src: SourceName, norm_url: Optional[Res[Url]]=None) -> Iterable[Res[DbVisit]]:
+    if norm_url is None and filtered(v.url):
+        # otherwise it's already been filtered
         return
-    res = DbVisit.make(v, src=src)
+    res = DbVisit.make(v, src=src, norm_url=norm_url)
     if isinstance(res, CanonifyException):
         # todo not sure if need this log? either way maybe get rid of canonify exception and just yield up
         logger.error('error while canonnifying %s... ignoring', v)
@@ -90,7 +395,11 @@ def as_db_visit(v: Visit, *, src: SourceName) -> Iterable[Res[DbVisit]]:
 
 
 def filtered(url: Url) -> bool:
-    return any(f(url) for f in filters())
+    return filters()(url)
+
+
+def filter_stats() -> Dict[str, int]:
+    return dict(filters().dropped)
 
 
 def make_filter(thing: Union[str, Filter]) -> Filter:
@@ -0,0 +1,86 @@
+'''
+Persistent cache of the file MIME types detected by content (e.g. via libmagic), so unchanged files aren't opened on every indexer run.
+
+Stored in CACHE_DIR, entries are invalidated when the file's mtime or size changes. Undetected types aren't stored.
+Only used for the files which can't be handled by the extension (see sources.auto), so it's fairly small.
+'''
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import sqlite3
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .common import logger, mime_from_content, _mimetypes
+
+
+_WRITE_BATCH = 1_000
+
+
+class MimeCache:
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+        # path -> mtime_ns, size, mime
+        self.cache: Dict[str, Tuple[int, int, Optional[str]]] = {}
+        self.pending: List[Tuple[str, int, int, Optional[str]]] = []
+        self.hits = 0
+        self.misses = 0
+
+    def load(self) -> None:
+        conn = self.conn
+        conn.execute('CREATE TABLE IF NOT EXISTS mime (path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, mime TEXT)')
+        self.cache = {path: (mtime_ns, size, m) for path, mtime_ns, size, m in conn.execute('SELECT path, mtime_ns, size, mime FROM mime')}
+        logger.debug('loaded %d entries from the mime cache', len(self.cache))
+
+    def mime(self, path: Path, st: os.stat_result) -> Optional[str]:
+        '''
+        Same as common.mime, but content based detection is cached
+        '''
+        ps = str(path)
+        pm, _ = _mimetypes().guess_type(ps)
+        if pm is not None:
+            return pm
+        cached = self.cache.get(ps)
+        # NOTE: older versions stored undetected types (None) as well, so these are detected again
+        if cached is not None and cached[2] is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            self.hits += 1
+            return cached[2]
+        self.misses += 1
+        pm = mime_from_content(ps)
+        if pm is None:
+            # e.g. libmagic isn't available, so it might be detected properly later
+            return None
+        self.cache[ps] = (st.st_mtime_ns, st.st_size, pm)
+        self.pending.append((ps, st.st_mtime_ns, st.st_size, pm))
+        if len(self.pending) >= _WRITE_BATCH:
+            self.flush()
+        return pm
+
+    def flush(self) -> None:
+        if len(self.pending) == 0:
+            return
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO mime (path, mtime_ns, size, mime) VALUES (?, ?, ?, ?)', self.pending)
+        self.pending = []
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits'  : self.hits,
+            'misses': self.misses,
+            'size'  : len(self.cache),
+        }
+
+
+@contextmanager
+def mime_cache(cache_dir: Path) -> Iterator[MimeCache]:
+    path = cache_dir / 'mime.sqlite'
+    conn = sqlite3.connect(str(path))
+    try:
+        cache = MimeCache(conn)
+        cache.load()
+        try:
+            yield cache
+        finally:
+            cache.flush()
+        logger.info('mime persistent cache %s: %s', path, cache.stats())
+    finally:
+        conn.close()
@@ -5,32 +5,74 @@ import argparse
 from dataclasses import dataclass
 import os
 import json
+import time
 from datetime import timedelta
 from pathlib import Path
 import logging
 from functools import lru_cache
-from typing import List, NamedTuple, Dict, Optional, Any, Tuple
+from contextlib import asynccontextmanager
+import asyncio
+import gzip
+import sqlite3
+from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
+from typing import List, NamedTuple, Dict, Optional, Any, Tuple, Callable, Hashable, TypeVar, Awaitable, AsyncIterator, Iterable
 
 
+from more_itertools import chunked
 import pytz
 from pytz import BaseTzInfo
 
 import fastapi
+from fastapi import Response
+from fastapi.concurrency import run_in_threadpool
 
-from sqlalchemy import MetaData, exists, literal, between, or_, and_, exc, select
+from sqlalchemy import MetaData, exists, literal, between, or_, and_, exc, select, event
 from sqlalchemy import Column, Table, func, types
 from sqlalchemy.sql.elements import ColumnElement
 from sqlalchemy.sql import text
 
 
-from .common import PathWithMtime, DbVisit, Url, setup_logger, default_output_dir, get_system_tz
+try:
+    import brotli # type: ignore
+except ImportError:
+    brotli = None
+
+from .common import DbVisit, Url, setup_logger, default_output_dir, get_system_tz
 from .compat import Protocol
-from .cannon import canonify
+from .cannon import canonify, canonify_many, canonify_cache_stats
+from .sqlite import sqlite_connection
 
 
 Json = Dict[str, Any]
 
-app = fastapi.FastAPI()
+T = TypeVar('T')
+
+
+@asynccontextmanager
+async def lifespan(app: fastapi.FastAPI) -> AsyncIterator[None]:
+    config = EnvConfig.get().config
+    if config is not None:
+        from .config import import_config
+        # should normalise urls the same way the indexer did
+        import_config(config).configure_canonify()
+    state_dir = EnvConfig.get().state_dir
+    reporter: Optional[asyncio.Task] = None
+    if state_dir is not None:
+        report_worker()
+        reporter = asyncio.create_task(report_worker_periodically())
+    yield
+    if reporter is not None:
+        reporter.cancel()
+    if state_dir is not None:
+        try:
+            (state_dir / f'{os.getpid()}.json').unlink()
+        except FileNotFoundError:
+            pass
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
 
 # meh. need this since I don't have hooks in hug to initialize logging properly..
 @lru_cache(1)
@@ -57,19 +99,38 @@ def get_version() -> str:
 class ServerConfig(NamedTuple):
     db: Path
     timezone: BaseTzInfo
+    db_workers: int = 4
+    db_max_queue: int = 64
+    # number of server processes
+    workers: int = 1
+    # shared between the server processes, to report their health
+    state_dir: Optional[Path] = None
+    # promnesia config, used for the custom url normalisation rules
+    config: Optional[Path] = None
 
     def as_str(self) -> str:
         return json.dumps({
-            'timezone': self.timezone.zone,
-            'db'      : str(self.db),
+            'timezone'    : self.timezone.zone,
+            'db'          : str(self.db),
+            'db_workers'  : self.db_workers,
+            'db_max_queue': self.db_max_queue,
+            'workers'     : self.workers,
+            'state_dir'   : None if self.state_dir is None else str(self.state_dir),
+            'config'      : None if self.config    is None else str(self.config   ),
         })
 
     @classmethod
     def from_str(cls, cfgs: str) -> 'ServerConfig':
         d = json.loads(cfgs)
+        dflt = cls._field_defaults
         return cls(
-            db      =Path         (d['db']),
-            timezone=pytz.timezone(d['timezone'])
+            db          =Path         (d['db']),
+            timezone    =pytz.timezone(d['timezone']),
+            db_workers  =d.get('db_workers'  , dflt['db_workers'  ]),
+            db_max_queue=d.get('db_max_queue', dflt['db_max_queue']),
+            workers     =d.get('workers'     , dflt['workers'     ]),
+            state_dir   =None if d.get('state_dir') is None else Path(d['state_dir']),
+            config      =None if d.get('config'   ) is None else Path(d['config'   ]),
         )
 
 
@@ -90,6 +151,110 @@ class EnvConfig:
 
 # todo how to return exception in error?
 
+
+class SingleFlight:
+    '''
+    Coalesces identical concurrent requests.
+
+    While a call for some key is in flight, other callers with the same key wait for it
+    and share its result instead of running the same DB query again.
+    E.g. on page load the extension requests the same url from the sidebar, icon update and mark visited code paths.
+
+    NOTE: not thread safe, meant to be used from the event loop
+    '''
+    def __init__(self) -> None:
+        self.inflight: Dict[Hashable, asyncio.Future] = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        fut = self.inflight.get(key)
+        if fut is not None:
+            self.coalesced += 1
+        else:
+            self.executed += 1
+            fut = asyncio.ensure_future(fn())
+            self.inflight[key] = fut
+            # NOTE: only coalescing requests in flight, the result isn't cached after that
+            fut.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # shield, so if one of the clients goes away it doesn't cancel the query for the rest
+        return await asyncio.shield(fut)
+
+    def stats(self) -> Json:
+        return {
+            'executed' : self.executed,
+            'coalesced': self.coalesced,
+        }
+
+
+class DbPool:
+    '''
+    Dedicated pool of threads for running the DB queries.
+
+    Limits the number of queries running at once, and rejects the requests (with 503) when too many are waiting,
+    so the rest of the server (e.g. /status) stays responsive even when there is a heavy /search running.
+    '''
+    def __init__(self, *, workers: int, max_queue: int) -> None:
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='promnesia-db')
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.peak_queued = 0
+        self.completed = 0
+        self.rejected = 0
+
+    async def run(self, fn: Callable[[], T]) -> T:
+        with self.lock:
+            if self.queued + self.active >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise fastapi.HTTPException(status_code=503, detail=f'Too many pending DB queries ({self.queued} queued), try again later')
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+
+        def job() -> T:
+            with self.lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                return fn()
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        cfut = self.executor.submit(job)
+        def on_done(f: Future) -> None:
+            if f.cancelled(): # job never started (e.g. client went away while it was queued)
+                with self.lock:
+                    self.queued -= 1
+        cfut.add_done_callback(on_done)
+        return await asyncio.wrap_future(cfut)
+
+    def stats(self) -> Json:
+        with self.lock:
+            return {
+                'workers'    : self.workers,
+                'max_queue'  : self.max_queue,
+                'queued'     : self.queued,
+                'active'     : self.active,
+                'peak_queued': self.peak_queued,
+                'completed'  : self.completed,
+                'rejected'   : self.rejected,
+            }
+
+
+_single_flight = SingleFlight()
+
+
+# NOTE: lazy, so it's created after the config is set
+@lru_cache(1)
+def get_db_pool() -> DbPool:
+    cfg = EnvConfig.get()
+    return DbPool(workers=cfg.db_workers, max_queue=cfg.db_max_queue)
+
+
 def as_json(v: DbVisit) -> Json:
     # yep, this is NOT %Y-%m-%d as is seems to be the only format with timezone that Date.parse in JS accepts. Just forget it.
     dts = v.dt.strftime('%d %b %Y %H:%M:%S %z')
@@ -119,22 +284,101 @@ def get_db_path(check: bool=True) -> Path:
 
 
 from .read_db import DbStuff, get_db_stuff
+from .dump import get_db_version
+
+
+Fingerprint = Tuple[int, ...]
+
+def db_fingerprint(db_path: Path) -> Fingerprint:
+    '''
+    Changes whenever the database contents change.
+    The inode changes when the database is overwritten (the whole file is replaced),
+    and the db version is bumped by the indexer whenever any urls were changed (see dump.update_versions).
+    Unlike the mtime/size of the database and WAL files, it isn't affected by checkpoints or unrelated writes,
+    so the caches aren't dropped needlessly.
+    Since it's only relying on the database itself, all server processes agree on it,
+    so their caches are invalidated consistently.
+    '''
+    try:
+        st = db_path.stat()
+    except FileNotFoundError:
+        return (0, 0)
+    version = _cached_db_version(db_path, st)
+    if version is None:
+        # older database which doesn't track versions, so can only rely on the mtime
+        return (st.st_ino, -1, st.st_mtime_ns)
+    return (st.st_ino, version)
+
+
+# db path -> (files stat key, db version)
+_db_versions: Dict[Path, Tuple[Tuple[int, ...], Optional[int]]] = {}
+
+
+def _cached_db_version(db_path: Path, st: os.stat_result) -> Optional[int]:
+    '''
+    Opening a connection on every request just to read the version is wasteful, so it's only read again when the files change.
+    The indexer writes in WAL mode, so the commits might only touch the -wal file until the checkpoint.
+    '''
+    wal: Tuple[int, ...] = ()
+    try:
+        wst = Path(f'{db_path}-wal').stat()
+    except FileNotFoundError:
+        pass
+    else:
+        # NOTE: empty WAL doesn't have any commits (and it's created by the readers too)
+        if wst.st_size > 0:
+            wal = (wst.st_ino, wst.st_mtime_ns, wst.st_size)
+    key = (st.st_ino, st.st_mtime_ns, st.st_size, *wal)
+    cached = _db_versions.get(db_path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    version = _read_db_version(db_path)
+    _db_versions[db_path] = (key, version)
+    return version
+
+
+def _read_db_version(db_path: Path) -> Optional[int]:
+    try:
+        with sqlite_connection(f'{db_path}?mode=ro') as conn:
+            row = conn.execute('SELECT version FROM db_version').fetchone()
+    except sqlite3.OperationalError as e:
+        if 'no such table' in str(e):
+            return None
+        raise e
+    return 0 if row is None else row[0]
+
+
+# shared between the server processes via the OS page cache, so each of them doesn't need its own copy of the pages
+_MMAP_SIZE = 256 * 1024 * 1024
+
 
 @lru_cache(1)
-# PathWithMtime aids lru_cache in reloading the sqlalchemy binder
-def _get_stuff(db_path: PathWithMtime) -> DbStuff:
+# fingerprint aids lru_cache in reloading the sqlalchemy binder
+def _get_stuff(db_path: Path, fingerprint: Fingerprint) -> DbStuff:
     get_logger().debug('Reloading DB: %s', db_path)
-    return get_db_stuff(db_path=db_path.path)
+    engine, binder, table = get_db_stuff(db_path=db_path)
+
+    def setup_connection(dbapi_con, con_record) -> None:
+        dbapi_con.execute(f'PRAGMA mmap_size = {_MMAP_SIZE}')
+    event.listen(engine, 'connect', setup_connection)
+    engine.dispose() # make sure the connections opened during the setup are not reused
+    return engine, binder, table
 
 
 def get_stuff(db_path: Optional[Path]=None) -> DbStuff: # TODO better name
     # ok, it will always load from the same db file; but intermediate would be kinda an optional dump.
     if db_path is None:
         db_path = get_db_path()
-    return _get_stuff(PathWithMtime.make(db_path))
+    return _get_stuff(db_path, db_fingerprint(db_path))
 
 
 def db_stats(db_path: Path) -> Json:
+    return _db_stats(db_path, db_fingerprint(db_path))
+
+
+# cached, so frequent health checks from multiple clients/processes don't keep hitting the database
+@lru_cache(1)
+def _db_stats(db_path: Path, fingerprint: Fingerprint) -> Json:
     engine, binder, table = get_stuff(db_path)
     query = select(func.count()).select_from(table)
     with engine.connect() as conn:
@@ -155,7 +399,15 @@ class VisitsResponse:
     visits: Any
 
 
-def search_common(url: str, where: Where) -> VisitsResponse:
+async def search_common(url: str, where: Where, *, key: Hashable) -> VisitsResponse:
+    '''
+    key: identifies the query for coalescing (see SingleFlight), should be unique per endpoint and url
+    '''
+    pool = get_db_pool()
+    return await _single_flight.do(key, lambda: pool.run(lambda: _search_common(url=url, where=where)))
+
+
+def _search_common(url: str, where: Where) -> VisitsResponse:
     logger = get_logger()
     config = EnvConfig.get()
 
@@ -206,10 +458,15 @@ def search_common(url: str, where: Where) -> VisitsResponse:
 # perhasp should switch to get for most endpoint
 @app.get ('/status', response_model=Json)
 @app.post('/status', response_model=Json)
-def status() -> Json:
+async def status() -> Json:
     '''
     Ideally, status will always respond, regardless the internal state of the backend?
     '''
+    # NOTE: deliberately not using the DB pool here, so it's not stuck behind the heavy queries
+    return await run_in_threadpool(_status)
+
+
+def _status() -> Json:
     logger = get_logger()
 
     db = get_db_path(check=False)
@@ -237,9 +494,86 @@ def status() -> Json:
         'version': version,
         'db'     : db_path,
         'stats'  : stats,
+        'pid'         : os.getpid(),
+        'singleflight': _single_flight.stats(),
+        'db_pool'     : get_db_pool().stats(),
+        'canonify_cache': canonify_cache_stats(),
+        'workers'     : workers_status(),
+    }
+
+
+def worker_stats() -> Json:
+    return {
+        'pid'         : os.getpid(),
+        'updated'     : time.time(),
+        'singleflight': _single_flight.stats(),
+        'db_pool'     : get_db_pool().stats(),
     }
 
 
+def report_worker() -> None:
+    '''
+    In multiprocess mode, every worker keeps its stats in the shared state directory,
+    so /status can report the health of all the workers regardless of which one is handling the request.
+    '''
+    state_dir = EnvConfig.get().state_dir
+    assert state_dir is not None
+    target = state_dir / f'{os.getpid()}.json'
+    tmp = target.with_suffix('.tmp')
+    tmp.write_text(json.dumps(worker_stats()))
+    tmp.replace(target) # atomic, so other workers never see partially written file
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # exists, just owned by someone else
+    return True
+
+
+# workers refresh their reports periodically, so the reports older than that are from the workers which are gone/stuck
+# (e.g. killed without a chance to clean up, and the pid might be reused by an unrelated process since)
+_WORKER_REPORT_INTERVAL = timedelta(seconds=10)
+_WORKER_TTL = timedelta(minutes=1)
+
+
+async def report_worker_periodically() -> None:
+    while True:
+        await asyncio.sleep(_WORKER_REPORT_INTERVAL.total_seconds())
+        try:
+            report_worker()
+        except Exception as e:
+            get_logger().exception(e)
+
+
+def workers_status() -> List[Json]:
+    state_dir = EnvConfig.get().state_dir
+    if state_dir is None: # single process
+        return [worker_stats()]
+
+    report_worker()
+    now = time.time()
+    res = []
+    for f in sorted(state_dir.glob('*.json')):
+        try:
+            st = json.loads(f.read_text())
+        except Exception as e:
+            # might be removed while we're reading it
+            get_logger().exception(e)
+            continue
+        if not _is_alive(st['pid']) or now - st['updated'] > _WORKER_TTL.total_seconds():
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
+            continue
+        res.append(st)
+    return res
+
+
 from dataclasses import dataclass
 @dataclass
 class VisitsRequest:
@@ -247,11 +581,12 @@ class VisitsRequest:
 
 @app.get ('/visits', response_model=VisitsResponse)
 @app.post('/visits', response_model=VisitsResponse)
-def visits(request: VisitsRequest) -> VisitsResponse:
+async def visits(request: VisitsRequest) -> VisitsResponse:
     url = request.url
     get_logger().info('/visited %s', url)
-    return search_common(
+    return await search_common(
         url=url,
+        key=('visits', url),
         # odd, doesn't work just with: x or (y and z)
         where=lambda table, url: or_(
             table.c.norm_url == url,  # exact match
@@ -266,11 +601,12 @@ class SearchRequest:
 
 @app.get ('/search', response_model=VisitsResponse)
 @app.post('/search', response_model=VisitsResponse)
-def search(request: SearchRequest) -> VisitsResponse:
+async def search(request: SearchRequest) -> VisitsResponse:
     url = request.url
     get_logger().info('/search %s', url)
-    return search_common(
+    return await search_common(
         url=url,
+        key=('search', url),
         where=lambda table, url: or_(
             # todo hmm. think about it, not sure if I need proper indexer for fuzzy search etc?
             table.c.norm_url     .contains(url, autoescape=True),
@@ -287,7 +623,7 @@ class SearchAroundRequest:
 
 @app.get ('/search_around', response_model=VisitsResponse)
 @app.post('/search_around', response_model=VisitsResponse)
-def search_around(request: SearchAroundRequest) -> VisitsResponse:
+async def search_around(request: SearchAroundRequest) -> VisitsResponse:
     timestamp = request.timestamp
     get_logger().info('/search_around %s', timestamp)
     utc_timestamp = timestamp # old 'timestamp' name is legacy
@@ -297,8 +633,9 @@ def search_around(request: SearchAroundRequest) -> VisitsResponse:
     delta_front = timedelta(minutes=2).total_seconds()
     # TODO not sure about delta_front.. but it also serves as quick hack to accommodate for all the truncations etc
 
-    return search_common(
+    return await search_common(
         url='http://dummy.org', # NOTE: not used in the where query (below).. perhaps need to get rid of this
+        key=('search_around', utc_timestamp),
         where=lambda table, url: between(
             func.strftime(
                 '%s', # NOTE: it's tz aware, e.g. would distinguish +05:00 vs -03:00
@@ -344,7 +681,7 @@ VisitedResponse = List[Optional[Json]]
 
 @app.get ('/visited', response_model=VisitedResponse)
 @app.post('/visited', response_model=VisitedResponse)
-def visited(request: VisitedRequest) -> VisitedResponse:
+async def visited(request: VisitedRequest) -> VisitedResponse:
     # TODO instead switch logging to fastapi
     urls = request.urls
     client_version = request.client_version
@@ -354,31 +691,63 @@ def visited(request: VisitedRequest) -> VisitedResponse:
 
     version = as_version(client_version)
 
-    nurls = [canonify(u) for u in urls]
-    snurls = list(sorted(set(nurls)))
+    # client_version doesn't affect the query, so not part of the key
+    pool = get_db_pool()
+    return await _single_flight.do(('visited', tuple(urls)), lambda: pool.run(lambda: _visited(urls)))
 
-    if len(snurls) == 0:
+
+# statement text stays the same regardless of the number of urls, so sqlite can reuse the prepared statement
+# also json_each avoids hitting the bound variables limit
+# still, really huge inputs are split in batches to keep the json argument/intermediate results reasonable
+_VISITED_BATCH = 5000
+
+
+def _visited(urls: List[str]) -> VisitedResponse:
+    if len(urls) == 0:
         return []
 
+    # NOTE: urls which fail to canonify are reported as not visited
+    nurls = [None if isinstance(nu, Exception) else nu for nu in canonify_many(urls)]
+    present = lookup_visited(nu for nu in nurls if nu is not None)
+    results = []
+    for nu in nurls:
+        r = None if nu is None else present.get(nu, None)
+        results.append(None if r is None else as_json(r))
+
+    # no need for it anymore, extension has been updated since
+    # just keeping as an example
+    # if version <= (0, 11, 14):
+    #     # older extension versions expected boolean result here
+    #     results = [r is not None for r in results] # type: ignore[misc]
+
+    return results
+
+
+def lookup_visited(nurls: Iterable[Url]) -> Dict[Url, DbVisit]:
+    '''
+    For each of the (normalised) urls present in the database, returns a representative visit (preferring ones with context)
+    '''
+    snurls = list(sorted(set(nurls)))
+    if len(snurls) == 0:
+        return {}
+
     engine, binder, table = get_stuff()
 
     # sqlalchemy doesn't seem to support SELECT FROM (VALUES (...)) in its api
     # also doesn't support array binding...
     # https://stackoverflow.com/questions/13190392/how-can-i-bind-a-list-to-a-parameter-in-a-custom-query-in-sqlalchemy
-    bstring = ','.join(f'(:b{i})'   for i, _ in enumerate(snurls))
-    bdict = {            f'b{i}': v for i, v in enumerate(snurls)}
+    # so passing the urls as a json array instead
     # TODO hopefully, visits.* thing only returns one visit??
-    query = text(f"""
-WITH cte(queried) AS (SELECT * FROM (values {bstring}))
+    query = text("""
 SELECT queried, visits.*
-    FROM cte JOIN visits
+    FROM (SELECT value AS queried FROM json_each(:urls)) JOIN visits
     ON queried = visits.norm_url
 /*  order stuff without contexts last
     this actually doesn't make sense, locially it should be ASC??
     but somehow DESC is the one that actually works..
 */
     ORDER BY visits.context IS NULL DESC
-    """).bindparams(**bdict).columns(
+    """).columns(
         Column('match', types.Unicode),
         *table.columns,
     )
@@ -386,32 +755,242 @@ SELECT queried, visits.*
     # SELECT visits.* FROM visits GROUP BY visits.norm_url ORDER BY visits.context IS NULL DESC
     # + unique index in norm_url
     # brings down large queries to 50ms...
+    present: Dict[Url, DbVisit] = {}
     with engine.connect() as conn:
-        res = list(conn.execute(query))
-        present: Dict[str, Any] = {row[0]: binder.from_row(row[1:]) for row in res}
-    results = []
-    for nu in nurls:
-        r = present.get(nu, None)
-        results.append(None if r is None else as_json(r))
+        # NOTE: batches don't overlap, so the ordering within each url is still respected
+        for batch in chunked(snurls, _VISITED_BATCH):
+            for row in conn.execute(query, {'urls': json.dumps(batch)}):
+                present[row[0]] = binder.from_row(row[1:])
+    return present
 
-    # no need for it anymore, extension has been updated since
-    # just keeping as an example
-    # if version <= (0, 11, 14):
-    #     # older extension versions expected boolean result here
-    #     results = [r is not None for r in results] # type: ignore[misc]
 
-    return results
+# max number of urls returned by /changes at once, so the initial sync against a large database isn't a single huge response
+_CHANGES_LIMIT = 5000
+
+
+@app.get ('/changes', response_model=Json)
+@app.post('/changes', response_model=Json)
+async def changes(since: int=0, cursor: Optional[str]=None, limit: int=_CHANGES_LIMIT) -> Json:
+    '''
+    Delta sync for the clients keeping a local copy of the visited urls (i.e. same data as /visited returns).
+
+    Returns urls added/changed ('added', with same summaries as /visited) and removed since the database version 'since'.
+    If 'reset' is true, the client should drop its copy first (e.g. if the database was recreated from scratch), and use 'since=0' from then on.
+    The changes are returned in pages of at most 'limit' urls: while 'more' is true, the client should request again with the same 'since' and the returned 'cursor'.
+    After the last page, the client is meant to keep the returned 'version' and pass it as 'since' next time.
+    '''
+    get_logger().info('/changes %s %s %s', since, cursor, limit)
+    limit = max(1, min(limit, _CHANGES_LIMIT))
+    pool = get_db_pool()
+    return await _single_flight.do(('changes', since, cursor, limit), lambda: pool.run(lambda: _changes(since, cursor=cursor, limit=limit)))
+
+
+def _parse_cursor(cursor: Optional[str]) -> Tuple[int, str]:
+    if cursor is None:
+        return (-1, '')
+    try:
+        v, _, url = cursor.partition(':')
+        return (int(v), url)
+    except ValueError:
+        raise fastapi.HTTPException(status_code=400, detail=f'Malformed cursor: {cursor}')
+
+
+def _changes(since: int, *, cursor: Optional[str], limit: int) -> Json:
+    after_version, after_url = _parse_cursor(cursor)
+    engine, binder, table = get_stuff()
+    with engine.connect() as conn:
+        version = get_db_version(conn)
+        if version is None:
+            raise fastapi.HTTPException(status_code=404, detail="Database doesn't track versions, please rerun the indexer")
+        reset = since < 0 or since > version
+        if reset:
+            since = 0
+        rows = list(conn.execute(text('''
+        SELECT version, norm_url, present FROM url_versions
+        WHERE version > :since AND (version, norm_url) > (:after_version, :after_url)
+        ORDER BY version, norm_url
+        LIMIT :limit
+        '''), {'since': since, 'after_version': after_version, 'after_url': after_url, 'limit': limit + 1}))
+    more = len(rows) > limit
+    rows = rows[:limit]
+    added   = [u for _, u, present in rows if present]
+    removed = [u for _, u, present in rows if not present]
+    # NOTE: database might be updated in between (including between the pages), but that's fine:
+    # urls changed since are bumped to a newer version, so they end up after the cursor and the client gets them again
+    present = lookup_visited(added)
+    res = {
+        'version': version,
+        'reset'  : reset,
+        'added'  : [as_json(present[u]) for u in added if u in present],
+        'removed': removed,
+        'more'   : more,
+    }
+    if more:
+        last_version, last_url, _ = rows[-1]
+        res['cursor'] = f'{last_version}:{last_url}'
+    return res
+
+
+class VisitedFilter(NamedTuple):
+    version: int
+    etag: str
+    data: bytes
+
+
+@app.get('/visited_filter')
+async def visited_filter(request: fastapi.Request) -> fastapi.Response:
+    '''
+    Bloom filter of the visited (normalised) urls, generated by the indexer (see bloom.py for the format).
+    Supports ETag revalidation (If-None-Match), so checking for updates is cheap.
+    '''
+    get_logger().info('/visited_filter')
+    db_path = get_db_path()
+    pool = get_db_pool()
+    vf = await pool.run(lambda: _visited_filter(db_path, db_fingerprint(db_path)))
+    headers = {
+        'ETag': vf.etag,
+        'Cache-Control': 'no-cache',  # i.e. always revalidate
+        'X-Promnesia-Db-Version': str(vf.version),
+    }
+    if etag_matches(request, vf.etag):
+        return fastapi.Response(status_code=304, headers=headers)
+    return fastapi.Response(content=vf.data, media_type='application/octet-stream', headers=headers)
+
+
+@lru_cache(1)
+def _visited_filter(db_path: Path, fingerprint: Fingerprint) -> VisitedFilter:
+    engine, binder, table = get_stuff(db_path)
+    with engine.connect() as conn:
+        try:
+            row = conn.execute(text('SELECT version, digest, data FROM visited_filter')).fetchone()
+        except exc.OperationalError as e:
+            if 'no such table' not in str(e):
+                raise e
+            row = None
+    if row is None:
+        raise fastapi.HTTPException(status_code=404, detail="Database doesn't have visited filter, please rerun the indexer")
+    version, digest, data = row
+    return VisitedFilter(version=version, etag=f'"{digest}"', data=data)
+
+
+def etag_matches(request: fastapi.Request, etag: str) -> bool:
+    matching = [t.strip() for t in request.headers.get('if-none-match', '').split(',')]
+    # weak comparison is fine here
+    strip = lambda t: t[2:] if t.startswith('W/') else t
+    return strip(etag) in {strip(t) for t in matching} or '*' in matching
+
+
+# responses for these only depend on the request and the database
+# (unlike e.g. /status), so can be revalidated without running the query again
+_CONDITIONAL_ENDPOINTS = {'/visits', '/search', '/search_around', '/visited'}
+
+# not worth compressing small responses
+_COMPRESS_MIN_SIZE = 1024
+
+
+@lru_cache(1)
+def _etag_salt() -> str:
+    # the response format might change between versions, and the response depends on the server config (e.g. timezone)
+    version: str
+    try:
+        version = get_version()
+    except Exception as e:
+        # e.g. running from the repository without installing
+        version = 'unknown'
+    return repr((version, EnvConfig.get().as_str()))
+
+
+def request_etag(request: fastapi.Request, body: bytes) -> str:
+    db_path = get_db_path(check=False)
+    h = sha256(_etag_salt().encode('utf8'))
+    for x in (
+            repr(db_fingerprint(db_path)),
+            request.url.path,
+            request.url.query,
+    ):
+        h.update(x.encode('utf8'))
+        h.update(b'\0')
+    h.update(body)
+    # weak, since it's shared between differently encoded representations
+    return f'W/"{h.hexdigest()[:32]}"'
+
+
+def accepted_encodings(request: fastapi.Request) -> List[str]:
+    res = []
+    for x in request.headers.get('accept-encoding', '').split(','):
+        enc, _, params = x.partition(';')
+        if params.replace(' ', '') in {'q=0', 'q=0.0', 'q=0.00', 'q=0.000'}:
+            continue
+        res.append(enc.strip().lower())
+    return res
+
+
+def compress(content: bytes, *, encodings: List[str]) -> Tuple[Optional[str], bytes]:
+    if len(content) < _COMPRESS_MIN_SIZE:
+        return None, content
+    if brotli is not None and 'br' in encodings:
+        # default quality (11) is way too slow for on the fly compression
+        return 'br', brotli.compress(content, quality=5)
+    if 'gzip' in encodings:
+        return 'gzip', gzip.compress(content, compresslevel=6)
+    return None, content
+
+
+@app.middleware('http')
+async def conditional_and_compressed(request: fastapi.Request, call_next: Callable[[fastapi.Request], Awaitable[Response]]) -> Response:
+    '''
+    Query responses can be pretty big and repetitive, which matters when the server is accessed over a slow network.
+    So they are compressed, and clients can revalidate them (If-None-Match) to avoid downloading them again.
+    '''
+    if request.url.path not in _CONDITIONAL_ENDPOINTS:
+        return await call_next(request)
+
+    body = await request.body()
+    etag = request_etag(request, body)
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+    # NOTE: strictly speaking, should be 412 for POST requests
+    # but the extension uses POST for everything, and 304 is what it's interested in
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    response = await call_next(request)
+    if response.status_code != 200:
+        return response
+
+    content = b''.join([chunk async for chunk in response.body_iterator])  # type: ignore[attr-defined]
+    encodings = accepted_encodings(request)
+    if len(content) < _COMPRESS_MIN_SIZE:
+        encoding: Optional[str] = None
+    else:
+        # compressing big responses takes a while, so shouldn't block the event loop
+        encoding, content = await run_in_threadpool(compress, content, encodings=encodings)
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    rheaders = {k: v for k, v in response.headers.items() if k != 'content-length'}
+    return Response(
+        content=content,
+        status_code=response.status_code,
+        headers={**rheaders, **headers},
+    )
 
 
 def _run(*, host: str, port: str, quiet: bool, config: ServerConfig) -> None:
     logger = get_logger()
 
-    logger.info('Running server with %s', config)
+    from tempfile import TemporaryDirectory
+    from contextlib import nullcontext
+    state_dir = TemporaryDirectory(prefix='promnesia-server-') if config.workers > 1 and config.state_dir is None else nullcontext(None)
+    with state_dir as sdir:
+        if sdir is not None:
+            config = config._replace(state_dir=Path(sdir))
+
+        logger.info('Running server with %s', config)
 
-    EnvConfig.set(config)
+        # NOTE: workers are separate processes, so the config is passed to them via the environment variable
+        EnvConfig.set(config)
 
-    import uvicorn
-    uvicorn.run('promnesia.server:app', host=host, port=int(port), log_level='debug')
+        import uvicorn
+        uvicorn.run('promnesia.server:app', host=host, port=int(port), log_level='debug', workers=config.workers)
 
 
 def run(args: argparse.Namespace) -> None:
@@ -422,6 +1001,10 @@ def run(args: argparse.Namespace) -> None:
         config=ServerConfig(
             db=args.db,
             timezone=args.timezone,
+            db_workers=args.db_workers,
+            db_max_queue=args.db_max_queue,
+            workers=args.workers,
+            config=args.config,
         )
     )
 
@@ -462,6 +1045,34 @@ def setup_parser(p: argparse.ArgumentParser) -> None:
         help='Path to the links database (optional, uses user data dir by default)',
     )
 
+    p.add_argument(
+        '--config',
+        type=Path,
+        default=None,
+        help='Promnesia config, only needed if it has custom url normalisation rules (CANONIFY_SPECS/CANONIFY_DOMAIN_SUBST)',
+    )
+
+    p.add_argument(
+        '--workers',
+        type=int,
+        default=ServerConfig._field_defaults['workers'],
+        help='Number of server processes (e.g. if the server is shared by multiple browsers/users)',
+    )
+
+    p.add_argument(
+        '--db-workers',
+        type=int,
+        default=ServerConfig._field_defaults['db_workers'],
+        help='Number of threads running the database queries',
+    )
+
+    p.add_argument(
+        '--db-max-queue',
+        type=int,
+        default=ServerConfig._field_defaults['db_max_queue'],
+        help='Max number of database queries waiting for a free worker. Requests beyond that are rejected with HTTP 503',
+    )
+
     p.add_argument(
         '--timezone',
         type=pytz.timezone,
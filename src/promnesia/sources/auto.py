@@ -1,5 +1,5 @@
 """
-- discovers files recursively
+- discovers files recursively (skipping hidden files, and optionally respecting .gitignore)
 - guesses the format (orgmode/markdown/json/etc) by the extension/MIME type
 - can index most of plaintext files, including source code!
 - autodetects Obsidian vault and adds `obsidian://` app protocol support [[file:../src/promnesia/sources/obsidian.py][promnesia.sources.obsidian]]
@@ -14,15 +14,17 @@ import itertools
 import json
 import os
 from typing import Optional, Iterable, Union, List, Tuple, NamedTuple, Sequence, Iterator, Iterable, Callable, Any, Dict, Set
-from fnmatch import fnmatch
 from pathlib import Path
 from functools import lru_cache, wraps
 import warnings
 
 import pytz
 
-from ..common import Visit, Url, PathIsh, get_logger, Loc, get_tmpdir, extract_urls, Extraction, Result, Results, mime, traverse, file_mtime, echain, logger
+from ..common import Visit, Url, PathIsh, get_logger, Loc, get_tmpdir, extract_urls, Extraction, Result, Results, mime, file_mtime, get_system_tz, echain, logger, preload_urlextractors
+from ..walk import walk, WalkEntry, WalkStats
+from ..mime_cache import mime_cache, MimeCache
 from ..config import use_cores
+from .. import config
 
 
 from .filetypes import EUrl
@@ -171,11 +173,15 @@ def index(
         ignored: Union[Sequence[str], str]=(),
         follow: bool=True,
         replacer: Replacer=None,
+        use_gitignore: bool=False,
+        hidden: bool=False,
 ) -> Results:
     '''
     path   : a path or list of paths to recursively index
     ignored: a glob or list of globs to exclude from indexing
     follow : whether to follow symlinks or not
+    use_gitignore: whether to skip the files ignored by .gitignore
+    hidden : whether to index hidden files/directories (e.g. '.notes/'), skipped by default
     '''
     # TODO document replacer?
     ignored = (ignored,) if isinstance(ignored, str) else ignored
@@ -200,6 +206,8 @@ def index(
             follow=follow,
             replacer=replacer,
             root=root,
+            use_gitignore=use_gitignore,
+            hidden=hidden,
         )
         yield from _index(apath, opts=opts)
 
@@ -210,20 +218,37 @@ class Options(NamedTuple):
     # TODO I don't like this replacer thing... think about removing it
     replacer: Replacer
     root: Optional[Path]=None
+    use_gitignore: bool=False
+    hidden: bool=False
 
 
-def _index_file_aux(path: Path, opts: Options) -> Union[Exception, List[Result]]:
+def _index_file_aux(item: Tuple[WalkEntry, Optional['Mime']], opts: Options) -> Union[Exception, List[Result]]:
     # just a helper for the concurrent version (the generator isn't picklable)
+    entry, pm = item
     try:
-        return list(_index_file(path, opts=opts))
+        return list(_index_file(entry.path, opts=opts, st=entry.stat, pm=pm))
     except Exception as e:
         # possible due to unavoidable race conditions
         return e
 
 
+def _init_worker(cache_dir: Optional[Path]) -> None:
+    # otherwise each worker would pay for these on the first file
+    preload_urlextractors(cache_dir)
+    import importlib
+    for name in ['shellcmd', 'plaintext', 'org', 'markdown', 'html']:
+        try:
+            importlib.import_module(f'{__package__}.{name}')
+        except ImportError:
+            # will be handled by 'fallback' when the file is indexed
+            pass
+
+
 def _index(path: Path, opts: Options) -> Results:
     logger = get_logger()
 
+    cache_dir = config.get().cache_dir if config.has() else None
+
     cores = use_cores()
     if cores is None: # do not use cores
         # todo use ExitStack instead?
@@ -231,33 +256,49 @@ def _index(path: Path, opts: Options) -> Results:
         mapper = map # dummy pool
     else:
         workers = None if cores == 0 else cores
-        pool = Pool(workers) # type: ignore
+        # workers might not have the config (e.g. with 'spawn' start method), so need to pass cache_dir
+        pool = Pool(workers, initializer=_init_worker, initargs=(cache_dir,)) # type: ignore
         mapper = pool.map # type: ignore
 
+    # NOTE: mime types are detected (and cached) here rather than in the workers, so only the main process uses the cache
+    mcache_ctx = nullcontext() if cache_dir is None else mime_cache(cache_dir)
+
     # iterate over resolved paths, to avoid duplicates
-    def rit() -> Iterable[Path]:
-        it = traverse(path, follow=opts.follow, ignore=IGNORE)
-        for p in it:
-            if any(fnmatch(str(p), o) for o in opts.ignored):
-                # TODO not sure if should log here... might end up with quite a bit of logs
-                logger.debug('ignoring %s: user ignore rules', p)
-                continue
-            if any(i in p.parts for i in IGNORE): # meh, not very efficient.. pass to traverse??
-                logger.debug('ignoring %s: default ignore rules', p)
-                continue
-
-            p = p.resolve()
-            if not os.path.exists(p):
-                logger.debug('ignoring %s: broken symlink?', p)
-                continue
-
-            yield p
+    stats = WalkStats()
+    def rit() -> Iterable[WalkEntry]:
+        # walk prunes IGNORE names below the root, so only need to check the root itself
+        if any(i in path.parts for i in IGNORE):
+            logger.debug('ignoring %s: default ignore rules', path)
+            return
+        # NOTE: walk only emits existing files, and the stat comes along, so no need to check/stat them again
+        # user ignore globs are checked during the walk too, so ignored directories aren't even listed
+        for e in walk(path, follow=opts.follow, ignore=IGNORE, ignore_paths=opts.ignored, gitignore=opts.use_gitignore, hidden=opts.hidden, stats=stats):
+            if e.symlinked:
+                p = e.path.resolve()
+                if any(i in p.parts for i in IGNORE):
+                    logger.debug('ignoring %s: default ignore rules', p)
+                    continue
+                e = e._replace(path=p)
+
+            yield e
+        logger.info('%s: %d files in %d directories, pruned by ignore rules: %d files, %d directories', path, stats.files, stats.dirs, stats.pruned_files, stats.pruned_dirs)
+
+    def with_mime(it: Iterable[WalkEntry], mcache: Optional[MimeCache]) -> Iterator[Tuple[WalkEntry, Optional[Mime]]]:
+        for e in it:
+            pm = None
+            if mcache is not None and _needs_mime(e.path):
+                try:
+                    pm = mcache.mime(e.path, e.stat)
+                except Exception as ex:
+                    # shouldn't stop indexing the rest of the files, the worker will retry (and report the error)
+                    logger.debug('error while detecting mime type of %s: %s', e.path, ex)
+            yield e, pm
 
     from more_itertools import unique_everseen
-    it = unique_everseen(rit())
+    it = unique_everseen(rit(), key=lambda e: e.path)
 
-    with pool:
-        for r in mapper(_index_file_aux, it, itertools.repeat(opts)):
+    with pool, mcache_ctx as mcache:
+        for r in mapper(_index_file_aux, with_mime(it, mcache), itertools.repeat(opts)):
             if isinstance(r, Exception):
                 yield r
             else:
@@ -266,21 +307,30 @@ def _index(path: Path, opts: Options) -> Results:
 
 Mime = str
 from .filetypes import Ex # meh
-def by_path(pp: Path) -> Tuple[Optional[Ex], Optional[Mime]]:
+def _needs_mime(pp: Path) -> bool:
+    suf = pp.suffix.lower()
+    return suf != '.xz' and type2idx(suf) is None
+
+
+def by_path(pp: Path, *, pm: Optional[Mime]=None) -> Tuple[Optional[Ex], Optional[Mime]]:
+    '''
+    pm: mime type, if already known
+    '''
     suf = pp.suffix.lower()
     # firt check suffixes, it's faster
     s = type2idx(suf)
     if s is not None:
         return s, None
     # then try with mime
-    pm = mime(pp)
+    if pm is None:
+        pm = mime(pp)
     if pm is not None:
         return type2idx(pm), pm
     else:
         return None, None
 
 
-def _index_file(pp: Path, opts: Options) -> Results:
+def _index_file(pp: Path, opts: Options, st: Optional[os.stat_result]=None, pm: Optional[Mime]=None) -> Results:
     logger = get_logger()
     # TODO use kompress?
     # TODO not even sure if it's used...
@@ -305,7 +355,7 @@ def _index_file(pp: Path, opts: Options) -> Results:
 
     ex = RuntimeError(f'While indexing {pp}')
 
-    ip, pm = by_path(pp)
+    ip, pm = by_path(pp, pm=pm)
     if ip is None:
         # TODO use warning (with mime/ext as key?)
         # TODO only log once? # hmm..
@@ -325,7 +375,7 @@ def _index_file(pp: Path, opts: Options) -> Results:
             yield e
 
     root = opts.root
-    fallback_dt = file_mtime(pp)
+    fallback_dt = file_mtime(pp) if st is None else datetime.fromtimestamp(st.st_mtime, tz=get_system_tz())
     fallback_loc = Loc.file(pp)
     replacer = opts.replacer
     for r in indexer():
@@ -0,0 +1,338 @@
+'''
+In-process file discovery for the indexers (see common.traverse), based on os.scandir.
+
+- directories are scanned ahead of time by a thread pool (os.scandir releases the GIL), but the files are still emitted in a deterministic order:
+  depth first, entries sorted by name
+- there are no subprocesses and no output parsing, so any valid filename works (including the ones with newlines)
+- ignore rules are checked while scanning, so the ignored directories aren't even listed
+- same as fd, hidden files/directories (starting with '.') are skipped unless hidden=True
+- .gitignore files can be respected (opt-in, see GitIgnore for the supported syntax)
+- each file comes with its stat data, so the later stages don't need to stat it again
+'''
+from concurrent.futures import Future, ThreadPoolExecutor
+from fnmatch import translate
+import os
+from pathlib import Path
+import re
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from .common import logger
+
+
+class WalkEntry(NamedTuple):
+    path: Path
+    stat: os.stat_result
+    # whether the path goes through a symlink (so it might need resolving)
+    symlinked: bool
+
+
+class GitIgnore:
+    '''
+    Supports comments, negation (!), directory only patterns (trailing /), anchored patterns (containing /),
+    wildcards (*, ?, [...]) and **.
+    Rules from the deeper .gitignore files take precedence, and within a file the last matching rule wins, same as git.
+    '''
+    def __init__(self, lines: Iterable[str]) -> None:
+        # regex, negated, directory only
+        self.rules: List[Tuple['re.Pattern[str]', bool, bool]] = []
+        for line in lines:
+            rule = _parse_gitignore_line(line)
+            if rule is not None:
+                self.rules.append(rule)
+
+    def match(self, rel: str, *, is_dir: bool) -> Optional[bool]:
+        '''
+        rel: '/' separated path relative to the .gitignore directory
+        Returns True if ignored, False if explicitly unignored and None if no rules matched
+        '''
+        for rx, negated, dir_only in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if rx.fullmatch(rel) is not None:
+                return not negated
+        return None
+
+
+def _parse_gitignore_line(line: str) -> Optional[Tuple['re.Pattern[str]', bool, bool]]:
+    line = line.rstrip('\r\n')
+    if line.endswith('\\ '):
+        line = line[:-2] + ' '
+    else:
+        line = line.rstrip(' ')
+    if line == '' or line.startswith('#'):
+        return None
+    negated = line.startswith('!')
+    if negated:
+        line = line[1:]
+    elif line.startswith(('\\!', '\\#')):
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if line == '':
+        return None
+    # pattern with a slash in the beginning or the middle is relative to the .gitignore directory
+    anchored = '/' in line
+    if line.startswith('/'):
+        line = line[1:]
+    body = _gitignore_translate(line)
+    return re.compile(body if anchored else '(?:.*/)?' + body), negated, dir_only
+
+
+def _gitignore_translate(pat: str) -> str:
+    res: List[str] = []
+    i = 0
+    n = len(pat)
+    while i < n:
+        c = pat[i]
+        if pat.startswith('**/', i) and (i == 0 or pat[i - 1] == '/'):
+            res.append('(?:.*/)?')
+            i += 3
+        elif pat.startswith('/**', i) and i + 3 == n:
+            res.append('/.*')
+            i += 3
+        elif c == '*':
+            while i < n and pat[i] == '*':
+                i += 1
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+            i += 1
+        elif c == '[':
+            j = pat.find(']', i + 2)
+            if j == -1:
+                res.append(re.escape(c))
+                i += 1
+            else:
+                stuff = pat[i + 1: j]
+                if stuff.startswith('!'):
+                    stuff = '^' + stuff[1:]
+                elif stuff.startswith('^'):
+                    stuff = '\\' + stuff
+                res.append('[' + stuff.replace('\\', '\\\\') + ']')
+                i = j + 1
+        elif c == '\\' and i + 1 < n:
+            res.append(re.escape(pat[i + 1]))
+            i += 2
+        else:
+            res.append(re.escape(c))
+            i += 1
+    return ''.join(res)
+
+
+def _compile_globs(globs: Sequence[str]) -> Optional['re.Pattern[str]']:
+    if len(globs) == 0:
+        return None
+    return re.compile('|'.join(translate(g) for g in globs))
+
+
+class IgnoreRules:
+    '''
+    names: file/directory names (or globs) ignored anywhere in the tree, e.g. '.git' or '*.pyc'
+    paths: globs matched against the whole path, same as fnmatch (so '*' matches '/' as well)
+
+    All globs are compiled into a few regexes, so the cost doesn't depend much on the number of rules.
+    '''
+    def __init__(self, names: Sequence[str]=(), paths: Sequence[str]=()) -> None:
+        self.literal = frozenset(n for n in names if not any(c in n for c in '*?['))
+        self.names = _compile_globs([n for n in names if n not in self.literal])
+        paths = [os.path.normcase(p) for p in paths]
+        self.files = _compile_globs(paths)
+        # if a glob ending with '*' matches 'dir/', it matches everything within the directory as well
+        # so the whole directory can be pruned
+        self.dirs = _compile_globs([p for p in paths if p.endswith('*')])
+
+    def name(self, name: str) -> bool:
+        return name in self.literal or (self.names is not None and self.names.match(name) is not None)
+
+    def file(self, path: str) -> bool:
+        return self.files is not None and self.files.match(os.path.normcase(path)) is not None
+
+    def dir(self, path: str) -> bool:
+        return self.dirs is not None and self.dirs.match(os.path.normcase(path) + os.sep) is not None
+
+
+class WalkStats:
+    def __init__(self) -> None:
+        self.dirs = 0
+        self.files = 0
+        # ignored entries, for directories their contents aren't counted since they are never listed
+        self.pruned_dirs = 0
+        self.pruned_files = 0
+
+    def __repr__(self) -> str:
+        return f'WalkStats(dirs={self.dirs}, files={self.files}, pruned_dirs={self.pruned_dirs}, pruned_files={self.pruned_files})'
+
+
+class _Entry(NamedTuple):
+    name: str
+    path: str
+    is_dir: bool
+    # for directories, only set when following symlinks (used to detect loops)
+    stat: Optional[os.stat_result]
+    is_symlink: bool
+
+
+class _Listing(NamedTuple):
+    entries: List[_Entry]
+    gitignore: Optional[GitIgnore]
+    pruned_dirs: int
+    pruned_files: int
+
+
+def _scan(path: str, *, follow: bool, rules: IgnoreRules, gitignore: bool, hidden: bool) -> _Listing:
+    entries: List[_Entry] = []
+    gi: Optional[GitIgnore] = None
+    pruned_dirs = 0
+    pruned_files = 0
+    try:
+        with os.scandir(path) as it:
+            for de in it:
+                name = de.name
+                try:
+                    if gitignore and name == '.gitignore' and de.is_file():
+                        with open(de.path, encoding='utf8', errors='replace') as fo:
+                            gi = GitIgnore(fo)
+                    skip = not hidden and name.startswith('.')
+                    if de.is_dir(follow_symlinks=follow):
+                        if skip or rules.name(name) or rules.dir(de.path):
+                            pruned_dirs += 1
+                            continue
+                        entries.append(_Entry(name, de.path, True, de.stat() if follow else None, de.is_symlink()))
+                    elif de.is_file(follow_symlinks=follow):
+                        if skip or rules.name(name) or rules.file(de.path):
+                            pruned_files += 1
+                            continue
+                        entries.append(_Entry(name, de.path, False, de.stat(follow_symlinks=follow), de.is_symlink()))
+                    # otherwise something like a broken symlink or a socket
+                except OSError as e:
+                    logger.debug('error while scanning %s, skipping: %s', de.path, e)
+    except OSError as e:
+        logger.warning('error while scanning %s, skipping: %s', path, e)
+    entries.sort(key=lambda e: e.name)
+    return _Listing(entries=entries, gitignore=gi, pruned_dirs=pruned_dirs, pruned_files=pruned_files)
+
+
+# scanning is mostly waiting for IO, so makes sense to have more threads than cores
+_THREADS = 8
+
+
+def walk(
+        root: Path,
+        *,
+        follow: bool=True,
+        ignore: Sequence[str]=(),
+        ignore_paths: Sequence[str]=(),
+        gitignore: bool=False,
+        hidden: bool=False,
+        threads: int=_THREADS,
+        stats: Optional[WalkStats]=None,
+) -> Iterator[WalkEntry]:
+    '''
+    follow      : whether to follow symlinks (otherwise symlinks aren't emitted at all)
+    ignore      : file/directory names (or globs) to skip
+    ignore_paths: globs matched against the whole path (see IgnoreRules)
+    gitignore   : whether to respect .gitignore files (off by default, so everything except the ignored files is emitted)
+    hidden      : whether to emit hidden files and descend into hidden directories below the root (same as fd --hidden)
+    threads     : 0 means scanning everything in the current thread
+    stats       : if passed, updated with the number of scanned/pruned entries
+    '''
+    if stats is None:
+        stats = WalkStats()
+    rules = IgnoreRules(names=ignore, paths=ignore_paths)
+    try:
+        root_st = root.stat() if follow else root.lstat()
+    except OSError as err:
+        logger.warning('error while accessing %s, skipping: %s', root, err)
+        return
+    if not os.path.isdir(root) or (not follow and root.is_symlink()):
+        if rules.file(str(root)):
+            stats.pruned_files += 1
+            return
+        stats.files += 1
+        yield WalkEntry(path=root, stat=root_st, symlinked=root.is_symlink())
+        return
+    if rules.dir(str(root)):
+        stats.pruned_dirs += 1
+        return
+
+    def scan(path: str) -> _Listing:
+        return _scan(path, follow=follow, rules=rules, gitignore=gitignore, hidden=hidden)
+
+    pool = ThreadPoolExecutor(threads) if threads > 0 else None
+    # don't scan too far ahead, otherwise the listings would take lots of memory
+    max_pending = threads * 8
+    pending: Set['Future[_Listing]'] = set()
+    visited: Set[Tuple[int, int]] = {(root_st.st_dev, root_st.st_ino)}
+
+    GitIgnores = List[Tuple[str, GitIgnore]]
+    Child = Tuple[_Entry, Optional['Future[_Listing]']]
+    # iterator over the directory children, .gitignores in scope, whether the directory is under a symlink
+    stack: List[Tuple[Iterator[Child], GitIgnores, bool]] = []
+
+    def enter(path: str, fut: Optional['Future[_Listing]'], gis: GitIgnores, symlinked: bool) -> None:
+        if fut is None:
+            listing = scan(path)
+        else:
+            listing = fut.result()
+            pending.discard(fut)
+        stats.dirs += 1
+        stats.pruned_dirs  += listing.pruned_dirs
+        stats.pruned_files += listing.pruned_files
+        if listing.gitignore is not None:
+            gis = [*gis, (path, listing.gitignore)]
+        children: List[Child] = []
+        for e in listing.entries:
+            if len(gis) > 0 and _gitignored(gis, e):
+                if e.is_dir:
+                    stats.pruned_dirs += 1
+                else:
+                    stats.pruned_files += 1
+                continue
+            f: Optional['Future[_Listing]'] = None
+            if e.is_dir:
+                if follow:
+                    assert e.stat is not None
+                    key = (e.stat.st_dev, e.stat.st_ino)
+                    if key in visited:
+                        # symlink loop, or the same directory via another symlink
+                        logger.debug('already visited %s, skipping', e.path)
+                        continue
+                    visited.add(key)
+                if pool is not None and len(pending) < max_pending:
+                    f = pool.submit(scan, e.path)
+                    pending.add(f)
+            children.append((e, f))
+        stack.append((iter(children), gis, symlinked))
+
+    try:
+        enter(str(root), None, [], False)
+        while len(stack) > 0:
+            it, gis, symlinked = stack[-1]
+            nxt = next(it, None)
+            if nxt is None:
+                stack.pop()
+                continue
+            e, fut = nxt
+            if e.is_dir:
+                enter(e.path, fut, gis, symlinked or e.is_symlink)
+            else:
+                assert e.stat is not None
+                stats.files += 1
+                yield WalkEntry(path=Path(e.path), stat=e.stat, symlinked=symlinked or e.is_symlink)
+    finally:
+        for f in pending:
+            f.cancel()
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+
+def _gitignored(gis: List[Tuple[str, GitIgnore]], e: _Entry) -> bool:
+    # the deepest .gitignore with a matching rule wins
+    for base, gi in reversed(gis):
+        rel = e.path[len(base) + 1:]
+        if os.sep != '/':
+            rel = rel.replace(os.sep, '/')
+        res = gi.match(rel, is_dir=e.is_dir)
+        if res is not None:
+            return res
+    return False
@@ -2,7 +2,7 @@ from typing import cast
 
 import pytest # type: ignore
 
-from promnesia.cannon import canonify, CanonifyException
+from promnesia.cannon import canonify, _canonify, CanonifyException, canonify_cache_stats, canonify_cache_clear, configure, Spec, DomainTrie
 
 # TODO should actually understand 'sequences'?
 # e.g.
@@ -22,6 +22,9 @@ def check(url, expected):
     if expected is TODO:
         pytest.skip(f"'{url}' will be handled later")
     assert canonify(url) == expected
+    # cached result should be the same
+    assert canonify(url) == expected
+    assert _canonify(url) == expected
 
 
 # TODO assume spaces are not meaninfgul??
@@ -323,3 +326,165 @@ def test_empty_query_parameter(url, expected):
 ])
 def test_qkeep_true(url, expected):
     assert canonify(url) == expected
+
+
+def test_cache() -> None:
+    url = 'https://www.youtube.com/watch?t=491s&v=1NHbPN9pNPM&index=63&list=WL'
+    canonify_cache_clear()
+    assert canonify_cache_stats()['hit_rate'] is None
+
+    for _ in range(4):
+        assert canonify(url) == 'youtube.com/watch?v=1NHbPN9pNPM&t=491s&list=WL'
+    stats = canonify_cache_stats()
+    assert stats['size'] == 1
+    assert (stats['hits'], stats['misses']) == (3, 1)
+    assert stats['hit_rate'] == 0.75
+
+    # errors aren't cached, but should still be raised every time
+    for _ in range(2):
+        with pytest.raises(CanonifyException):
+            canonify('https://example.com\uFF03@bing.com')
+
+
+def test_cache_size(monkeypatch) -> None:
+    from promnesia.cannon import _canonify_cache_size
+    try:
+        configure(cache_size=10)
+        assert canonify_cache_stats()['maxsize'] == 10
+        configure(cache_size=-1)
+        assert canonify_cache_stats()['maxsize'] is None
+    finally:
+        configure()
+
+    monkeypatch.setenv('PROMNESIA_CANONIFY_CACHE_SIZE', '123')
+    assert _canonify_cache_size() == 123
+    # config takes priority
+    assert _canonify_cache_size(5) == 5
+    monkeypatch.setenv('PROMNESIA_CANONIFY_CACHE_SIZE', 'lots')
+    with pytest.warns(UserWarning, match='PROMNESIA_CANONIFY_CACHE_SIZE'):
+        assert _canonify_cache_size() == 50_000
+
+
+def test_domain_trie() -> None:
+    t: DomainTrie[Spec] = DomainTrie()
+    t.add('wikipedia.org', Spec(fkeep=True))
+    t.add('google.com', Spec(qkeep={'q'}))
+    t.add('play.google.com', Spec(qkeep={'id'}))
+    assert t.get('en.wikipedia.org') == Spec(fkeep=True)
+    assert t.get('wikipedia.org') == Spec(fkeep=True)
+    assert t.get('xwikipedia.org') is None
+    assert t.get('org') is None
+    # shortest suffix wins
+    assert t.get('play.google.com') == Spec(qkeep={'q'})
+
+
+def test_configure() -> None:
+    url = 'https://mobile.mysite.org/post?article=123&utm_source=whatever'
+    assert canonify(url) == 'mobile.mysite.org/post'
+    try:
+        configure(
+            user_specs={
+                'mysite.org': Spec(qkeep=['article']),
+                # overrides the builtin one
+                'youtube.com': Spec(qkeep=['v']),
+            },
+            user_dom_subst=[
+                ('mobile.mysite.', 'mysite.'),
+                # takes priority over the builtin 'm.youtube.'
+                ('m.youtube.com', 'youtube.net'),
+                # no dot, so it's a partial label
+                ('altmy', 'my'),
+            ],
+        )
+        assert canonify(url) == 'mysite.org/post?article=123'
+        assert canonify('https://altmysite.org/post?article=1') == 'mysite.org/post?article=1'
+        assert canonify('https://www.youtube.com/watch?v=123&list=5') == 'youtube.com/watch?v=123'
+        assert canonify('https://m.youtube.com/watch?v=123&list=5') == 'youtube.net/watch'
+        # builtin rules still work
+        assert canonify('https://mobile.twitter.com/foo') == 'twitter.com/foo'
+    finally:
+        configure()
+    assert canonify(url) == 'mobile.mysite.org/post'
+    assert canonify('https://www.youtube.com/watch?v=123&list=5') == 'youtube.com/watch?v=123&list=5'
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_canonify_many(workers, monkeypatch) -> None:
+    import promnesia.cannon as C
+    # otherwise pool is only used for large inputs
+    monkeypatch.setattr(C, '_POOL_THRESHOLD', 1)
+
+    bad = 'https://example.com＃@bing.com'
+    urls = [
+        'https://www.youtube.com/watch?v=1NHbPN9pNPM&feature=share',
+        bad,
+        'https://mobile.mysite.org/post?article=123',
+        'https://youtu.be/1NHbPN9pNPM',
+        'https://www.youtube.com/watch?v=1NHbPN9pNPM&feature=share',
+    ]
+    try:
+        configure(user_dom_subst=[('mobile.mysite.', 'mysite.')])
+        res = C.canonify_many(urls, workers=workers)
+    finally:
+        configure()
+    assert len(res) == len(urls)
+    assert res[0] == 'youtube.com/watch?v=1NHbPN9pNPM'
+    assert isinstance(res[1], CanonifyException)
+    # user rules should be respected in the workers as well
+    assert res[2] == 'mysite.org/post'
+    assert res[3] == 'youtube.com/watch?v=1NHbPN9pNPM'
+    assert res[4] == res[0]
+
+    assert C.canonify_many([]) == []
+
+
+def test_canonify_many_pool(monkeypatch) -> None:
+    import promnesia.cannon as C
+    monkeypatch.setattr(C, '_POOL_THRESHOLD', 1)
+    url = 'https://mobile.mysite.org/post?article=123'
+    try:
+        assert C.canonify_many([url], workers=2) == ['mobile.mysite.org/post']
+        pool = C._pool
+        assert pool is not None
+        # reused between the calls
+        assert C.canonify_many([url, url], workers=2) == ['mobile.mysite.org/post'] * 2
+        assert C._pool is pool
+
+        # workers have the old rules, so the pool should be recreated
+        configure(user_dom_subst=[('mobile.mysite.', 'mysite.')])
+        assert C._pool is None
+        assert C.canonify_many([url], workers=2) == ['mysite.org/post']
+    finally:
+        configure()
+        C.shutdown_pool()
+    assert C._pool is None
+
+
+def test_persistent_cache(tmp_path) -> None:
+    from promnesia.cannon_cache import canonify_cache
+    urls = [
+        'https://www.youtube.com/watch?v=1NHbPN9pNPM&feature=share',
+        'https://mobile.mysite.org/post?article=123',
+        'https://example.com＃@bing.com',
+    ]
+    with canonify_cache(tmp_path) as cc:
+        res = cc.canonify_many(urls)
+        assert cc.stats() == {'hits': 0, 'misses': 3, 'size': 2}
+    assert res[:2] == ['youtube.com/watch?v=1NHbPN9pNPM', 'mobile.mysite.org/post']
+    assert isinstance(res[2], CanonifyException)
+
+    with canonify_cache(tmp_path) as cc:
+        res2 = cc.canonify_many(urls)
+        # errors aren't cached
+        assert cc.stats() == {'hits': 2, 'misses': 1, 'size': 2}
+    assert res2[:2] == res[:2]
+
+    # should be invalidated if rules change
+    try:
+        configure(user_dom_subst=[('mobile.mysite.', 'mysite.')])
+        with canonify_cache(tmp_path) as cc:
+            res3 = cc.canonify_many(urls)
+            assert cc.stats()['hits'] == 0
+        assert res3[1] == 'mysite.org/post'
+    finally:
+        configure()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+'''
+Canonify throughput benchmark over a synthetic, but realistic mix of urls.
+
+Run it locally as:
+
+    python3 tests/cannon_benchmark.py --count 100000
+
+It reports urls/sec (without the canonify cache, and with it on a corpus with repeated urls, like browser history)
+and the time spent in the individual canonify steps.
+'''
+from collections import defaultdict
+from contextlib import contextmanager
+import random
+import time
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import pytest
+
+from promnesia import cannon
+from promnesia.cannon import canonify
+
+
+TRACKERS = [
+    'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content',
+    'fbclid', 'gclid', 'ref', 'ref_src', 'mc_cid', 'mc_eid', 'igshid', '_hsenc',
+]
+
+WORDS = [
+    'python', 'rust', 'emacs', 'org-mode', 'sqlite', 'performance', 'history', 'browser', 'extension', 'notes',
+    'knowledge', 'graph', 'memex', 'search', 'context', 'pkm', 'linux', 'benchmark', 'unicode', 'encoding',
+]
+
+
+def _word(r: random.Random) -> str:
+    return r.choice(WORDS)
+
+
+def _slug(r: random.Random) -> str:
+    return '-'.join(_word(r) for _ in range(r.randint(1, 5)))
+
+
+def _id(r: random.Random, n: int=11) -> str:
+    return ''.join(r.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-') for _ in range(n))
+
+
+def _trackers(r: random.Random) -> List[str]:
+    return [f'{k}={_word(r)}' for k in r.sample(TRACKERS, r.randint(0, 5))]
+
+
+def _with_query(url: str, params: List[str]) -> str:
+    return url if len(params) == 0 else url + '?' + '&'.join(params)
+
+
+def _generic(r: random.Random) -> str:
+    dom = r.choice(['example.com', 'blog.example.org', 'www.lesswrong.com', 'docs.python.org', 'en.wikipedia.org', 'news.bbc.co.uk', 'a.b.example.co.uk'])
+    path = '/'.join(_slug(r) for _ in range(r.randint(0, 4)))
+    params = _trackers(r)
+    if r.random() < 0.3:
+        params.append(f'id={r.randint(1, 10 ** 6)}')
+    url = _with_query(f'{r.choice(["https", "http"])}://{dom}/{path}', params)
+    if r.random() < 0.1:
+        url += '#' + _slug(r)
+    return url
+
+
+def _youtube(r: random.Random) -> str:
+    vid = _id(r)
+    kind = r.randint(0, 3)
+    if kind == 0:
+        return f'https://youtu.be/{vid}'
+    if kind == 1:
+        return f'https://www.youtube.com/embed/{vid}?feature=oembed'
+    dom = r.choice(['www.youtube.com', 'm.youtube.com', 'youtube.com'])
+    params = [f'v={vid}'] + [f'{k}={_word(r)}' for k in r.sample(['t', 'list', 'index', 'feature', 'ab_channel', 'pp', 'si'], r.randint(0, 4))]
+    r.shuffle(params)
+    return _with_query(f'https://{dom}/watch', params + _trackers(r))
+
+
+def _reddit(r: random.Random) -> str:
+    dom = r.choice(['www.reddit.com', 'old.reddit.com', 'np.reddit.com', 'm.reddit.com'])
+    sub = _word(r)
+    url = f'https://{dom}/r/{sub}/comments/{_id(r, 6)}/{_slug(r).replace("-", "_")}/'
+    if r.random() < 0.3:
+        url += f'{_id(r, 7)}/'
+    return _with_query(url, [f'{k}={_word(r)}' for k in r.sample(['context', 'sort', 'utm_name', 'share_id'], r.randint(0, 2))])
+
+
+def _twitter(r: random.Random) -> str:
+    dom = r.choice(['twitter.com', 'mobile.twitter.com', 'm.twitter.com', 'nitter.net'])
+    return _with_query(f'https://{dom}/{_word(r)}/status/{r.randint(10 ** 17, 10 ** 18)}', [f's={r.randint(1, 30)}'] if r.random() < 0.5 else [])
+
+
+def _archive_org(r: random.Random) -> str:
+    return f'https://web.archive.org/web/{r.randint(2005, 2023)}0101000000/' + r.choice([_generic, _reddit, _twitter])(r)
+
+
+def _percent_encoded(r: random.Random) -> str:
+    parts = r.choice([
+        ['%D0%9C%D0%BE%D1%81%D0%BA%D0%B2%D0%B0', 'Москва'],
+        ['caf%C3%A9', 'café'],
+        ['hello%20world', 'hello world', 'hello+world'],
+        ['C%2B%2B', 'C++'],
+        ['%E6%97%A5%E6%9C%AC', '日本'],
+    ])
+    return f'https://en.wikipedia.org/wiki/{r.choice(parts)}_{_word(r)}'
+
+
+def _google(r: random.Random) -> str:
+    kind = r.randint(0, 2)
+    if kind == 0:
+        return f'https://www.google.com/amp/s/{_generic(r).split("://")[1]}'
+    if kind == 1:
+        return _with_query('https://www.google.com/url', [f'q={_generic(r)}', 'sa=D', f'ved={_id(r, 30)}', f'usg={_id(r, 20)}'])
+    return _with_query('https://www.google.com/search', [f'q={_word(r)}+{_word(r)}', 'hl=en', 'client=firefox-b-d'])
+
+
+def _misc(r: random.Random) -> str:
+    return r.choice([
+        lambda: f'https://news.ycombinator.com/item?id={r.randint(1, 4 * 10 ** 7)}',
+        lambda: f'https://news.ycombinator.com/from?site={_word(r)}.com',
+        lambda: f'https://github.com/{_word(r)}/{_slug(r)}/issues/{r.randint(1, 1000)}?q=is%3Aopen&tab=repositories',
+        lambda: f'https://www.facebook.com/permalink.php?story_fbid={r.randint(1, 10 ** 9)}&id={r.randint(1, 10 ** 9)}&__tn__=K-R',
+        lambda: f'https://app.getpocket.com/read/{r.randint(1, 10 ** 9)}',
+        lambda: f'https://stackoverflow.com/questions/{r.randint(1, 10 ** 8)}/{_slug(r)}?noredirect=1&lq=1',
+        # sometimes query has no '?'
+        lambda: f'https://www.example.com/page&{_word(r)}=1',
+    ])()
+
+
+# generator, weight
+MIX: List[Tuple[Callable[[random.Random], str], float]] = [
+    (_generic        , 40),
+    (_youtube        , 15),
+    (_reddit         , 10),
+    (_twitter        ,  8),
+    (_archive_org    ,  3),
+    (_percent_encoded,  6),
+    (_google         ,  8),
+    (_misc           , 10),
+]
+
+
+def generate_urls(count: int, *, seed: int=0) -> List[str]:
+    r = random.Random(seed)
+    gens, weights = zip(*MIX)
+    return [g(r) for g in r.choices(gens, weights=weights, k=count)]
+
+
+def with_repeats(urls: List[str], count: int, *, seed: int=0) -> List[str]:
+    '''
+    Like browser history: few urls are visited over and over again, most only a few times
+    '''
+    r = random.Random(seed)
+    weights = [1 / (i + 1) for i in range(len(urls))]
+    return r.choices(urls, weights=weights, k=count)
+
+
+# canonify steps to break down the time, looked up as module globals by canonify
+STEPS = [
+    '_prenormalise',
+    'urlsplit',
+    'handle_archive_org',
+    'transform_split',
+    'canonify_domain',
+    'parse_qsl',
+    'get_compiled_spec',
+    'urlencode',
+    '_quote_path',
+    'myunsplit',
+]
+
+
+@contextmanager
+def instrumented() -> Iterator[Dict[str, List[float]]]:
+    '''
+    Patches canonify steps to measure time spent in each of them (inclusive, e.g. transform_split includes canonify_domain)
+    '''
+    stats: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0])
+    originals = {name: getattr(cannon, name) for name in STEPS}
+
+    def wrap(name: str, f: Callable) -> Callable:
+        def wrapped(*args: Any, **kwargs: Any) -> Any:
+            before = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                s = stats[name]
+                s[0] += 1
+                s[1] += time.perf_counter() - before
+        return wrapped
+
+    try:
+        for name, f in originals.items():
+            setattr(cannon, name, wrap(name, f))
+        yield stats
+    finally:
+        for name, f in originals.items():
+            setattr(cannon, name, f)
+
+
+def _measure(f: Callable[[str], str], urls: List[str]) -> float:
+    before = time.perf_counter()
+    for u in urls:
+        try:
+            f(u)
+        except cannon.CanonifyException:
+            pass
+    return time.perf_counter() - before
+
+
+def run(count: int, *, seed: int=0) -> Dict[str, Any]:
+    urls = generate_urls(count, seed=seed)
+    uncached = cannon._canonify
+
+    elapsed = _measure(uncached, urls)
+
+    repeated = with_repeats(urls, count, seed=seed)
+    cannon.canonify_cache_clear()
+    elapsed_cached = _measure(canonify, repeated)
+    cache = cannon.canonify_cache_stats()
+
+    with instrumented() as stats:
+        elapsed_instrumented = _measure(uncached, urls)
+
+    return {
+        'count'         : count,
+        'uncached'      : elapsed,
+        'cached'        : elapsed_cached,
+        'cache'         : cache,
+        'instrumented'  : elapsed_instrumented,
+        'steps'         : dict(stats),
+    }
+
+
+def report(res: Dict[str, Any]) -> str:
+    count = res['count']
+    lines = [
+        f"canonify, {count} urls",
+        f"  uncached: {res['uncached']:.2f}s, {count / res['uncached']:.0f} urls/s",
+        f"  cached (repeated urls, hit rate {res['cache']['hit_rate']}): {res['cached']:.2f}s, {count / res['cached']:.0f} urls/s",
+        f"breakdown (inclusive, instrumented run took {res['instrumented']:.2f}s):",
+    ]
+    total = res['instrumented']
+    for name in STEPS:
+        calls, spent = res['steps'].get(name, (0, 0.0))
+        lines.append(f"  {name:<20} {calls:>8} calls {spent:7.2f}s {spent / total * 100:5.1f}%")
+    return '\n'.join(lines)
+
+
+def test_benchmark() -> None:
+    urls = generate_urls(2000)
+    # sanity check: should be deterministic
+    assert urls == generate_urls(2000)
+
+    # instrumenting shouldn't change the results
+    def results() -> List[Any]:
+        res: List[Any] = []
+        for u in urls:
+            try:
+                res.append(cannon._canonify(u))
+            except cannon.CanonifyException:
+                res.append(None)
+        return res
+    expected = results()
+    with instrumented():
+        assert results() == expected
+
+    res = run(2000)
+    print(report(res))
+    assert set(res['steps']) == set(STEPS)
+    assert res['steps']['_prenormalise'][0] >= 2000
+
+
+def _query_heavy_urls(count: int) -> List[str]:
+    tracking = '&'.join(f'{k}=xxx' for k in [
+        'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'fbclid', 'gclid', 'ref', 'feature', 'ab_channel',
+        'src', 'hc_ref', 'notif_id', 'notif_t', '__tn__', 'sa', 'ved', 'usg', 'ust', 'source',
+    ])
+    res = []
+    for i in range(count):
+        res.extend([
+            f'https://www.youtube.com/watch?v=video{i}&list=WL&index=3&t=10s&{tracking}',
+            f'https://m.facebook.com/permalink.php?story_fbid={i}&id=1000&{tracking}',
+            f'https://www.google.com/url?q=https://example.com/page{i}&{tracking}',
+        ])
+    return res
+
+
+@pytest.mark.parametrize('count', [5000])
+def test_benchmark_query_heavy(count: int) -> None:
+    urls = _query_heavy_urls(count)
+    # don't want to measure the cache
+    canonify_ = cannon._canonify
+    before = time.time()
+    res = [canonify_(u) for u in urls]
+    elapsed = time.time() - before
+    print(f'canonify: {len(urls)} query heavy urls, {elapsed:.2f}s, {len(urls) / elapsed:.0f} urls/s')
+
+    assert res[:3] == [
+        'youtube.com/watch?v=video0&t=10s&list=WL',
+        'facebook.com/permalink.php?id=1000&story_fbid=0',
+        'google.com/url',
+    ]
+
+
+def main() -> None:
+    import argparse
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--count', type=int, default=100_000, help='Number of urls')
+    p.add_argument('--seed' , type=int, default=0      , help='Random seed for the url generator')
+    args = p.parse_args()
+    print(report(run(args.count, seed=args.seed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+'''
+Extraction (dedup/filter/canonify) throughput and peak memory over a large synthetic source.
+
+Run it locally as:
+
+    python3 tests/extract_benchmark.py --count 1000000
+
+Every variant runs in a separate process, so peak RSS isn't affected by the previous runs.
+'''
+from datetime import datetime, timedelta
+import random
+import subprocess
+import sys
+import time
+from typing import Any, Dict, Iterator, List
+
+import pytz
+
+from promnesia.common import Loc, Source, Visit
+import promnesia.extract as E
+
+from cannon_benchmark import generate_urls
+
+
+def generate_visits(count: int, *, seed: int=0) -> Iterator[Visit]:
+    '''
+    Like a chat export: each message has a few links, and the visits from the same message share the locator and the context.
+    Like most sources, constructs new locator/context objects for each visit.
+    '''
+    r = random.Random(seed)
+    urls = generate_urls(min(count, 50_000), seed=seed)
+    start = datetime(2020, 1, 1, tzinfo=pytz.utc)
+    emitted = 0
+    msg = 0
+    while emitted < count:
+        msg += 1
+        chat = r.randint(1, 100)
+        links = r.sample(urls, r.randint(1, 4))
+        dt = start + timedelta(minutes=msg)
+        for u in links:
+            yield Visit(
+                url=u,
+                dt=dt,
+                locator=Loc.make(title=f'chat {chat}', href=f'https://chat.example.com/{chat}/{msg}'),
+                context=' '.join(['message', str(msg), 'with', 'links:', *links]),
+            )
+            emitted += 1
+            if emitted == count:
+                break
+
+
+class _NoInterner(E.Interner):
+    def visit(self, v: Visit) -> Visit:
+        return v
+
+
+def run(count: int, *, intern: bool, seed: int=0) -> Dict[str, Any]:
+    orig = E.Interner
+    if not intern:
+        E.Interner = _NoInterner  # type: ignore[misc]
+    try:
+        source = Source(lambda: generate_visits(count, seed=seed), name='benchmark')
+        before = time.perf_counter()
+        n = 0
+        for v in E.extract_visits(source, src='benchmark'):
+            n += 1
+        elapsed = time.perf_counter() - before
+    finally:
+        E.Interner = orig  # type: ignore[misc]
+    import resource  # not available on windows
+    return {
+        'count'  : count,
+        'visits' : n,
+        'elapsed': elapsed,
+        # NOTE: kilobytes on linux
+        'rss_mb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def report(name: str, res: Dict[str, Any]) -> str:
+    return f"{name:<12} {res['visits']} visits: {res['elapsed']:.2f}s, {res['count'] / res['elapsed']:.0f} visits/s, peak RSS {res['rss_mb']:.0f} MiB"
+
+
+def test_benchmark() -> None:
+    count = 5000
+    visits = list(generate_visits(count))
+    assert len(visits) == count
+    # sanity check: should be deterministic
+    assert visits == list(generate_visits(count))
+
+    # interning shouldn't change the results
+    def extracted() -> List[Any]:
+        return list(E.extract_visits(Source(lambda: iter(visits), name='benchmark'), src='benchmark'))
+    with_interning = extracted()
+    orig = E.Interner
+    E.Interner = _NoInterner  # type: ignore[misc]
+    try:
+        assert extracted() == with_interning
+    finally:
+        E.Interner = orig  # type: ignore[misc]
+
+    interner = E.Interner()
+    interned = [interner.visit(v) for v in visits]
+    assert interned == visits
+    assert interner.shared > count // 2
+    [v1, v2] = [v for v in interned if v.locator == interned[0].locator][:2]
+    assert v1.locator is v2.locator
+    assert v1.context is v2.context
+
+    print(report('interned', run(count, intern=True)))
+
+
+def main() -> None:
+    import argparse
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--count', type=int, default=1_000_000, help='Number of visits')
+    p.add_argument('--seed' , type=int, default=0        , help='Random seed for the visits generator')
+    p.add_argument('--variant', choices=['plain', 'interned'], help=argparse.SUPPRESS)
+    args = p.parse_args()
+    if args.variant is not None:
+        print(report(args.variant, run(args.count, intern=args.variant == 'interned', seed=args.seed)))
+        return
+    for variant in ['plain', 'interned']:
+        subprocess.check_call([sys.executable, __file__, '--count', str(args.count), '--seed', str(args.seed), '--variant', variant])
+
+
+if __name__ == '__main__':
+    main()
@@ -236,6 +236,87 @@ FILTERS = [
             extract_from_path(tdata('custom')),
         ))
         assert len(visits) == 4
+        assert E.filter_stats() == {'some-weird-domain.xyz': 1}
+
+
+def test_filter_stats_per_run(tmp_path: Path) -> None:
+    import promnesia.extract as E
+    from config_tests import index
+    cfg = f'''
+OUTPUT_DIR = r'{tmp_path}'
+FILTERS = ['page1.html']
+from promnesia.common import Source
+from promnesia.sources import demo
+SOURCES = [Source(demo.index, count=5)]
+'''
+    try:
+        for _ in range(2):
+            index(cfg)
+            # shouldn't accumulate between the runs
+            assert E.filter_stats() == {'page1.html': 1}
+    finally:
+        E.filters.cache_clear()
+
+
+def test_compiled_filters() -> None:
+    import promnesia.extract as E
+    from promnesia.common import Filter
+    from promnesia.extract import CompiledFilters, DEFAULT_FILTERS, make_filter
+
+    def is_local(u: str) -> bool:
+        return 'localhost' in u
+
+    flt: List[Union[str, Filter]] = [
+        *DEFAULT_FILTERS,
+        r'^https://example\.com/private',
+        r'(?i)TRACKER',  # global flag, can't be combined
+        r'(a)b\1',       # backreference, can't be combined
+        # same group names, so the combined regex falls back onto separate matching
+        r'(?P<x>spam)',
+        r'(?P<x>eggs)',
+        is_local,
+    ]
+    cf = CompiledFilters(flt)
+    assert cf.prefixes == ['^about:', '^blob:', '^view-source:', '^content:']
+    assert cf.anchored is cf.unanchored is E._NEVER
+
+    naive = [make_filter(f) for f in flt]
+    urls = [
+        'about:blank',
+        'chrome-extension://abcd/popup.html',
+        'chrome://newtab',
+        'https://example.com/private/page',
+        'https://example.com/public/page',
+        'https://site.com/?x=tracker',
+        'https://abab.com',
+        'https://spam.com',
+        'https://eggs.com',
+        'http://localhost:8000',
+        'https://reddit.com/r/python',
+        'https://site.com/about:',
+    ]
+    for u in urls:
+        assert cf(u) == any(f(u) for f in naive), u
+
+    assert cf.dropped == {
+        '^about:'                       : 1,
+        r'^chrome-\w+://'               : 1,
+        'chrome://newtab'               : 1,
+        r'^https://example\.com/private': 1,
+        r'(?i)TRACKER'                  : 1,
+        r'(a)b\1'                       : 1,
+        r'(?P<x>spam)'                  : 1,
+        r'(?P<x>eggs)'                  : 1,
+        'is_local'                      : 1,
+    }
+
+    cf = CompiledFilters([*DEFAULT_FILTERS, r'(a)b', '^something|other'])
+    assert cf.anchored is not E._NEVER and cf.unanchored is not E._NEVER
+    assert cf('https://ab.com')
+    assert not cf('https://ba.com')
+    # '^' only applies to the first branch
+    assert cf('https://other.com')
+    assert not cf('https://something.com')
 
 
 @pytest.mark.skipif(_is_windows, reason="no grep on windows")
@@ -295,3 +376,149 @@ def HOOK(visit: Res[DbVisit]) -> Iterable[Res[DbVisit]]:
         assert p41 == p42
         assert isinstance(p6, DbVisit)
         assert p6.locator is not None
+
+
+@pytest.mark.parametrize('strategy', ['exact', 'hash64', 'hash128', 'window'])
+def test_dedup(strategy: str) -> None:
+    from promnesia.extract import make_dedup
+
+    def visits():
+        for i in [0, 1, 0, 2, 2, 3, 4, 5, 0]:
+            yield Visit(
+                url=f'http://test{i}',
+                dt=datetime.utcfromtimestamp(0),
+                locator=Loc.make('whatever'),
+            )
+
+    with with_config(f'''
+DEDUP = {strategy!r}
+DEDUP_WINDOW = 3
+'''):
+        assert make_dedup().name == strategy
+        urls = [v.orig_url for v in as_ok_visits(W(lambda: visits()))]
+
+    expected = ['http://test0', 'http://test1', 'http://test2', 'http://test3', 'http://test4', 'http://test5']
+    if strategy == 'window':
+        # test0 is out of the window by the time it's emitted again
+        expected.append('http://test0')
+    assert urls == expected
+
+
+def test_dedup_memory() -> None:
+    from promnesia.extract import Dedup, Hash128Dedup
+
+    visits = [
+        Visit(
+            url=f'http://test{i}',
+            dt=datetime.utcfromtimestamp(i),
+            locator=Loc.make(f'/path/to/file{i}', href=f'editor:///path/to/file{i}'),
+            context=f'some context {i}',
+        ) for i in range(1000)
+    ]
+    exact = Dedup()
+    compact = Hash128Dedup()
+    for v in visits:
+        assert exact.add(v) and compact.add(v)
+        assert not exact.add(v) and not compact.add(v)
+    assert compact.memory() * 5 < exact.memory()
+
+
+def test_visit_batch() -> None:
+    from promnesia.common import VisitBatch, DbVisitBatch
+    from promnesia.extract import extract_batches
+
+    dt = datetime.utcfromtimestamp(0)
+    visits = [
+        Visit(
+            url=f'http://test{i % 4}/?utm_source=whatever',
+            dt=dt,
+            locator=Loc.make(f'loc{i}'),
+            context=f'ctx{i}' if i % 2 == 0 else None,
+        ) for i in range(6)
+    ]
+    err = RuntimeError('whatever')
+
+    def per_visit():
+        yield from visits[:2]
+        yield err
+        yield from visits[2:]
+
+    def batched():
+        yield VisitBatch.from_visits(visits[:2])
+        yield err
+        yield visits[2]
+        yield VisitBatch(
+            urls=[v.url for v in visits[3:]],
+            dts=[v.dt for v in visits[3:]],
+            locators=[v.locator for v in visits[3:]],
+            contexts=[v.context for v in visits[3:]],
+        )
+
+    assert list(VisitBatch.from_visits(visits)) == visits
+
+    expected = as_visits(W(lambda: per_visit()))
+    assert len(expected) == 7
+    assert as_visits(W(lambda: batched())) == expected
+
+    [b1, e, b2] = list(extract_batches(W(lambda: per_visit()), src='whatever'))
+    assert isinstance(b1, DbVisitBatch) and isinstance(b2, DbVisitBatch)
+    assert e is err
+    assert [*b1, *b2] == [v for v in expected if not isinstance(v, Exception)]
+    assert b1.norm_urls == ['test0', 'test1']
+
+
+def test_visit_batch_canonify_error(monkeypatch) -> None:
+    import promnesia.extract as E
+
+    def canonify_many(urls, *, workers=None):
+        raise RuntimeError('pool is broken')
+    monkeypatch.setattr(E, 'canonify_many', canonify_many)
+
+    dt = datetime.utcfromtimestamp(0)
+    visits = [Visit(url=f'http://test{i}', dt=dt, locator=Loc.make(f'loc{i}')) for i in range(3)]
+    # error happens during the final flush, shouldn't flush the same visits again while handling it
+    [e] = list(E.extract_batches(W(lambda: visits), src='whatever'))
+    assert isinstance(e, RuntimeError)
+
+
+def test_batch_hook() -> None:
+    from promnesia.__main__ import iter_all_visits, hook_stats
+    with with_config('''
+from promnesia.common import Source
+from promnesia.sources import demo
+
+SOURCES = [
+    Source(demo.index, count=7, name='somename'),
+]
+
+HOOK_BATCH_SIZE = 3
+
+sizes = []
+
+def HOOK(visit):
+    if 'page0' in visit.norm_url:
+        return
+    yield visit
+
+def BATCH_HOOK(visits):
+    sizes.append(len(visits))
+    if any('page5' in v.norm_url for v in visits):
+        raise RuntimeError('boom')
+    for v in visits:
+        yield v._replace(norm_url=v.norm_url.replace('demo.com', 'patched.com'))
+'''):
+        from promnesia import config
+        hook = config.get().BATCH_HOOK
+        assert hook is not None
+        sizes = hook.__globals__['sizes']
+        res = list(iter_all_visits())
+        [p1, p2, p3, e] = res
+        visits = [p for p in (p1, p2, p3) if isinstance(p, DbVisit)]
+        assert len(visits) == 3
+        assert [p.norm_url for p in visits] == ['patched.com/page1.html', 'patched.com/page2.html', 'patched.com/page3.html']
+        assert isinstance(e, RuntimeError)
+        assert sizes == [3, 3]
+        stats = hook_stats()
+        assert stats['HOOK']['calls'] == 7
+        assert stats['BATCH_HOOK']['calls'] == 2
+        assert stats['BATCH_HOOK']['seconds'] >= 0
@@ -247,6 +247,48 @@ OUTPUT_DIR = r'{tmp_path}'
     assert e.src == 'error'
 
 
+def test_recanonify(tmp_path: Path, monkeypatch) -> None:
+    import promnesia.dump
+    # to check it works across multiple chunks
+    monkeypatch.setattr(promnesia.dump, '_RECANONIFY_CHUNK', 7)
+
+    cfg = tmp_path / 'test_config.py'
+    base = f"""
+from datetime import datetime, timedelta
+from promnesia.common import Source, Visit, Loc
+def index():
+    for i in range(20):
+        yield Visit(
+            url=('https://mobile.' if i % 2 == 0 else 'https://www.') + 'mysite.org/page' + str(i),
+            dt=datetime.min + timedelta(days=5000) + timedelta(hours=i),
+            locator=Loc.make('test'),
+        )
+
+SOURCES = [Source(index)]
+OUTPUT_DIR = r'{tmp_path}'
+"""
+    cfg.write_text(base)
+    run_index(cfg)
+    db = tmp_path / 'promnesia.sqlite'
+    nurls = lambda: {v.norm_url for v in get_all_db_visits(db)}
+    assert len(nurls()) == 20
+
+    # rules changed, so now mobile and desktop pages should be unified
+    cfg.write_text(base + "\nCANONIFY_DOMAIN_SUBST = [('mobile.mysite.', 'mysite.')]\n")
+    from promnesia.dump import recanonify
+    from promnesia import config
+    config.load_from(cfg)
+    try:
+        config.get().configure_canonify()
+        changed, errors = recanonify(db)
+    finally:
+        config.reset()
+        from promnesia.cannon import configure
+        configure()
+    assert (changed, errors) == (10, 0)
+    assert nurls() == {f'mysite.org/page{i}' for i in range(20)}
+
+
 def test_indexing_update(tmp_path: Path) -> None:
     from collections import Counter
 
@@ -263,6 +305,32 @@ def test_indexing_update(tmp_path: Path) -> None:
     assert counter['hyp'] > 50, counter  # should keep the original visits too!
 
 
+def test_overwrite_while_reading(tmp_path: Path) -> None:
+    import sqlite3
+    from promnesia.bloom import BloomFilter
+
+    dt = datetime.fromisoformat('2018-06-01T10:00:00.000000+01:00')
+    db = tmp_path / 'promnesia.sqlite'
+    index_some_demo_visits(tmp_path, count=10, base_dt=dt, delta=timedelta(hours=1), update=False)
+
+    # e.g. the server is running, holding the WAL
+    reader = sqlite3.connect(db)
+    try:
+        assert reader.execute('SELECT count(*) FROM visits').fetchone() == (10,)
+        reader.execute('BEGIN')
+        reader.execute('SELECT count(*) FROM visited_filter').fetchone()
+
+        index_some_demo_visits(tmp_path, count=20, base_dt=dt, delta=timedelta(hours=1), update=False)
+
+        with sqlite3.connect(db) as conn:
+            assert conn.execute('PRAGMA integrity_check').fetchone() == ('ok',)
+            assert conn.execute('SELECT count(*) FROM visits').fetchone() == (20,)
+            [(data,)] = conn.execute('SELECT data FROM visited_filter')
+            assert BloomFilter.from_bytes(data).count == 20
+    finally:
+        reader.close()
+
+
 @pytest.mark.parametrize('execution_number', range(1))  # adjust this parameter to increase 'coverage
 def test_concurrent_indexing(tmp_path: Path, execution_number) -> None:
     cfg_slow = tmp_path / 'config_slow.py'
@@ -9,7 +9,7 @@ import sys
 from subprocess import check_output, check_call, PIPE
 from textwrap import dedent
 import time
-from typing import NamedTuple, ContextManager, Optional
+from typing import NamedTuple, ContextManager, List, Optional
 
 import pytz
 import requests
@@ -35,13 +35,15 @@ def next_port():
 
 
 @contextmanager
-def wserver(db: Optional[PathIsh]=None): # TODO err not sure what type should it be... -> ContextManager[Helper]:
+def wserver(db: Optional[PathIsh]=None, *, workers: int=1, config: Optional[PathIsh]=None): # TODO err not sure what type should it be... -> ContextManager[Helper]:
     port = str(next_port())
     cmd = [
         'serve',
         '--quiet',
         '--port', port,
         *([] if db is None else ['--db'  , str(db)]),
+        *([] if workers == 1 else ['--workers', str(workers)]),
+        *([] if config is None else ['--config', str(config)]),
     ]
     with tmp_popen(promnesia_bin(*cmd)) as server:
         # wait till ready
@@ -134,22 +136,108 @@ def test_visited(tmp_path: Path) -> None:
 
 
 import pytest
+
+
+@pytest.fixture(scope='module')
+def visited_benchmark_db(tmp_path_factory) -> Path:
+    tmp_path = tmp_path_factory.mktemp('visited_benchmark')
+    dt = pytz.utc.localize(datetime.fromisoformat('2018-06-01T10:00:00'))
+    index_some_demo_visits(tmp_path, count=10000, base_dt=dt, delta=timedelta(minutes=1), update=False)
+    return tmp_path / 'promnesia.sqlite'
+
+
 @pytest.mark.parametrize('count',
-    [1, 5, 10, 12, 25, 50, 100, 200, 400, 800, 1600]
+    [1, 5, 10, 12, 25, 50, 100, 200, 400, 800, 1600, 10000]
 )
-def test_visited_benchmark(count: int, tmp_path) -> None:
-    pytest.skip("Only works on @karlicoss computer for now")
-    # TODO skip on ci
+def test_visited_benchmark(count: int, visited_benchmark_db: Path, monkeypatch) -> None:
+    import asyncio
     import promnesia.server as S
-    # TODO reset after?
-    S.EnvConfig.set(S.ServerConfig(
-        # TODO populate with test db and benchmark properly...
-        db=Path('/todo'),
-        timezone=pytz.utc,
-    ))
-    links = [f'https://reddit.com/whatever{i}.html' for i in range(count)]
-    res = S.visited(links)
-    assert len(res) == len(links)
+
+    cfg = S.ServerConfig(db=visited_benchmark_db, timezone=pytz.utc)
+    monkeypatch.setenv(S.EnvConfig.KEY, cfg.as_str())
+    S.EnvConfig.get.cache_clear()
+    try:
+        # half of the links are present in the database
+        links = [f'https://demo.com/page{i}.html' for i in range(0, count * 2, 2)]
+        request = S.VisitedRequest(urls=links)
+        asyncio.run(S.visited(request)) # warmup, e.g. loads the db
+
+        before = time.perf_counter()
+        res = asyncio.run(S.visited(request))
+        elapsed = time.perf_counter() - before
+        print(f'/visited: {count:>5} urls, {elapsed * 1000:.1f}ms', file=sys.stderr)
+
+        assert len(res) == len(links)
+        hits = [r for r in res if r is not None]
+        assert len(hits) == len([i for i in range(0, count * 2, 2) if i < 10000])
+        assert hits[0]['normalised_url'] == 'demo.com/page0.html'
+    finally:
+        S.EnvConfig.get.cache_clear()
+
+
+def test_single_flight() -> None:
+    import asyncio
+    from promnesia.server import SingleFlight
+
+    sf = SingleFlight()
+    calls = 0
+
+    async def slow_query() -> str:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.1)
+        return 'result'
+
+    async def run() -> None:
+        results = await asyncio.gather(*(sf.do('key', slow_query) for _ in range(5)))
+        assert results == ['result'] * 5
+        assert calls == 1
+        assert sf.stats() == {'executed': 1, 'coalesced': 4}
+
+        # nothing in flight anymore, so should execute again
+        assert await sf.do('key', slow_query) == 'result'
+        assert calls == 2
+
+        # different keys aren't coalesced
+        await asyncio.gather(sf.do('key1', slow_query), sf.do('key2', slow_query))
+        assert calls == 4
+    asyncio.run(run())
+
+
+def test_db_pool() -> None:
+    import asyncio
+    import threading
+    import fastapi
+    from promnesia.server import DbPool
+
+    pool = DbPool(workers=1, max_queue=1)
+    release = threading.Event()
+
+    def heavy_query() -> str:
+        release.wait()
+        return 'heavy'
+
+    async def run() -> None:
+        running = asyncio.ensure_future(pool.run(heavy_query))
+        queued  = asyncio.ensure_future(pool.run(lambda: 'light'))
+        await asyncio.sleep(0.1)
+        assert pool.stats()['active'] == 1
+        assert pool.stats()['queued'] == 1
+
+        # both the worker and the queue are busy, so should be rejected straightaway
+        with pytest.raises(fastapi.HTTPException) as einfo:
+            await pool.run(lambda: 'rejected')
+        assert einfo.value.status_code == 503
+
+        release.set()
+        assert await running == 'heavy'
+        assert await queued  == 'light'
+        stats = pool.stats()
+        assert stats['completed'] == 2
+        assert stats['rejected' ] == 1
+        assert stats['queued'   ] == 0
+        assert stats['active'   ] == 0
+    asyncio.run(run())
 
 
 def test_search_around(tmp_path: Path) -> None:
@@ -198,6 +286,227 @@ def test_status_ok(tmp_path: Path) -> None:
         assert response['stats'] == {'total_visits': 10}
 
 
+def test_status_workers(tmp_path: Path) -> None:
+    dt = pytz.utc.localize(datetime.fromisoformat('2018-06-01T10:00:00.000000'))
+    index_some_demo_visits(tmp_path, count=10, base_dt=dt, delta=timedelta(hours=1), update=False)
+
+    with wserver(db=tmp_path / 'promnesia.sqlite', workers=2) as helper:
+        status = lambda: post(f'http://localhost:{helper.port}/status')
+
+        # requests are distributed between the workers, so should eventually hit both
+        pids = set()
+        for _ in range(50):
+            r = status()
+            pids.add(r['pid'])
+            assert r['stats'] == {'total_visits': 10}, r
+            if len(pids) == 2:
+                break
+        # but any of them reports health of all workers
+        workers = r['workers']
+        assert {w['pid'] for w in workers} == pids
+        assert all(time.time() - w['updated'] < 60 for w in workers)
+
+        # all workers should pick up database changes
+        index_some_demo_visits(tmp_path, count=20, base_dt=dt, delta=timedelta(hours=1), update=False)
+        for _ in range(10):
+            assert status()['stats'] == {'total_visits': 20}
+
+
+def test_db_fingerprint(tmp_path: Path) -> None:
+    from promnesia.server import db_fingerprint
+    dt = pytz.utc.localize(datetime.fromisoformat('2018-06-01T10:00:00.000000'))
+    db = tmp_path / 'promnesia.sqlite'
+    index_some_demo_visits(tmp_path, count=10, base_dt=dt, delta=timedelta(hours=1), update=True)
+    fp1 = db_fingerprint(db)
+
+    # same data, so nothing to reload even though the database files were written
+    index_some_demo_visits(tmp_path, count=10, base_dt=dt, delta=timedelta(hours=1), update=True)
+    assert db_fingerprint(db) == fp1
+
+    index_some_demo_visits(tmp_path, count=20, base_dt=dt, delta=timedelta(hours=1), update=True)
+    fp2 = db_fingerprint(db)
+    assert fp2 != fp1
+
+    # overwriting replaces the file
+    index_some_demo_visits(tmp_path, count=20, base_dt=dt, delta=timedelta(hours=1), update=False)
+    fp3 = db_fingerprint(db)
+    assert fp3 != fp2
+
+    # unchanged database, so the version shouldn't be read again
+    from unittest.mock import patch
+    with patch('promnesia.server._read_db_version', side_effect=AssertionError('should be cached')):
+        assert db_fingerprint(db) == fp3
+
+
+def test_changes(tmp_path: Path) -> None:
+    dt = pytz.utc.localize(datetime.fromisoformat('2018-06-01T10:00:00.000000'))
+    index_some_demo_visits(tmp_path, count=10, base_dt=dt, delta=timedelta(hours=1), update=False)
+
+    with wserver(db=tmp_path / 'promnesia.sqlite') as helper:
+        changes = lambda since: requests.get(f'http://localhost:{helper.port}/changes', params={'since': since}).json()
+
+        r = changes(0)
+        v1 = r['version']
+        assert not r['reset']
+        assert len(r['added']) == 10
+        assert r['added'][0]['original_url'].startswith('https://demo.com/page')
+        assert r['removed'] == []
+
+        assert changes(v1) == {'version': v1, 'reset': False, 'added': [], 'removed': [], 'more': False}
+
+        # paginated
+        urls: List[str] = []
+        cursor = None
+        while True:
+            r = requests.get(f'http://localhost:{helper.port}/changes', params={'since': 0, 'limit': 3, **({} if cursor is None else {'cursor': cursor})}).json()
+            assert len(r['added']) <= 3
+            urls.extend(v['normalised_url'] for v in r['added'])
+            if not r['more']:
+                break
+            cursor = r['cursor']
+        assert sorted(urls) == sorted(f'demo.com/page{i}.html' for i in range(10))
+
+        # reindexing with the same data shouldn't bump the version
+        index_some_demo_visits(tmp_path, count=10, base_dt=dt, delta=timedelta(hours=1), update=False)
+        assert changes(v1)['version'] == v1
+
+        # pages 5..9 are gone
+        index_some_demo_visits(tmp_path, count=5, base_dt=dt, delta=timedelta(hours=1), update=False)
+        r = changes(v1)
+        v2 = r['version']
+        assert v2 > v1
+        assert r['added'] == []
+        assert sorted(r['removed']) == sorted(f'demo.com/page{i}.html' for i in range(5, 10))
+
+        # client which is ahead (e.g. database was recreated from scratch) should resync
+        r = changes(v2 + 100)
+        assert r['reset']
+        assert len(r['added']) == 5
+
+
+def test_changes_contents(tmp_path: Path) -> None:
+    url = 'https://example.com/page'
+    index_urls({url: 'old context'})(tmp_path)
+    with wserver(db=tmp_path / 'promnesia.sqlite') as helper:
+        changes = lambda since: requests.get(f'http://localhost:{helper.port}/changes', params={'since': since}).json()
+        v1 = changes(0)['version']
+
+        # same number of visits/timestamps, only the context is different
+        index_urls({url: 'new context'})(tmp_path)
+        r = changes(v1)
+        assert r['version'] > v1
+        [added] = r['added']
+        assert added['context'] == 'new context'
+
+
+def test_visited_filter(tmp_path: Path) -> None:
+    from promnesia.bloom import BloomFilter
+    dt = pytz.utc.localize(datetime.fromisoformat('2018-06-01T10:00:00.000000'))
+    index_some_demo_visits(tmp_path, count=10, base_dt=dt, delta=timedelta(hours=1), update=False)
+
+    with wserver(db=tmp_path / 'promnesia.sqlite') as helper:
+        endpoint = f'http://localhost:{helper.port}/visited_filter'
+        r = requests.get(endpoint)
+        r.raise_for_status()
+        etag = r.headers['ETag']
+        bf = BloomFilter.from_bytes(r.content)
+        assert bf.count == 10
+        assert 'demo.com/page0.html' in bf
+        assert 'demo.com/page9.html' in bf
+
+        # not modified
+        r = requests.get(endpoint, headers={'If-None-Match': etag})
+        assert r.status_code == 304
+        assert r.content == b''
+
+        index_some_demo_visits(tmp_path, count=20, base_dt=dt, delta=timedelta(hours=1), update=False)
+        r = requests.get(endpoint, headers={'If-None-Match': etag})
+        assert r.status_code == 200
+        assert r.headers['ETag'] != etag
+        bf = BloomFilter.from_bytes(r.content)
+        assert bf.count == 20
+        assert 'demo.com/page19.html' in bf
+
+
+def test_conditional_and_compressed(tmp_path: Path) -> None:
+    dt = pytz.utc.localize(datetime.fromisoformat('2018-06-01T10:00:00.000000'))
+    index_some_demo_visits(tmp_path, count=100, base_dt=dt, delta=timedelta(hours=1), update=False)
+
+    with wserver(db=tmp_path / 'promnesia.sqlite') as helper:
+        endpoint = f'http://localhost:{helper.port}/visited'
+        urls = [f'https://demo.com/page{i}.html' for i in range(100)]
+        query = lambda **headers: requests.post(endpoint, json={'urls': urls}, headers=headers)
+
+        r = query(**{'Accept-Encoding': 'gzip'})
+        assert r.status_code == 200
+        assert r.headers['Content-Encoding'] == 'gzip'
+        assert all(x is not None for x in r.json())
+        etag = r.headers['ETag']
+
+        r = query(**{'Accept-Encoding': 'identity'})
+        assert 'Content-Encoding' not in r.headers
+        assert r.headers['ETag'] == etag
+
+        r = query(**{'If-None-Match': etag})
+        assert r.status_code == 304
+        assert r.content == b''
+
+        # different request
+        r = requests.post(endpoint, json={'urls': urls[:10]}, headers={'If-None-Match': etag})
+        assert r.status_code == 200
+        assert len(r.json()) == 10
+
+        # database changed
+        index_some_demo_visits(tmp_path, count=50, base_dt=dt, delta=timedelta(hours=1), update=False)
+        r = query(**{'If-None-Match': etag})
+        assert r.status_code == 200
+        assert r.headers['ETag'] != etag
+        assert r.json()[60] is None
+
+
+def test_etag_without_version(tmp_path: Path, monkeypatch) -> None:
+    import promnesia.server as S
+
+    # e.g. running from the repository, without the package installed
+    def get_version() -> str:
+        raise RuntimeError('not installed')
+    monkeypatch.setattr(S, 'get_version', get_version)
+    cfg = S.ServerConfig(db=tmp_path / 'promnesia.sqlite', timezone=pytz.utc)
+    monkeypatch.setenv(S.EnvConfig.KEY, cfg.as_str())
+    S.EnvConfig.get.cache_clear()
+    S._etag_salt.cache_clear()
+    try:
+        assert 'unknown' in S._etag_salt()
+    finally:
+        S.EnvConfig.get.cache_clear()
+        S._etag_salt.cache_clear()
+
+
+def test_custom_canonify_rules(tmp_path: Path) -> None:
+    cfg = tmp_path / 'config.py'
+    cfg.write_text(dedent(f'''
+    OUTPUT_DIR = r'{tmp_path}'
+
+    from datetime import datetime
+    from promnesia.common import Source, Visit, Loc
+    from promnesia.cannon import Spec
+    SOURCES = [Source(
+        lambda: [Visit(url='https://mobile.mysite.org/post?article=123&session=xxx', dt=datetime(2020, 1, 1), locator=Loc.make('test'))],
+        name='test',
+    )]
+
+    CANONIFY_SPECS = {{'mysite.org': Spec(qkeep=['article'])}}
+    CANONIFY_DOMAIN_SUBST = [('mobile.mysite.', 'mysite.')]
+    '''))
+    check_call(promnesia_bin('index', '--config', cfg))
+
+    with wserver(db=tmp_path / 'promnesia.sqlite', config=cfg) as helper:
+        response = post(f'http://localhost:{helper.port}/visited', '''urls:=["https://mysite.org/post?article=123&utm_source=xxx", "https://mysite.org/post"]''')
+        assert response[0] is not None
+        assert response[0]['original_url'] == 'https://mobile.mysite.org/post?article=123&session=xxx'
+        assert response[1] is None
+
+
 def test_status_error(tmp_path: Path) -> None:
     with wserver(db='/does/not/exist') as helper:
         response = post(f'http://localhost:{helper.port}/status')
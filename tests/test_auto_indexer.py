@@ -53,6 +53,16 @@ def test_auto() -> None:
     assert "I've enjoyed [Chandler Carruth's" in v.context
 
 
+def test_auto_workers(tmp_path, monkeypatch) -> None:
+    monkeypatch.setenv('PROMNESIA_CORES', '2')
+    from config_tests import with_config
+    with with_config(f'''
+CACHE_DIR = {str(tmp_path)!r}
+'''):
+        mm = makemap(auto.index(tdata('auto')))
+    assert _JSON_URLS.issubset(mm.keys())
+
+
 def test_obsidian() -> None:
     mm = makemap(auto.index(tdata('obsidian-vault')))
     example_url = 'https://example.com'
@@ -65,3 +75,110 @@ def test_logseq() -> None:
     example_url = 'https://example.com'
     [v] = mm[example_url]
     assert v.locator.href.startswith('logseq://')
+
+
+def test_gitignore(tmp_path) -> None:
+    (tmp_path / '.gitignore').write_text('ignored/\n')
+    (tmp_path / 'notes.txt').write_text('see https://example.com\n')
+    (tmp_path / 'ignored').mkdir()
+    (tmp_path / 'ignored' / 'notes.txt').write_text('see https://example.org\n')
+
+    mm = makemap(auto.index(tmp_path))
+    assert mm.keys() == {'https://example.com', 'https://example.org'}
+
+    mm = makemap(auto.index(tmp_path, use_gitignore=True))
+    assert mm.keys() == {'https://example.com'}
+
+
+def test_hidden(tmp_path) -> None:
+    (tmp_path / 'notes.txt').write_text('see https://example.com\n')
+    (tmp_path / '.cache').mkdir()
+    (tmp_path / '.cache' / 'notes.txt').write_text('see https://example.org\n')
+
+    mm = makemap(auto.index(tmp_path))
+    assert mm.keys() == {'https://example.com'}
+
+    mm = makemap(auto.index(tmp_path, hidden=True))
+    assert mm.keys() == {'https://example.com', 'https://example.org'}
+
+
+def test_mime_cache(tmp_path, monkeypatch) -> None:
+    import sqlite3
+    from promnesia import common
+    from promnesia.mime_cache import mime_cache
+
+    data = tmp_path / 'data'
+    data.mkdir()
+    notes = data / 'notes'  # no extension, so needs content based detection
+    notes.write_text('see https://example.com\n')
+    sqlite3.connect(str(data / 'db')).execute('CREATE TABLE x (y)').connection.commit()
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+
+    def stats():
+        with mime_cache(cache_dir) as mc:
+            return mc.stats()
+
+    from config_tests import with_config
+    with with_config(f'''
+CACHE_DIR = {str(cache_dir)!r}
+'''):
+        mm = makemap(auto.index(data))
+        assert mm.keys() == {'https://example.com'}
+        assert stats() == {'hits': 0, 'misses': 0, 'size': 2}
+
+        # shouldn't touch the files content now
+        calls = []
+        orig = common.mime_from_content
+        def patched(path):
+            calls.append(path)
+            return orig(path)
+        monkeypatch.setattr('promnesia.mime_cache.mime_from_content', patched)
+        mm = makemap(auto.index(data))
+        assert mm.keys() == {'https://example.com'}
+        assert calls == []
+
+        # changed files are detected again
+        notes.write_text('see https://example.org and some more text\n')
+        mm = makemap(auto.index(data))
+        assert mm.keys() == {'https://example.org'}
+        assert calls == [str(notes)]
+
+
+
+def test_mime_errors(tmp_path, monkeypatch) -> None:
+    from promnesia import common
+
+    data = tmp_path / 'data'
+    data.mkdir()
+    (data / 'a_broken').write_text('see https://example.org\n')
+    (data / 'b_notes').write_text('see https://example.com\n')
+    (data / 'c_unknown').write_bytes(b'\x00\x01\x02')
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+
+    orig = common.mime_from_content
+    def patched(path):
+        if str(path).endswith('a_broken'):
+            raise PermissionError(path)
+        if str(path).endswith('c_unknown'):
+            return None  # e.g. no libmagic
+        return orig(path)
+    monkeypatch.setattr('promnesia.mime_cache.mime_from_content', patched)
+    monkeypatch.setattr('promnesia.sources.auto.mime', patched)
+
+    from config_tests import with_config
+    from promnesia.mime_cache import mime_cache
+    with with_config(f'''
+CACHE_DIR = {str(cache_dir)!r}
+'''):
+        res = list(auto.index(data))
+    # the error only affects the broken file (and there is no extractor for the unknown one)
+    errors = [r for r in res if isinstance(r, Exception)]
+    assert len(errors) == 2
+    assert any(isinstance(e, PermissionError) for e in errors)
+    assert {r.url for r in res if not isinstance(r, Exception)} == {'https://example.com'}
+
+    # undetected mime types aren't persisted
+    with mime_cache(cache_dir) as mc:
+        assert mc.stats()['size'] == 1
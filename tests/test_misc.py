@@ -42,6 +42,154 @@ python.org/one.html ?? https://python.org/two.html some extra text
     }
 
 
+def _urlextract_urls(text: str, *, syntax: str) -> list:
+    # reference implementation: plain URLExtract, without any speedups
+    from urlextract import URLExtract # type: ignore
+    from promnesia.common import _sanitize
+    u = URLExtract()
+    if syntax == 'org':
+        u._stop_chars_right |= {'[', ']'}
+        u._stop_chars_left  |= {'[', ']'}
+    return [_sanitize(x) for x in u.gen_urls(text)]
+
+
+def test_extract_same_as_urlextract() -> None:
+    from time import perf_counter
+    from common import tdata
+
+    texts = [
+        p.read_text() for p in sorted(Path(tdata('')).rglob('*'))
+        if p.is_file() and p.suffix in {'.txt', '.org', '.md', '.json', '.html'}
+    ]
+    lines = [l for t in texts for l in t.splitlines()]
+    tricky = [
+        'http://x.com',
+        'http://x.com.',
+        'http://x.com, and y.org',
+        'http://x.com;',
+        'http://x.com:8080/path',
+        'https://www.google.com/x.com.',
+        'http://a.1.com/b 3.14 1.2.3.4',
+        'http://x.comx',
+        '(https://example.com/page)',
+        '[[https://example.com/page][description]]',
+        '[[https://example.com][description]]',
+        '[link](https://example.com/page?x=1&y=2#frag)',
+        '"https://example.com/page" and \'https://example.org\'',
+        'https://web.archive.org/web/2020/https://example.com/ http://localhost:8000',
+        'no urls here, but README.md and foo.py',
+        'LOCALHOST',
+        'http://пример.рф/путь and https://example.com',
+    ]
+    for syntax in ['', 'org']:
+        for data in [texts, lines, tricky]:
+            before = perf_counter()
+            expected = [_urlextract_urls(t, syntax=syntax) for t in data]
+            slow = perf_counter() - before
+
+            before = perf_counter()
+            actual = [extract_urls(t, syntax=syntax) for t in data]
+            fast = perf_counter() - before
+
+            print(f'syntax={syntax!r}: {len(data)} texts, URLExtract: {slow:.3f}s, extract_urls: {fast:.3f}s')
+            assert actual == expected
+
+
+def test_urlextract_internals() -> None:
+    '''
+    If this fails, URLExtract internals have changed: extract_urls still works, but without the speedups
+    (adapt promnesia.common to the new version, or adjust the urlextract version range in setup.py)
+    '''
+    from urlextract import URLExtract # type: ignore
+    import promnesia.common as C
+
+    u = URLExtract()
+    missing = [a for a in C._URLEXTRACT_ATTRS if not hasattr(u, a)]
+    assert missing == []
+    assert C._urlextract_compatible(u)
+
+    for syntax in ['', 'org']:
+        scanner = C._get_url_scanner(syntax=syntax)
+        assert isinstance(scanner.extractor._tlds_re, C._TldScanner)
+        assert scanner.tlds is scanner.extractor._tlds_re
+
+
+def test_urlextract_fallback() -> None:
+    from urlextract import URLExtract # type: ignore
+    import promnesia.common as C
+
+    text = 'see https://example.com, foo.org and http://пример.рф/путь'
+    # plain URLExtract (i.e. as if the internals were unsupported), should use public API only
+    scanner = C._UrlScanner(URLExtract())
+    assert scanner.tlds is None
+    assert [C._sanitize(x) for x in scanner.urls(text)] == _urlextract_urls(text, syntax='')
+
+
+def test_tlds_cache(tmp_path: Path) -> None:
+    from unittest.mock import patch
+    import promnesia.common as C
+
+    def reset() -> None:
+        C._tld_scanners.clear()
+        C._get_urlextractor.cache_clear()
+        C._get_url_scanner.cache_clear()
+
+    text = 'see https://example.com, foo.org and http://пример.рф/путь'
+    expected = _urlextract_urls(text, syntax='')
+    cache_file = tmp_path / 'urlextract_tlds.json'
+    try:
+        reset()
+        C.preload_urlextractors(tmp_path)
+        assert cache_file.exists()
+        assert extract_urls(text) == expected
+
+        # should be loaded from the cache now
+        reset()
+        C.preload_urlextractors(tmp_path)
+        [scanner] = C._tld_scanners.values()
+        assert scanner.tlds == C._TldScanner.parse(_urlextract_re())
+        assert extract_urls(text) == expected
+
+        # cache created by a different urlextract version should be ignored and rewritten
+        import json
+        import urlextract # type: ignore
+        data = json.loads(cache_file.read_text())
+        assert data['urlextract_version'] == urlextract.__version__
+        data['urlextract_version'] = '0.0.1'
+        data['tlds'] = ['.bogus']
+        cache_file.write_text(json.dumps(data))
+        reset()
+        C.preload_urlextractors(tmp_path)
+        [scanner] = C._tld_scanners.values()
+        assert scanner.tlds == C._TldScanner.parse(_urlextract_re())
+        assert extract_urls(text) == expected
+        assert json.loads(cache_file.read_text())['urlextract_version'] == urlextract.__version__
+
+        # corrupted cache shouldn't break anything
+        cache_file.write_text('garbage')
+        reset()
+        C.preload_urlextractors(tmp_path)
+        assert extract_urls(text) == expected
+
+        # neither should an unwritable cache dir
+        cache_file.unlink()
+        def fail(*args, **kwargs):
+            raise PermissionError('read-only')
+        with patch('promnesia.common.os.replace', fail):
+            reset()
+            C.preload_urlextractors(tmp_path)
+            assert extract_urls(text) == expected
+        assert list(tmp_path.iterdir()) == []
+    finally:
+        C._tlds_cache_dir = None
+        reset()
+
+
+def _urlextract_re():
+    from urlextract import URLExtract # type: ignore
+    return URLExtract()._tlds_re
+
+
 from promnesia.common import PathIsh, _is_windows as windows
 from promnesia.sources.auto import by_path
 
@@ -82,3 +230,30 @@ def test_filetypes() -> None:
         assert handled('file.' + ext)
 
     assert handled('x.html')
+
+
+def test_sniff_mime(tmp_path) -> None:
+    import gzip
+    import sqlite3
+    import zipfile
+    from promnesia.common import mime_from_content, _magic
+
+    sqlite3.connect(str(tmp_path / 'db')).execute('CREATE TABLE x (y)').connection.commit()
+    with zipfile.ZipFile(tmp_path / 'zip', 'w') as zf:
+        zf.writestr('a.txt', 'hi')
+    with zipfile.ZipFile(tmp_path / 'epub', 'w') as zf:
+        zf.writestr('mimetype', 'application/epub+zip')
+        zf.writestr('content.xhtml', '<html/>')
+    (tmp_path / 'gz').write_bytes(gzip.compress(b'hello'))
+    (tmp_path / 'pdf').write_bytes(b'%PDF-1.4\n1 0 obj\n<<>>\nendobj\ntrailer\n<<>>\n%%EOF\n')
+    (tmp_path / 'gif').write_bytes(b'GIF89a\x01\x00\x01\x00\x00\x00\x00;')
+    (tmp_path / 'empty').write_bytes(b'')
+    (tmp_path / 'txt').write_text('just some text\n')
+
+    magic = _magic()
+    for p in sorted(tmp_path.iterdir()):
+        expected = magic(str(p))
+        if expected is None:
+            # no libmagic
+            continue
+        assert mime_from_content(p) == expected, p
@@ -1,15 +1,28 @@
+import os
 from pathlib import Path
-from promnesia.common import traverse
+from promnesia.common import traverse, _is_windows
+from promnesia.walk import walk, GitIgnore, IgnoreRules, WalkStats
 from unittest.mock import Mock, patch
+import pytest
 from common import DATA
 
 
 testDataPath = Path(DATA) / 'traverse'
 
+
+@pytest.fixture
+def external(monkeypatch):
+    monkeypatch.setenv('PROMNESIA_TRAVERSE', 'external')
+
+
+def test_traverse_ignore():
+    paths = set(traverse(testDataPath, ignore=['ignoreme.txt', 'ignoreme2']))
+    assert paths == {testDataPath / 'imhere.txt', testDataPath / 'imhere2/real.txt'}
+
 # Patch shutil.which so it always returns false (when trying to which fdfind, etc)
 # so that it falls back to find
 @patch('promnesia.common.shutil.which', return_value=False)
-def test_traverse_ignore_find(patched):
+def test_traverse_ignore_find(patched, external):
     '''
     traverse() with `find` but ignore some stuff
     '''
@@ -19,7 +32,7 @@ def test_traverse_ignore_find(patched):
     # assert
     assert paths == {testDataPath / 'imhere2/real.txt', testDataPath / 'imhere.txt'}
 
-def test_traverse_ignore_fdfind():
+def test_traverse_ignore_fdfind(external):
     '''
     traverse() with `fdfind` but ignore some stuff
     '''
@@ -32,7 +45,7 @@ def test_traverse_ignore_fdfind():
 # TODO: It would be nice to test the implementation directly without having to do this
 # weird patching in the future
 @patch('promnesia.common._is_windows', new_callable=lambda: True)
-def test_traverse_ignore_windows(patched):
+def test_traverse_ignore_windows(patched, external):
     '''
     traverse() with python when _is_windows is true but ignore some stuff
     '''
@@ -41,3 +54,160 @@ def test_traverse_ignore_windows(patched):
 
     # assert
     assert paths == {testDataPath / 'imhere.txt', testDataPath / 'imhere2/real.txt'}
+
+
+def _walk(root: Path, **kwargs):
+    return [str(e.path.relative_to(root)) for e in walk(root, **kwargs)]
+
+
+def test_walk(tmp_path: Path) -> None:
+    for p in [
+            'b.txt',
+            'a/2.txt',
+            'a/1.txt',
+            'a/node_modules/x.js',
+            'c/d/e.txt',
+            'c/skipped.log',
+            'c/d/kept.log',
+            'build/out.txt',
+            'docs/build/index.txt',
+    ]:
+        (tmp_path / p).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / p).write_text(p)
+    (tmp_path / '.gitignore').write_text('''
+# comment
+*.log
+!d/kept.log
+/build/
+''')
+    (tmp_path / 'c' / '.gitignore').write_text('!kept.log\n')
+    expected = [
+        'a/1.txt',
+        'a/2.txt',
+        'b.txt',
+        'c/d/e.txt',
+        'c/d/kept.log',
+        'docs/build/index.txt',
+    ]
+    # should be deterministic regardless of the scanning threads
+    assert _walk(tmp_path, ignore=['node_modules'], gitignore=True, threads=0) == expected
+    assert _walk(tmp_path, ignore=['node_modules'], gitignore=True, threads=4) == expected
+    assert _walk(tmp_path, ignore=['node_modules'], gitignore=True, threads=1) == expected
+
+    # .gitignore is opt-in
+    assert 'c/skipped.log' in _walk(tmp_path)
+    assert 'build/out.txt' in _walk(tmp_path)
+    assert 'a/node_modules/x.js' in _walk(tmp_path, gitignore=False)
+    assert _walk(tmp_path, ignore=['*.txt', '.gitignore', 'c', 'node_modules'], gitignore=False) == []
+
+    # hidden files are skipped by default, same as fd
+    assert '.gitignore' not in _walk(tmp_path)
+    assert _walk(tmp_path, ignore=['node_modules'], gitignore=True, hidden=True) == sorted([*expected, '.gitignore', 'c/.gitignore'])
+
+    for e in walk(tmp_path):
+        assert e.stat.st_size == os.path.getsize(e.path)
+        assert not e.symlinked
+
+
+def test_traverse_gitignore(tmp_path: Path) -> None:
+    (tmp_path / '.gitignore').write_text('*.log\n')
+    (tmp_path / 'a.txt').write_text('a')
+    (tmp_path / 'b.log').write_text('b')
+
+    # by default .gitignore isn't respected
+    assert set(traverse(tmp_path)) == {tmp_path / 'a.txt', tmp_path / 'b.log'}
+    assert set(traverse(tmp_path, use_gitignore=True)) == {tmp_path / 'a.txt'}
+    assert set(traverse(tmp_path, use_gitignore=True, hidden=True)) == {tmp_path / '.gitignore', tmp_path / 'a.txt'}
+
+
+def test_traverse_hidden(tmp_path: Path) -> None:
+    root = tmp_path / '.notes'  # hidden root is still traversed
+    for p in ['a.txt', '.hidden.txt', '.cache/b.txt', 'sub/.c.txt']:
+        (root / p).parent.mkdir(parents=True, exist_ok=True)
+        (root / p).write_text(p)
+
+    assert set(traverse(root)) == {root / 'a.txt'}
+    assert set(traverse(root, hidden=True)) == {root / p for p in ['a.txt', '.hidden.txt', '.cache/b.txt', 'sub/.c.txt']}
+
+
+def test_gitignore() -> None:
+    gi = GitIgnore([
+        'foo',
+        'bar/',
+        'a/**/z',
+        '/rooted.txt',
+        '*.py[cod]',
+        'doc/*.md',
+        '\\!important',
+    ])
+    assert gi.match('foo', is_dir=False)
+    assert gi.match('x/foo', is_dir=True)
+    assert gi.match('bar', is_dir=True)
+    assert gi.match('bar', is_dir=False) is None
+    assert gi.match('a/z', is_dir=False)
+    assert gi.match('a/b/c/z', is_dir=False)
+    assert gi.match('rooted.txt', is_dir=False)
+    assert gi.match('x/rooted.txt', is_dir=False) is None
+    assert gi.match('x/y.pyc', is_dir=False)
+    assert gi.match('x/y.pyx', is_dir=False) is None
+    assert gi.match('doc/x.md', is_dir=False)
+    assert gi.match('doc/sub/x.md', is_dir=False) is None
+    assert gi.match('!important', is_dir=False)
+
+
+@pytest.mark.skipif(_is_windows, reason="filenames with newlines/symlinks")
+def test_walk_weird(tmp_path: Path) -> None:
+    (tmp_path / 'new\nline.txt').write_text('whatever')
+    d = tmp_path / 'dir'
+    d.mkdir()
+    (d / 'file.txt').write_text('whatever')
+    # symlink loop
+    (d / 'loop').symlink_to(tmp_path)
+    (tmp_path / 'broken').symlink_to(tmp_path / 'nonexistent')
+    (tmp_path / 'link.txt').symlink_to(d / 'file.txt')
+
+    assert _walk(tmp_path) == ['dir/file.txt', 'link.txt', 'new\nline.txt']
+    assert [e.symlinked for e in walk(tmp_path)] == [False, True, False]
+    assert _walk(tmp_path, follow=False) == ['dir/file.txt', 'new\nline.txt']
+    assert set(traverse(tmp_path)) == {d / 'file.txt', tmp_path / 'link.txt', tmp_path / 'new\nline.txt'}
+
+
+def test_ignore_rules(tmp_path: Path) -> None:
+    from fnmatch import fnmatch
+    for p in [
+            'notes/a.org',
+            'notes/private/secret.org',
+            'notes/private.org',
+            'notes/x.txt/inside.md',
+            'notes/.git/config',
+            'notes/y.pyc',
+            'other/z.org',
+    ]:
+        (tmp_path / p).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / p).write_text(p)
+    names = ['.git', '*.pyc']
+    paths = ['*/private*', '*.txt', '*/other/*']
+
+    stats = WalkStats()
+    res = [e.path for e in walk(tmp_path, ignore=names, ignore_paths=paths, stats=stats)]
+
+    # should be same as checking each file individually
+    every = [e.path for e in walk(tmp_path)]
+    expected = [
+        p for p in every
+        if not any(n in p.parts for n in ['.git']) and not fnmatch(p.name, '*.pyc') and not any(fnmatch(str(p), g) for g in paths)
+    ]
+    assert res == expected == [tmp_path / 'notes/a.org', tmp_path / 'notes/x.txt/inside.md']
+
+    # private/, other/ and .git/ are never listed
+    assert stats.pruned_dirs  == 3
+    assert stats.pruned_files == 2  # private.org and y.pyc
+    assert stats.files == 2
+    assert stats.dirs  == 3  # root, notes, x.txt
+
+    rules = IgnoreRules(names=names, paths=paths)
+    assert rules.name('.git') and rules.name('a.pyc') and not rules.name('a.py')
+    assert rules.file('/x/notes.txt') and not rules.file('/x/notes.md')
+    # '*.txt' doesn't match the files inside the directory, so it can't be pruned
+    assert not rules.dir('/x/notes.txt')
+    assert rules.dir('/x/private') and rules.dir('/x/other')